@@ -0,0 +1,251 @@
+import csv
+import json
+import math
+import time
+import linecache
+import collections
+import numpy as np
+import pina.gen
+import pina.misc
+from pina.profiling import percentile
+
+
+KEYS = ('test', 'width', 'height', 'size')
+
+STATISTICS = ('mean', 'std', 'p50', 'p90', 'p99')
+
+GATED = ('call_p50', 'kernel_p50')
+
+
+def timing(times):
+    """Return the mean, standard deviation and percentiles of *times* in seconds."""
+    values = sorted(times)
+
+    if not values:
+        return None
+
+    mean = sum(values) / len(values)
+    std = (sum((v - mean) ** 2 for v in values) / len(values)) ** 0.5
+    return dict(mean=mean, std=std,
+                p50=percentile(values, 50),
+                p90=percentile(values, 90),
+                p99=percentile(values, 99))
+
+
+def flatten(record):
+    """
+    Return *record* with its nested timings turned into ``<column>_<statistic>``
+    entries, e.g. ``kernel_p50``.
+    """
+    result = collections.OrderedDict()
+
+    for key, value in record.items():
+        if isinstance(value, dict):
+            for stat in STATISTICS:
+                if stat in value:
+                    result['{}_{}'.format(key, stat)] = value[stat]
+        else:
+            result[key] = value
+
+    return result
+
+
+def identity(record):
+    """Return the values of *record* identifying what was measured."""
+    return tuple(record.get(k) for k in KEYS)
+
+
+def columns(records):
+    """Return the columns of the flattened *records* in order of appearance."""
+    result = [k for k in KEYS if any(k in r for r in records)]
+
+    for record in records:
+        for key in flatten(record):
+            if key not in result:
+                result.append(key)
+
+    return result
+
+
+def write_json(records, f, **config):
+    """Write *records* and the *config* they were measured with to *f*."""
+    json.dump(dict(config=config, records=records), f, indent=2, sort_keys=True,
+              separators=(',', ': '))
+    f.write('\n')
+
+
+def write_csv(records, f):
+    """Write *records* to *f* as CSV with one flattened record per row."""
+    writer = csv.DictWriter(f, columns(records), restval='', lineterminator='\n')
+    writer.writeheader()
+
+    for record in records:
+        writer.writerow(flatten(record))
+
+
+def load(path):
+    """Return the records of a file written by :func:`write_json`."""
+    with open(path) as f:
+        return json.load(f)['records']
+
+
+def compare(baseline, records, threshold=0.1, gated=GATED):
+    """
+    Return a list of (record, column, before, after) tuples for each *gated*
+    column of *records* that takes more than *threshold* longer relative to
+    the matching record of *baseline*. Records and columns that were not
+    measured in both are skipped.
+    """
+    before = dict((identity(r), flatten(r)) for r in baseline)
+    regressions = []
+
+    for record in records:
+        key = identity(record)
+
+        if key not in before:
+            continue
+
+        after = flatten(record)
+
+        for column in gated:
+            old, new = before[key].get(column), after.get(column)
+
+            if old and new is not None and new > old * (1 + threshold):
+                regressions.append((record, column, old, new))
+
+    return regressions
+
+
+def format_regressions(regressions):
+    """Return one line per regression with its relative slowdown."""
+    def name(record):
+        if 'size' in record:
+            return '{} size {}'.format(record['test'], record['size'])
+
+        return '{} {}x{}'.format(record['test'], record['width'], record['height'])
+
+    return ''.join('{} {}: {:.3e} -> {:.3e} (+{:.1%})\n'.format(
+        name(record), column, old, new, new / old - 1)
+        for record, column, old, new in regressions)
+
+
+def chain_source(name, size):
+    terms = ' + '.join('x * {}.5'.format(i) if i % 2 else 'y * {}.25'.format(i)
+                       for i in range(size))
+    return 'def {}(x, y, n):\n    return {}\n'.format(name, terms)
+
+
+def locals_source(name, size):
+    lines = ['def {}(x, y, n):'.format(name), '    a0 = x * 0.5']
+    lines += ['    a{} = a{} * y + {}.0'.format(i, i - 1, i) for i in range(1, size)]
+    lines.append('    return a{}'.format(size - 1))
+    return '\n'.join(lines) + '\n'
+
+
+def nested_source(name, size, depth=8):
+    # Python only allows 20 nested loops, so deeper kernels are sequences of
+    # nests of up to *depth* blocks
+    lines = ['def {}(x, y, n):'.format(name), '    s = 0.0']
+
+    for i in range(size):
+        indent = '    ' * (i % depth + 1)
+
+        if i % 2:
+            lines.append('{}if x > {}.0:'.format(indent, i))
+        else:
+            lines.append('{}for i{} in range(n):'.format(indent, i))
+
+        lines.append('{}    s += y * {}.0'.format(indent, i))
+
+    lines.append('    return s')
+    return '\n'.join(lines) + '\n'
+
+
+def stencil_source(name, size):
+    terms = ' + '.join('x[-{0}] + x[+{0}]'.format(i + 1) for i in range(size))
+    return 'def {}(x, y, n):\n    return {}\n'.format(name, terms)
+
+
+KERNELS = collections.OrderedDict([('chain', chain_source),
+                                   ('locals', locals_source),
+                                   ('nested', nested_source),
+                                   ('stencil', stencil_source)])
+
+
+def synthetic_kernel(kind, size):
+    """
+    Return a new function of the synthetic *kind* of kernel grown to *size*,
+    i.e. long expression chains, many locals, deeply nested blocks or many
+    relative subscripts. Each call defines a new function, whose source is
+    parsed again on translation.
+    """
+    synthetic_kernel.count += 1
+    name = '{}_{}'.format(kind, size)
+    filename = '<pina.benchmark {}>'.format(synthetic_kernel.count)
+    source = KERNELS[kind](name, size)
+
+    # Register the source like a file for inspect.getsource()
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+    namespace = {}
+    exec(compile(source, filename, 'exec'), namespace)
+    return namespace[name]
+
+synthetic_kernel.count = 0
+
+
+def translation_times(func, args, env=None):
+    """
+    Translate *func* for *args* and return an ordered dictionary with the
+    seconds spent in each pass of :func:`pina.gen.ast`, in generating the
+    source and in total.
+    """
+    timings = collections.OrderedDict()
+    specs = pina.misc.arg_specs(func, args)
+    fdef = pina.gen.ast(func, specs, env, timings)
+
+    start = time.time()
+    pina.gen.source(fdef)
+    timings['source'] = time.time() - start
+    timings['total'] = sum(timings.values())
+    return timings
+
+
+def translation_records(sizes, iterations=5, env=None, kinds=None):
+    """
+    Return records with the timing of each pass translating the synthetic
+    kernels of *kinds* at each of *sizes*, over *iterations* fresh functions.
+    """
+    x = np.zeros((64, 64), dtype=np.float32)
+    records = []
+
+    for kind in kinds or KERNELS:
+        for size in sizes:
+            times = collections.OrderedDict()
+
+            for i in range(iterations):
+                func = synthetic_kernel(kind, size)
+
+                for name, value in translation_times(func, (x, x, 4), env).items():
+                    times.setdefault(name, []).append(value)
+
+            record = collections.OrderedDict([('test', kind), ('size', size)])
+            record.update((name, timing(values)) for name, values in times.items())
+            records.append(record)
+
+    return records
+
+
+def scaling(sizes, values):
+    """
+    Return the exponent *k* of the power law ``values ~ sizes ** k`` fitted to
+    the positive *values* in log-log space, i.e. 1 for linear scaling.
+    """
+    points = [(math.log(s), math.log(v)) for s, v in zip(sizes, values) if s > 0 and v > 0]
+
+    if len(points) < 2:
+        return None
+
+    mx = sum(p[0] for p in points) / len(points)
+    my = sum(p[1] for p in points) / len(points)
+    var = sum((p[0] - mx) ** 2 for p in points)
+    return sum((p[0] - mx) * (p[1] - my) for p in points) / var if var else None
@@ -0,0 +1,268 @@
+import os
+import json
+import numpy as np
+import pyopencl as cl
+import pina.cl
+
+
+MANIFEST = 'manifest.json'
+
+REDUCTIONS = {'sum': np.sum, 'mean': np.sum, 'min': np.min, 'max': np.max}
+
+
+def load_binaries(context, devices, binaries, options):
+    """
+    Return the program built from the *binaries* of *devices*, or None if
+    they do not match the devices or fail to build.
+    """
+    if not binaries or len(binaries) != len(devices):
+        return None
+
+    try:
+        return cl.Program(context, devices, binaries).build(options)
+    except cl.Error:
+        # Binaries might be stale after a driver update
+        return None
+
+
+def compile_for(*signatures):
+    """
+    Declare the example arguments of each signature the decorated function
+    is compiled for by :func:`build`, e.g. ``@compile_for((frame, 0.5))``.
+    """
+    def _declare(func):
+        func.bundle_signatures = list(signatures)
+        return func
+
+    return _declare
+
+
+def signature(args):
+    """
+    Return the hashable signature of *args*: dtype and shape of arrays and the
+    type name of scalars. Unlike with just-in-time calls, prebuilt kernels
+    only accept the exact shapes they were compiled for.
+    """
+    def normalize(a):
+        if isinstance(a, np.ndarray):
+            return (a.dtype.name, a.shape)
+
+        return type(a).__name__
+
+    return tuple(normalize(a) for a in args)
+
+
+def describe(arg):
+    """Return the manifest entry of the example argument *arg*."""
+    import pina.ext.pycl
+
+    if isinstance(arg, np.ndarray):
+        return dict(dtype=arg.dtype.name, shape=list(arg.shape))
+
+    return dict(type=type(arg).__name__, dtype=np.dtype(type(pina.ext.pycl.scalar_arg(arg))).name)
+
+
+def build(path, funcs, runtime):
+    """
+    Compile *funcs* with *runtime* for the signatures they were declared with
+    and write the bundle to the directory *path*. Global and local sizes,
+    dimension arguments and range guards are computed now, so that loading
+    needs none of the translator.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    queue = runtime.queues[0]
+    kernels = {}
+
+    for func in funcs:
+        call = runtime.jit(func)
+        entries = kernels.setdefault(func.__name__, [])
+
+        for args in getattr(func, 'bundle_signatures', []):
+            args = tuple(args)
+            kernel = call.kernel(args)
+            program = kernel.get_info(cl.kernel_info.PROGRAM)
+            prefix = '{}_{}'.format(func.__name__, len(entries))
+            workspace = tuple(a for a in args if isinstance(a, np.ndarray))[0].shape
+            count = int(np.prod(workspace))
+
+            if call.reduction:
+                out = dict(dtype=call.out_types[kernel].name,
+                           shape=[-(-count // call.group_sizes[kernel][0])])
+            else:
+                out = dict(dtype=call.out_types[kernel].name, shape=list(workspace))
+
+            global_size, local, extra = call.launch_config(kernel, queue, workspace, [])
+            dims = call.dimension_args([a.shape if isinstance(a, np.ndarray) else None
+                                        for a in args])
+
+            with open(os.path.join(path, prefix + '.cl'), 'w') as f:
+                f.write(call.translate(args))
+
+            binaries = []
+
+            for i, binary in enumerate(program.binaries):
+                binaries.append('{}.{}.bin'.format(prefix, i))
+
+                with open(os.path.join(path, binaries[-1]), 'wb') as f:
+                    f.write(binary)
+
+            entries.append(dict(args=[describe(a) for a in args],
+                                source=prefix + '.cl',
+                                binaries=binaries,
+                                global_size=[int(n) for n in global_size],
+                                local_size=[int(n) for n in local] if local else None,
+                                extra=[int(v) for v in extra],
+                                dims=[int(v) for v in dims],
+                                out=out,
+                                reduction=call.reduction,
+                                count=count))
+
+    manifest = dict(devices=runtime.device_ids, options=runtime.env.build_options(),
+                    kernels=kernels)
+
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+
+
+class Kernel(object):
+    """
+    Prebuilt kernel of a :class:`Bundle`, which is called like a just-in-time
+    call with arguments matching one of its compiled signatures.
+    """
+
+    def __init__(self, bundle, name, entries):
+        self.bundle = bundle
+        self.name = name
+        self.entries = {}
+        self.kernels = {}
+
+        for entry in entries:
+            key = tuple((a['dtype'], tuple(a['shape'])) if 'shape' in a else a['type']
+                        for a in entry['args'])
+            self.entries[key] = entry
+
+    def __call__(self, *args, **kwargs):
+        key = signature(args)
+        entry = self.entries.get(key)
+
+        if entry is None:
+            raise TypeError("{}() was not compiled for arguments {}".format(self.name, key))
+
+        if key not in self.kernels:
+            self.kernels[key] = getattr(self.bundle.program(entry), self.name)
+
+        queue = self.bundle.queue
+        context = self.bundle.context
+        kargs = []
+
+        for arg, spec in zip(args, entry['args']):
+            if isinstance(arg, np.ndarray):
+                flags = cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR
+                kargs.append(cl.Buffer(context, flags, arg.nbytes, hostbuf=arg))
+            else:
+                kargs.append(np.dtype(spec['dtype']).type(arg))
+
+        shape, dtype = tuple(entry['out']['shape']), np.dtype(entry['out']['dtype'])
+        out = kwargs.get('out', None)
+
+        if entry['reduction'] and out is not None:
+            raise TypeError("{}() returns a scalar and takes no output".format(self.name))
+
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape or out.dtype != dtype:
+            msg = "Output must be a {} array of shape {}"
+            raise ValueError(msg.format(dtype.name, shape))
+
+        out_buffer = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, out.nbytes)
+        kargs.append(out_buffer)
+        kargs.extend(np.int32(v) for v in entry['dims'] + entry['extra'])
+
+        local = tuple(entry['local_size']) if entry['local_size'] else None
+        event = self.kernels[key](queue, tuple(entry['global_size']), local, *kargs)
+        cl.enqueue_copy(queue, out, out_buffer, wait_for=[event])
+
+        if entry['reduction']:
+            # Partial results of the work groups are reduced on the host
+            value = REDUCTIONS[entry['reduction']](out.astype(np.float64))
+
+            if entry['reduction'] == 'mean':
+                value /= entry['count']
+
+            return dtype.type(value)
+
+        return out
+
+
+class Bundle(object):
+    """
+    Kernels of the bundle written by :func:`build` to *path*, available as
+    attributes. They run on *queue* or on a queue of the first device the
+    bundle has binaries for, preferably one whose name contains
+    *preferred_device*. Programs are only loaded when first called and built
+    from source if no binary matches the device.
+    """
+
+    def __init__(self, path, queue=None, preferred_device=None):
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+
+        if queue is None:
+            devices = [d for p in cl.get_platforms() for d in p.get_devices()]
+
+            if preferred_device:
+                needle = preferred_device.lower()
+                devices = [d for d in devices if needle in d.name.lower()] or devices
+
+            known = [d for d in devices if pina.cl.device_id(d) in manifest['devices']]
+            device = (known or devices)[0]
+            queue = cl.CommandQueue(cl.Context(devices=[device]), device=device)
+
+        self.path = path
+        self.queue = queue
+        self.context = queue.context
+        self.options = manifest['options']
+        self.kernels = dict((name, Kernel(self, name, entries))
+                            for name, entries in manifest['kernels'].items())
+
+        device_id = pina.cl.device_id(queue.device)
+        self.index = manifest['devices'].index(device_id) if device_id in manifest['devices'] else None
+        self.programs = {}
+
+    def __getattr__(self, name):
+        kernels = self.__dict__.get('kernels', {})
+
+        if name not in kernels:
+            raise AttributeError(name)
+
+        return kernels[name]
+
+    def program(self, entry):
+        """Return the built program of the manifest *entry*."""
+        source = entry['source']
+
+        if source in self.programs:
+            return self.programs[source]
+
+        program = None
+
+        if self.index is not None and self.index < len(entry['binaries']):
+            with open(os.path.join(self.path, entry['binaries'][self.index]), 'rb') as f:
+                binary = f.read()
+
+            program = load_binaries(self.context, [self.queue.device], [binary], self.options)
+
+        if program is None:
+            with open(os.path.join(self.path, source)) as f:
+                program = cl.Program(self.context, f.read()).build(self.options)
+
+        self.programs[source] = program
+        return program
+
+
+def load(path, queue=None, preferred_device=None):
+    """Return the :class:`Bundle` in the directory *path*."""
+    return Bundle(path, queue, preferred_device)
@@ -0,0 +1,195 @@
+import os
+import re
+import glob
+import errno
+import hashlib
+import inspect
+import tempfile
+
+
+def default_path():
+    """Return the default cache directory, honoring *PINA_CACHE_DIR*."""
+    if 'PINA_CACHE_DIR' in os.environ:
+        return os.environ['PINA_CACHE_DIR']
+
+    base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'pina')
+
+
+def translator_digest():
+    """
+    Fingerprint the translator modules and the runtimes in ``pina.ext``,
+    which add code of their own to kernels, so that cached sources generated
+    by an older translator are not reused.
+    """
+    global _translator_digest
+
+    if _translator_digest is None:
+        h = hashlib.sha1()
+        directory = os.path.dirname(os.path.abspath(__file__))
+
+        fnames = glob.glob(os.path.join(directory, '*.py')) + \
+                 glob.glob(os.path.join(directory, 'ext', '*.py'))
+
+        for fname in sorted(fnames):
+            with open(fname, 'rb') as f:
+                h.update(f.read())
+
+        _translator_digest = h.hexdigest()
+
+    return _translator_digest
+
+_translator_digest = None
+
+
+def spec_digest(spec, env=None):
+    qualifier = spec.qualifier
+    shape = tuple(spec.shape) if spec.shape else None
+    size = spec.size
+
+    if shape and size and env and env.is_dynamic(shape):
+        shape, size = len(shape), None
+
+    return (spec.name, qualifier.__class__.__name__, qualifier.type_repr, qualifier.type_name,
+            shape, size, spec.values, spec.batched)
+
+
+def env_digest(env):
+    if env is None:
+        return None
+
+    return tuple(sorted((k, repr(v)) for k, v in vars(env).items()))
+
+
+def make_key(func, specs, env, devices):
+    """
+    Compute a content-addressed key for *func* translated with *specs* in
+    *env* and built for *devices*, a list of device identity strings.
+    """
+    h = hashlib.sha1()
+    parts = [translator_digest(),
+             inspect.getsource(func),
+             sorted(spec_digest(s, env) for s in specs.values()),
+             env_digest(env),
+             list(devices)]
+
+    h.update(repr(parts).encode('utf-8'))
+    return h.hexdigest()
+
+
+ENTRY = re.compile(r'^[^.]+\.(cl|\d+\.bin)$')
+
+
+class Cache(object):
+    """
+    On-disk store of generated kernel sources and built program binaries.
+    Each entry consists of a ``<key>.cl`` file and one ``<key>.<n>.bin`` file
+    per device. Least recently used entries are evicted once the total size
+    exceeds *max_size* bytes. Other files in the directory, such as the
+    tuning database, are left alone.
+    """
+
+    def __init__(self, path=None, max_size=64 * 1024 * 1024):
+        self.path = path or default_path()
+        self.max_size = max_size
+
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _filename(self, key, suffix):
+        return os.path.join(self.path, key + suffix)
+
+    def _write(self, fname, data):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        os.rename(tmp, fname)
+
+    def get(self, key):
+        """
+        Return a (source, binaries) tuple stored under *key* or None. If no
+        binaries were stored, the list is empty.
+        """
+        source_name = self._filename(key, '.cl')
+
+        try:
+            with open(source_name, 'rb') as f:
+                source = f.read().decode('utf-8')
+
+            binaries = []
+
+            for fname in sorted(glob.glob(self._filename(key, '.*.bin'))):
+                with open(fname, 'rb') as f:
+                    binaries.append(f.read())
+
+            os.utime(source_name, None)
+        except (IOError, OSError):
+            return None
+
+        return source, binaries
+
+    def put(self, key, source, binaries=None):
+        """Store *source* and optionally a list of device *binaries*."""
+        try:
+            for i, binary in enumerate(binaries or []):
+                self._write(self._filename(key, '.{0:02d}.bin'.format(i)), binary)
+
+            self._write(self._filename(key, '.cl'), source.encode('utf-8'))
+        except (IOError, OSError):
+            # A read-only or full cache must never break kernel execution
+            return
+
+        self.evict()
+
+    def files(self):
+        """Return the paths of the files of all entries."""
+        return [os.path.join(self.path, f) for f in os.listdir(self.path) if ENTRY.match(f)]
+
+    def size(self):
+        return sum(os.path.getsize(f) for f in self.files())
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits *max_size*."""
+        entries = {}
+
+        for fname in self.files():
+            key = os.path.basename(fname).split('.')[0]
+            size, atime = entries.get(key, (0, 0))
+
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+
+            atime = max(atime, stat.st_mtime) if fname.endswith('.cl') else atime
+            entries[key] = (size + stat.st_size, atime)
+
+        total = sum(size for size, _ in entries.values())
+
+        for key, (size, _) in sorted(entries.items(), key=lambda e: e[1][1]):
+            if total <= self.max_size:
+                break
+
+            self.remove(key)
+            total -= size
+
+    def remove(self, key):
+        for fname in glob.glob(self._filename(key, '.*')):
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+    def clear(self):
+        for fname in self.files():
+            os.remove(fname)
+
+
+def combine_keys(keys):
+    """Combine several keys into a single one."""
+    return hashlib.sha1(''.join(keys).encode('utf-8')).hexdigest()
@@ -1,54 +1,58 @@
-from pycparser import c_ast
+import importlib
+from collections import OrderedDict
 
 
-def replace(expr, needle, replacement):
-    """Replaces a *name* ID in *expr* by *node*"""
-    def check_and_replace(node):
-        return replacement if node == needle else node
+class LazyModule(object):
+    """
+    Module imported when one of its attributes is first used, so that only
+    translating kernels needs pycparser and loading bundles does not.
+    """
 
-    class Visitor(c_ast.NodeVisitor):
-        def visit_Assignment(self, node):
-            node.lvalue = check_and_replace(node.lvalue)
-            node.rvalue = check_and_replace(node.rvalue)
-            replace(node.lvalue, needle, replacement)
-            replace(node.rvalue, needle, replacement)
+    def __init__(self, name):
+        self.name = name
 
-        def visit_UnaryOp(self, node):
-            node.expr = check_and_replace(node.expr)
-            replace(node.expr, needle, replacement)
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self.name), attr)
+        setattr(self, attr, value)
+        return value
 
-        def visit_BinaryOp(self, node):
-            node.left = check_and_replace(node.left)
-            node.right = check_and_replace(node.right)
-            replace(node.left, needle, replacement)
-            replace(node.right, needle, replacement)
 
-        def visit_Return(self, node):
-            node.expr = check_and_replace(node.expr)
-            replace(node.expr, needle, replacement)
+c_ast = LazyModule('pycparser.c_ast')
+c_generator = LazyModule('pycparser.c_generator')
 
-        def visit_ExprList(self, node):
-            for i, expr in enumerate(node.exprs):
-                node.exprs[i] = check_and_replace(node.exprs[i])
-                replace(node.exprs[i], needle, replacement)
 
-        def visit_FuncCall(self, node):
-            for i, expr in enumerate(node.args.exprs):
-                node.args.exprs[i] = check_and_replace(node.args.exprs[i])
-                replace(node.args.exprs[i], needle, replacement)
+def slots(node):
+    """
+    Yield (attribute, index, child) triples for all children of *node*. The
+    index is None for children that are not stored in a list.
+    """
+    for name, child in node.children():
+        if name.endswith(']'):
+            attr, index = name[:-1].split('[')
+            yield attr, int(index), child
+        else:
+            yield name, None, child
+
 
-        def visit_Compound(self, node):
-            for i, item in enumerate(node.block_items):
-                node.block_items[i] = check_and_replace(item)
-                replace(node.block_items[i], needle, replacement)
+def walk(node):
+    """Iterate over all nodes of the tree rooted at *node* in pre-order."""
+    stack = [node]
 
-        def visit_ParamList(self, node):
-            for i, item in enumerate(node.params):
-                node.params[i] = check_and_replace(item)
-                replace(node.params[i], needle, replacement)
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed([c for _, c in node.children()]))
 
 
-    Visitor().visit(expr)
+def replace(expr, needle, replacement):
+    """Replaces a *name* ID in *expr* by *node*"""
+    for node in walk(expr):
+        for attr, index, child in slots(node):
+            if child is needle:
+                if index is None:
+                    setattr(node, attr, replacement)
+                else:
+                    getattr(node, attr)[index] = replacement
 
 
 def find(node, cond):
@@ -56,18 +60,122 @@ def find(node, cond):
     Find nodes in *node* that satisfy *cond*, a callable receiving a single
     node.
     """
-    result = []
+    return [n for n in walk(node) if cond(n)]
 
-    class Visitor(c_ast.NodeVisitor):
-        def generic_visit(self, node):
-            if cond(node):
-                result.append(node)
 
-            for _, c in node.children():
-                result.extend(find(c, cond))
+class Tree(object):
+    """
+    Index over the AST rooted at *root*. Every node is linked to its parent
+    and nodes are grouped by type, so that type lookups and replacements do
+    not need to walk the tree. All structural changes must go through the
+    methods of this class to keep the index valid.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.parents = {}
+        self.types = {}
+        self._add(root, None, None, None)
+
+    def _add(self, node, parent, attr, index):
+        stack = [(node, parent, attr, index)]
+
+        while stack:
+            node, parent, attr, index = stack.pop()
+            self.parents[id(node)] = (parent, attr, index)
+            nodes = self.types.get(type(node))
+
+            if nodes is None:
+                nodes = self.types[type(node)] = OrderedDict()
+
+            nodes[id(node)] = node
+            stack.extend((c, node, a, i) for a, i, c in reversed(list(slots(node))))
+
+    def _remove(self, node):
+        for n in walk(node):
+            self.parents.pop(id(n), None)
+            self.types[type(n)].pop(id(n), None)
+
+    def _slot(self, node):
+        parent, attr, index = self.parents[id(node)]
+
+        if index is not None:
+            items = getattr(parent, attr)
+
+            if index >= len(items) or items[index] is not node:
+                # Insertions in front of the node shifted the list
+                index = [i for i, item in enumerate(items) if item is node][0]
+
+        return parent, attr, index
 
-    Visitor().visit(node)
-    return result
+    def __contains__(self, node):
+        return id(node) in self.parents
+
+    def parent(self, node):
+        """Return the parent of *node* or None for the root."""
+        return self.parents[id(node)][0]
+
+    def ancestors(self, node):
+        """Iterate over all ancestors of *node* starting with its parent."""
+        node = self.parent(node)
+
+        while node is not None:
+            yield node
+            node = self.parent(node)
+
+    def within(self, node, ancestor):
+        """Check if *node* is part of the subtree rooted at *ancestor*."""
+        return node is ancestor or any(a is ancestor for a in self.ancestors(node))
+
+    def find_type(self, node_type, within=None):
+        """
+        Return all nodes of exactly *node_type*, optionally restricted to the
+        subtree rooted at *within*.
+        """
+        nodes = list(self.types.get(node_type, {}).values())
+
+        if within is not None and within is not self.root:
+            nodes = [n for n in nodes if self.within(n, within)]
+
+        return nodes
+
+    def find(self, node_type, cond, within=None):
+        """Return all nodes of *node_type* that satisfy *cond*."""
+        return [n for n in self.find_type(node_type, within) if cond(n)]
+
+    def replace(self, node, replacement):
+        """Put *replacement* in place of *node*."""
+        parent, attr, index = self._slot(node)
+        self._remove(node)
+
+        if parent is None:
+            self.root = replacement
+        elif index is None:
+            setattr(parent, attr, replacement)
+        else:
+            getattr(parent, attr)[index] = replacement
+
+        self._add(replacement, parent, attr, index)
+
+    def set(self, parent, attr, value):
+        """Set the child *attr* of *parent* to *value*."""
+        old = getattr(parent, attr)
+
+        if old is not None:
+            self.replace(old, value)
+        else:
+            setattr(parent, attr, value)
+            self._add(value, parent, attr, None)
+
+    def insert(self, parent, attr, index, node):
+        """Insert *node* into the child list *attr* of *parent* at *index*."""
+        items = getattr(parent, attr)
+        items.insert(index, node)
+        self._add(node, parent, attr, index)
+
+    def append(self, parent, attr, node):
+        """Append *node* to the child list *attr* of *parent*."""
+        self.insert(parent, attr, len(getattr(parent, attr)), node)
 
 
 def find_read_only(body, params):
@@ -132,6 +240,16 @@ def TypeDecl(name, typename, init):
     return c_ast.Decl(name, None, None, None, typedecl, init, None)
 
 
+def type_name(decl):
+    """
+    Return the type of the variable declared by *decl* or of the elements
+    it points to, without address space qualifiers.
+    """
+    typedecl = decl.type.type if isinstance(decl.type, c_ast.PtrDecl) else decl.type
+    words = ' '.join(typedecl.type.names).split()
+    return ' '.join(w for w in words if w not in ('__global', '__constant', '__local'))
+
+
 def PtrDecl(name, typename, qualifiers):
     """Create a pointer type declaration such as '*typename* * *name*'"""
     idtype = c_ast.IdentifierType([typename])
@@ -150,9 +268,17 @@ def ArrayRef(name, subscript):
     return c_ast.ArrayRef(c_ast.ID(name), c_ast.ID(subscript))
 
 
-def WorkItemIndex(dims=2):
-    """Build an expression to build the current work item index."""
-    left = c_ast.ID('get_global_id(1)')
-    right = c_ast.ID('get_global_size(0)')
-    a = c_ast.BinaryOp('*', left, right)
-    return c_ast.BinaryOp('+', a, c_ast.ID('get_global_id(0)'))
+def WorkItemIndex(dims=2, sizes=None):
+    """
+    Build an expression to build the current work item index of a *dims*
+    dimensional range, whose dimension 0 varies fastest. The sizes of the
+    dimensions are queried unless named in *sizes*.
+    """
+    sizes = sizes or ['get_global_size({0})'.format(dim) for dim in range(dims)]
+    index = c_ast.ID('get_global_id({0})'.format(dims - 1))
+
+    for dim in reversed(range(dims - 1)):
+        a = c_ast.BinaryOp('*', index, c_ast.ID(sizes[dim]))
+        index = c_ast.BinaryOp('+', a, c_ast.ID('get_global_id({0})'.format(dim)))
+
+    return index
@@ -2,7 +2,41 @@ class ExecutionEnvironment(object):
     def __init__(self):
         self.MAX_CONSTANT_ARGS = 2
         self.MAX_CONSTANT_SIZE = 64 * 1024
+        self.MAX_LOCAL_SIZE = 32 * 1024
         self.opt_level = 2
+        self.dataflow = True
+        self.fast_math = False
+        self.native_math = None
+        self.dynamic_shapes = False
+        self.static_shapes = []
+        self.guard_range = False
+        self.vector_width = 4
+        self.tile_size = None
+        self.reduction_size = 256
+        self.unroll_factor = 4
+        self.unroll_limit = 16
+        self.inline_limit = 64
+
+    def build_options(self):
+        """Return the compiler options for programs built in this environment."""
+        if self.fast_math:
+            return ['-cl-fast-relaxed-math', '-cl-mad-enable']
+
+        return []
+
+    def is_dynamic(self, shape):
+        """
+        Check if the dimensions of an array with *shape* are passed as kernel
+        arguments instead of being compiled into the kernel as constants.
+        """
+        return self.dynamic_shapes and tuple(shape) not in self.static_shapes
+
+
+def device_id(device):
+    """Return a string identifying the OpenCL *device* and its driver."""
+    info = (device.platform.name, device.platform.version, device.name, device.vendor,
+            device.version, device.driver_version)
+    return '/'.join(info)
 
 
 class BufferSpec(object):
@@ -17,3 +51,5 @@ class BufferSpec(object):
         self.size = None
         self.shape = None
         self.access = self.READ_ONLY
+        self.values = None
+        self.batched = False
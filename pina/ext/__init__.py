@@ -0,0 +1,26 @@
+import os
+
+
+def runtime(backend=None, **kwargs):
+    """
+    Return a runtime of *backend*, 'opencl' or 'numpy', constructed with
+    *kwargs*. Without *backend*, *PINA_BACKEND* is used and otherwise OpenCL
+    if a platform is available, NumPy if not.
+    """
+    backend = backend or os.environ.get('PINA_BACKEND')
+
+    if backend not in (None, 'opencl', 'numpy'):
+        raise ValueError("Unknown backend {0}".format(backend))
+
+    if backend != 'numpy':
+        try:
+            import pina.ext.pycl
+        except ImportError:
+            if backend == 'opencl':
+                raise
+        else:
+            if backend == 'opencl' or pina.ext.pycl.available():
+                return pina.ext.pycl.Runtime(**kwargs)
+
+    import pina.ext.pynp
+    return pina.ext.pynp.Runtime(**kwargs)
@@ -1,179 +1,1055 @@
+import re
 import sys
+import copy
 import time
+import threading
+import collections
 import pyopencl as cl
 import numpy as np
 import pina
 import pina.cl
+import pina.misc
+import pina.cache
+import pina.bundle
+import pina.gen
+import pina.tuning
+import pina.profiling
+import pina.qualifiers
 
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
 
-def slices(array, axis, n_devices):
-    rng = [dim for dim in array.shape]
-    rng[axis] = rng[axis] / n_devices
 
-    for i in range(n_devices):
-        slices = []
+def partition(n, weights):
+    """
+    Split the range [0, *n*) into contiguous (start, stop) pairs whose sizes
+    are proportional to *weights*.
+    """
+    total = float(sum(weights))
+    bounds = [0]
+    acc = 0.0
 
-        for j, dim in enumerate(rng):
-            if j == axis:
-                slices.append(slice(i * dim, (i + 1) * dim, None))
-            else:
-                slices.append(slice(0, dim, None))
+    for weight in weights:
+        acc += weight
+        bounds.append(int(round(n * acc / total)))
+
+    bounds[-1] = n
+    return zip(bounds[:-1], bounds[1:])
+
+
+def scalar_arg(arg):
+    """Convert the scalar *arg* to the type of its kernel parameter."""
+    type_name = pina.gen.element_type(pina.misc.arg_spec(arg, None))
+    return np.dtype(pina.qualifiers.numpy_type(type_name)).type(arg)
+
+
+def available():
+    """Check if an OpenCL platform with devices is available."""
+    try:
+        return any(p.get_devices() for p in cl.get_platforms())
+    except cl.Error:
+        return False
+
+
+def device_weight(device):
+    """Estimate the relative throughput of *device* before measuring it."""
+    return device.max_compute_units * device.max_clock_frequency
+
+
+class DeviceArray(object):
+    """
+    Array stored in a device buffer of *runtime*. Host data is uploaded
+    lazily when a kernel first uses the array and device data is only
+    downloaded when it is read on the host with :meth:`get`. The buffer comes
+    from the runtime's pool and goes back with :meth:`release`.
+    """
+
+    is_device_array = True
+
+    def __init__(self, runtime, shape, dtype=np.float32, host=None):
+        self.runtime = runtime
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.host = host
+        self.host_dirty = host is not None
+        self.device_dirty = False
+        self.event = None
+        self.reads = []
+        self._buffer = None
+
+    def __del__(self):
+        # Unreachable arrays are not read anymore, their data can go
+        if self._buffer is not None:
+            self.runtime.pool.release(self._buffer, self.dependencies())
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return self.get() if dtype is None else self.get().astype(dtype)
+
+    def buffer(self, queue=None):
+        """
+        Return the device buffer, uploading newer host data first. Commands
+        using the buffer must wait for :attr:`event`.
+        """
+        queue = queue or self.runtime.queues[0]
+
+        if self._buffer is None:
+            self._buffer = self.runtime.pool.acquire(self.nbytes)
+
+        if self.host_dirty:
+            self.event = cl.enqueue_copy(queue, self._buffer, self.host, is_blocking=False,
+                                         wait_for=self.dependencies())
+            self.runtime.record('to_device', 'upload', queue, self.event)
+            self.reads = []
+            self.host_dirty = False
+
+        return self._buffer
+
+    def release(self):
+        """
+        Return the device buffer to the pool, downloading newer device data
+        first. A buffer is acquired again when the array is used next.
+        """
+        if self._buffer is None:
+            return
+
+        if self.device_dirty:
+            self.get()
+
+        self.runtime.pool.release(self._buffer, self.dependencies())
+        self._buffer = None
+        self.event = None
+        self.reads = []
+        self.host_dirty = self.host is not None
+
+    def dependencies(self):
+        """Return the events a command writing the buffer must wait for."""
+        return ([self.event] if self.event else []) + self.reads
+
+    def mark_read(self, event):
+        """Record that the command of *event* reads the device buffer."""
+        complete = cl.command_execution_status.COMPLETE
+        self.reads = [e for e in self.reads if e.command_execution_status != complete]
+        self.reads.append(event)
+
+    def mark_device_dirty(self, event=None):
+        """
+        Record that a kernel wrote newer data into the device buffer, which
+        is complete once *event* finished.
+        """
+        self.device_dirty = True
+        self.host_dirty = False
+        self.event = event
+        self.reads = []
+
+    def mark_host_dirty(self):
+        """Record that the host array returned by :meth:`get` was modified."""
+        self.host_dirty = True
+        self.device_dirty = False
+
+    def set(self, array):
+        """Replace the contents with *array*, uploading it on next use."""
+        array = np.asarray(array, dtype=self.dtype)
+
+        if array.shape != self.shape:
+            raise ValueError("Shape {} does not match {}".format(array.shape, self.shape))
+
+        self.host = np.ascontiguousarray(array)
+        self.mark_host_dirty()
+
+    def get(self, queue=None):
+        """Return the data as a host array, downloading it if necessary."""
+        if self.host is None:
+            self.host = np.empty(self.shape, dtype=self.dtype)
+
+        if self.device_dirty:
+            queue = queue or self.runtime.queues[0]
+            event = cl.enqueue_copy(queue, self.host, self._buffer,
+                                    wait_for=[self.event] if self.event else None)
+            self.runtime.record('get', 'download', queue, event)
+            self.device_dirty = False
+
+        return self.host
+
+
+class Future(object):
+    """
+    Result of a non-blocking call, available once the OpenCL *event* has
+    completed. *keep* holds objects that must stay alive until then, such as
+    host arrays that are still being transferred. If given, *then* is called
+    with *value* to produce the result.
+    """
+
+    def __init__(self, event, value, keep=None, then=None):
+        self.event = event
+        self.value = value
+        self.keep = keep
+        self.then = then
+
+    def done(self):
+        if self.event is None:
+            return True
+
+        status = self.event.command_execution_status
+        return status == cl.command_execution_status.COMPLETE
+
+    def wait(self):
+        if self.event is not None:
+            self.event.wait()
+
+        self.keep = None
+
+    def result(self):
+        self.wait()
+        return self.then(self.value) if self.then else self.value
+
+    def __await__(self):
+        import asyncio
+
+        # Waiting in a worker thread leaves the event loop free
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, self.result).__await__()
+
+
+def size_class(nbytes):
+    """Return *nbytes* rounded up to a quarter of the power of two below."""
+    nbytes = max(int(nbytes), BufferPool.MIN_SIZE)
+    step = 1 << max(0, (nbytes - 1).bit_length() - 3)
+    return -(-nbytes // step) * step
+
+
+class BufferPool(object):
+    """
+    Device buffers of *context* reused by size class once the events they
+    were released with completed, keeping at most *max_bytes* resident.
+    """
+
+    MIN_SIZE = 4096
+
+    def __init__(self, context, max_bytes=None):
+        self.context = context
+        self.max_bytes = max_bytes
+        self.free = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resident = 0
+        self.used = 0
+
+    def acquire(self, nbytes):
+        """Return a buffer of at least *nbytes* for exclusive use."""
+        size = size_class(nbytes)
+        complete = cl.command_execution_status.COMPLETE
+
+        with self.lock:
+            for key, (buf, events) in self.free.items():
+                if buf.size == size and all(e.command_execution_status == complete for e in events):
+                    del self.free[key]
+                    self.hits += 1
+                    self.used += size
+                    return buf
+
+            self.misses += 1
+            self.evict(self.max_bytes - size if self.max_bytes is not None else None)
+            self.resident += size
+            self.used += size
+
+        return cl.Buffer(self.context, cl.mem_flags.READ_WRITE, size)
+
+    def release(self, buf, events=()):
+        """
+        Return *buf* to the pool, to be reused once the commands of *events*
+        completed.
+        """
+        with self.lock:
+            self.count += 1
+            self.free[self.count] = (buf, [e for e in events if e is not None])
+            self.used -= buf.size
+
+            if self.max_bytes is not None:
+                self.evict(self.max_bytes)
+
+    def evict(self, max_bytes=None):
+        """
+        Drop the least recently released free buffers until at most
+        *max_bytes* are resident, or all of them without *max_bytes*. Pending
+        commands keep their buffers alive until they completed.
+        """
+        for key in list(self.free):
+            if max_bytes is not None and self.resident <= max_bytes:
+                break
+
+            buf, _ = self.free.pop(key)
+            self.resident -= buf.size
+            self.evictions += 1
+
+    def clear(self):
+        """Drop all free buffers."""
+        with self.lock:
+            self.evict()
+
+    def stats(self):
+        """
+        Return the hits, misses and evictions so far, and the bytes of
+        buffers that are resident, in use and free.
+        """
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    resident=self.resident, used=self.used,
+                    free=self.resident - self.used, buffers=len(self.free))
+
+
+class Pipeline(object):
+    """
+    Frames streamed through *stages*, calls or (call, leading arguments)
+    tuples, with up to *depth* frames in flight.
+    """
+
+    def __init__(self, runtime, stages, depth=2):
+        self.runtime = runtime
+        self.depth = max(1, depth)
+        self.stages = []
+
+        for i, stage in enumerate(stages):
+            call, args = (stage, ()) if not isinstance(stage, tuple) else (stage[0], tuple(stage[1]))
+
+            if call.reduction and i < len(stages) - 1:
+                raise TypeError("Only the last stage can be a reduction like {}()".format(call.name))
+
+            self.stages.append((call, args))
+
+        device = runtime.devices[0]
+        self.queues = [runtime.create_queue(device, profiling=True), runtime.queues[0],
+                       runtime.create_queue(device, profiling=True)]
+
+        profiling = cl.command_queue_properties.PROFILING_ENABLE
+        self.kernels_timed = bool(runtime.queues[0].properties & profiling)
+        self.profile = pina.profiling.Profile()
+        self.read_times = []
+        self.latencies = []
+        self.elapsed = 0.0
+
+    def __call__(self, frames):
+        """
+        Return a generator of the results of the frames yielded by the
+        iterable *frames*, in order.
+        """
+        source = Queue.Queue(self.depth)
+        stop = threading.Event()
+        reader = threading.Thread(target=self.read, args=(frames, source, stop))
+        reader.daemon = True
+        reader.start()
+
+        slots = [{} for i in range(self.depth)]
+        pending = collections.deque()
+        start = time.time()
+        n = 0
+
+        try:
+            while True:
+                item = source.get()
+
+                if item is None:
+                    break
+
+                if isinstance(item, Exception):
+                    raise item
+
+                if len(pending) == self.depth:
+                    yield self.finish(*pending.popleft())
+
+                pending.append(self.submit(slots[n % self.depth], item))
+                n += 1
+
+            while pending:
+                yield self.finish(*pending.popleft())
+        finally:
+            stop.set()
+            self.elapsed += time.time() - start
+
+    def read(self, frames, source, stop):
+        """Put the frames of *frames* into *source* until done or stopped."""
+        def put(item):
+            while not stop.is_set():
+                try:
+                    source.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+
+            return False
+
+        try:
+            frames = iter(frames)
+
+            while True:
+                start = time.time()
+
+                try:
+                    frame = np.ascontiguousarray(next(frames))
+                except StopIteration:
+                    break
+
+                self.read_times.append(time.time() - start)
+
+                if not put(frame):
+                    return
+
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def submit(self, slot, frame):
+        """
+        Upload *frame* into the buffers of *slot* and enqueue all stages.
+        Return the arguments of :meth:`finish`.
+        """
+        upload, compute, download = self.queues
+        start = time.time()
+        device_frame = slot.get('frame')
+
+        if device_frame is None or device_frame.shape != frame.shape or device_frame.dtype != frame.dtype:
+            device_frame = slot['frame'] = DeviceArray(self.runtime, frame.shape, frame.dtype)
+            slot['outputs'] = [None] * len(self.stages)
+
+        event = cl.enqueue_copy(upload, device_frame.buffer(), frame, is_blocking=False,
+                                wait_for=device_frame.dependencies() or None)
+        device_frame.mark_device_dirty(event)
+        self.profile.record('frame', 'upload', 0, event, 'upload')
+
+        # The host frame must live until its upload completed
+        slot['host'] = frame
+        value = device_frame
+
+        for i, (call, args) in enumerate(self.stages):
+            future = call.enqueue(*(args + (value,)), out=slot['outputs'][i])
+
+            if self.kernels_timed:
+                self.profile.record(call.name, 'kernel', 1, future.event, 'compute')
+
+            if call.reduction:
+                return future, start
+
+            value = slot['outputs'][i] = future.value
+
+        result = np.empty(value.shape, dtype=value.dtype)
+        event = cl.enqueue_copy(download, result, value.buffer(), is_blocking=False,
+                                wait_for=[value.event])
+        value.mark_read(event)
+        self.profile.record('result', 'download', 2, event, 'download')
+        return Future(event, result), start
+
+    def finish(self, future, start):
+        """Wait for the frame submitted at *start* and return its result."""
+        value = future.result()
+        self.latencies.append(time.time() - start)
+        return value
+
+    def stats(self):
+        """Return the frame count, throughput, latency and times per stage."""
+        stages = collections.OrderedDict()
+        summary = self.profile.summary()
+        names = [('frame', 'upload')] + [(c.name, 'kernel') for c, _ in self.stages]
+        names.append(('result', 'download'))
+
+        if self.read_times:
+            stages['read'] = pina.profiling.statistics(self.read_times)
+
+        for name, stage in names:
+            if (name, stage) in summary:
+                stages[name if stage == 'kernel' else stage] = summary[(name, stage)]
+
+        for s in stages.values():
+            s['throughput'] = s['count'] / s['total'] if s['total'] else None
+
+        frames = len(self.latencies)
+        return dict(frames=frames, elapsed=self.elapsed,
+                    throughput=frames / self.elapsed if self.elapsed else None,
+                    latency=pina.profiling.statistics(self.latencies) if frames else None,
+                    stages=stages)
+
+
+def vector_width(source):
+    """
+    Return the number of elements each work item computes, as announced by
+    :func:`pina.opt.vectorize` in the kernel *source*.
+    """
+    match = re.search(r'vec_type_hint\(float(\d+)\)', source)
+    return int(match.group(1)) if match else 1
+
+
+def required_group_size(kernel, device):
+    """Return the work-group size *kernel* was compiled for or None."""
+    info = cl.kernel_work_group_info.COMPILE_WORK_GROUP_SIZE
+    size = tuple(kernel.get_work_group_info(info, device))
+    return size[:2] if size[0] else None
+
+
+def reduce_sum(x):
+    return sum(x)
+
+
+def reduce_min(x):
+    return min(x)
+
+
+def reduce_max(x):
+    return max(x)
 
-        yield slices
+
+REDUCERS = {'sum': reduce_sum, 'min': reduce_min, 'max': reduce_max}
 
 
 class JustInTimeCall(object):
 
     INIT_FLAGS = cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR
 
-    def __init__(self, func, runtime):
-        self.func = pina.jit(func, env=runtime.env)
+    def __init__(self, func, runtime, env=None, inline=(), batch=False):
+        self.env = env or runtime.env
+        self.inline = inline
+        self.batch = batch
+        self.func = pina.jit(func, env=self.env, inline=inline, batch=batch)
+        self.pyfunc = func
+        self.funcs = [func]
+        self.reduction = pina.gen.reduction(func)
         self.runtime = runtime
         self.name = func.__name__
-        self.buffers = {}
-        self.out_buffers = {}
-        self.kernel = None
-        self.output = None
-        self.temporary = None
+        self.kernels = {}
+        self.widths = {}
+        self.group_sizes = {}
+        self.out_types = {}
         self.time = 0.0
 
     def __call__(self, *args, **kwargs):
-        shape = kwargs.get('shape', None)
+        return self.launch(args, kwargs, True).result()
+
+    def enqueue(self, *args, **kwargs):
+        """
+        Launch the kernel without waiting for its completion and return a
+        :class:`Future` of the result. Additional events to wait for before
+        launching can be passed as *wait_for*. Like for blocking calls, the
+        result is written into *out* if given.
+        """
+        return self.launch(args, kwargs, False)
+
+    def launch(self, args, kwargs, blocking):
+        return self.run(self.kernel(args), kwargs.get('shape', None), kwargs.get('out', None),
+                        blocking, list(kwargs.get('wait_for', None) or []), *args)
+
+    def kernel(self, args):
+        """Return the kernel for calling with *args*, building it on first use."""
+        values = pina.misc.inline_values(self.pyfunc, args, self.inline, self.env)
+        key = (pina.misc.signature(args, self.env), tuple(sorted(values.items())))
+        kernel = self.kernels.get(key)
+
+        if kernel is None:
+            program, source = self.build(*args)
+            kernel = getattr(program, self.name)
+            self.kernels[key] = kernel
+            self.widths[kernel] = vector_width(source)
+            self.group_sizes[kernel] = required_group_size(kernel, self.runtime.devices[0])
+            self.out_types[kernel] = self.output_dtype(args)
+
+        return kernel
+
+    def translate(self, args):
+        """Return the kernel source for calling with *args*."""
+        return self.func(*args)
 
-        if not self.kernel:
-            source = self.func(*args)
-            program = cl.Program(self.runtime.context, source).build()
-            self.kernel = getattr(program, self.name)
+    def output_dtype(self, args):
+        """Return the dtype of the result for calling with *args*."""
+        specs = pina.misc.arg_specs(self.pyfunc, args)
+        return np.dtype(pina.qualifiers.numpy_type(pina.gen.output_type(self.pyfunc, specs)))
+
+    def cache_key(self, args):
+        """Return the key of the program for *args* in the disk cache."""
+        values = pina.misc.inline_values(self.pyfunc, args, self.inline, self.env)
+        specs = pina.misc.arg_specs(self.pyfunc, args, values, self.batch)
+        return pina.cache.make_key(self.pyfunc, specs, self.env,
+                                   self.runtime.device_ids)
+
+    def build(self, *args):
+        """
+        Translate and build the program for *args*, preferably loading the
+        source and device binaries from the runtime's cache. Return the
+        program and its source.
+        """
+        cache = self.runtime.cache
+        context = self.runtime.context
+        options = self.env.build_options()
+
+        if not cache:
+            source = self.translate(args)
+            return cl.Program(context, source).build(options), source
+
+        key = self.cache_key(args)
+        entry = cache.get(key)
+
+        if entry:
+            source, binaries = entry
+            program = pina.bundle.load_binaries(context, self.runtime.devices, binaries, options)
+
+            if program:
+                return program, source
+        else:
+            source = self.translate(args)
 
-        return self.run(self.kernel, shape, *args)
+        program = cl.Program(context, source).build(options)
+        cache.put(key, source, program.binaries)
+        return program, source
 
-    def run(self, kernel, shape, *args):
+    def run(self, kernel, shape, out, blocking, wait_for, *args):
+        """
+        Launch *kernel* with *args* after the events in *wait_for* completed
+        and return a :class:`Future` of the result, which is written to *out*
+        if given. With *blocking* set, the result is waited for right away and
+        buffers can be reused.
+        """
         raise NotImplementedError
 
+    def output_array(self, shape, out=None, dtype=np.float32):
+        """
+        Return *out* after checking that it can hold a result of *shape* and
+        *dtype* or allocate a new host array for it.
+        """
+        dtype = np.dtype(dtype)
+
+        if out is None:
+            if self.runtime.pinned:
+                return self.runtime.empty_pinned(shape, dtype)
+
+            return np.empty(shape, dtype=dtype)
+
+        if out.shape != tuple(shape) or out.dtype != dtype:
+            msg = "Output must be a {} array of shape {}"
+            raise ValueError(msg.format(dtype.name, tuple(shape)))
+
+        if isinstance(out, np.ndarray) and not out.flags.c_contiguous:
+            raise ValueError("Output must be C-contiguous")
+
+        return out
+
+    def enqueue_kernel(self, kernel, queue, workspace, kargs, offset=None, wait_for=None):
+        """
+        Launch *kernel* with *kargs* over the global range *workspace* starting
+        at *offset*, configured by :meth:`launch_config`.
+        """
+        global_size, local, kargs = self.launch_config(kernel, queue, workspace, kargs,
+                                                       offset, wait_for)
+        event = kernel(queue, global_size, local, *kargs,
+                       global_offset=offset, wait_for=wait_for)
+        self.runtime.record(self.name, 'kernel', queue, event)
+        return event
+
+    def launch_config(self, kernel, queue, workspace, kargs, offset=None, wait_for=None):
+        """
+        Return the global size, local size and arguments of launching *kernel*
+        with *kargs* over *workspace*. Vectorized kernels run on a
+        correspondingly smaller range and tiled kernels on a range padded to
+        their work-group size. Batches run on a three-dimensional range and
+        all other kernels on at most two dimensions. Kernels with range guards
+        run with the local size found by the autotuner on a range padded to a
+        multiple of it and take the range as additional arguments.
+        """
+        width = self.widths.get(kernel, 1)
+        local = self.group_sizes.get(kernel)
+
+        if width > 1:
+            workspace = (-(-int(np.prod(workspace)) // width), 1)
+        elif local:
+            # Work groups of tiled kernels cover consecutive elements
+            workspace = (int(np.prod(workspace)), 1)
+        else:
+            workspace = pina.misc.global_range(workspace, self.batch)
+
+        if self.env.guard_range:
+            origin = offset or (0,) * len(workspace)
+            ranges = [o + n for o, n in zip(origin, workspace)] + [1] * (2 - len(workspace))
+            kargs = list(kargs) + [np.int32(r) for r in ranges]
+
+            if local is None:
+                local = self.local_size(kernel, queue, workspace, kargs, offset, wait_for)
+
+        return pina.tuning.padded(workspace, local), local, kargs
+
+    def local_size(self, kernel, queue, workspace, kargs, offset, wait_for):
+        """
+        Return the local size for launching *kernel* over *workspace* from the
+        runtime's tuning database. Unknown launches are benchmarked with all
+        candidate local sizes if the runtime autotunes.
+        """
+        tuning = self.runtime.tuning
+        device = queue.device
+        device_id = self.runtime.device_ids[self.runtime.devices.index(device)]
+        key = pina.tuning.make_key(self.funcs, self.env, device_id, workspace)
+
+        if key in tuning or not self.runtime.autotune:
+            return tuning.get(key)
+
+        if wait_for:
+            cl.wait_for_events(wait_for)
+
+        max_group_size = kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE,
+                                                    device)
+        best, best_time = None, None
+
+        for local in pina.tuning.candidates(workspace, max_group_size, device.max_work_item_sizes):
+            global_size = pina.tuning.padded(workspace, local)
+
+            try:
+                # The first launch warms up caches and the driver
+                kernel(queue, global_size, local, *kargs, global_offset=offset).wait()
+                start = time.time()
+
+                for i in range(3):
+                    kernel(queue, global_size, local, *kargs, global_offset=offset)
+
+                queue.finish()
+                elapsed = time.time() - start
+            except cl.Error:
+                # Too many resources requested for this local size
+                continue
+
+            if best_time is None or elapsed < best_time:
+                best, best_time = local, elapsed
+
+        tuning.put(key, best)
+        return best
+
+    def host_args(self, args):
+        """Replace device arrays in *args* by their host data."""
+        return [a.get() if isinstance(a, DeviceArray) else a for a in args]
+
+    def dimension_args(self, shapes):
+        """Return the kernel arguments describing the array *shapes*."""
+        return [np.int32(v) for v in pina.gen.dimension_values(shapes, self.env)]
+
 
 class MultiCall(JustInTimeCall):
-    def __init__(self, func, runtime):
-        super(MultiCall, self).__init__(func, runtime)
+    """
+    Call split across all queues of the runtime. The global range is cut
+    along its last dimension into slabs sized in proportion to the throughput
+    measured on each device, so that work items keep the ids and sizes of an
+    unsplit launch. Arrays of the work space shape get a buffer of full size
+    on each device, of which only the elements of the slab and the halo read
+    by relative accesses like ``x[-1]`` are transferred, all other arrays are
+    copied to each device as a whole.
+    """
 
-    def run(self, kernel, shape, *args):
-        np_args = [a for a in args if isinstance(a, np.ndarray) and len(a.shape) > 1]
-        key = tuple(id(a) for a in np_args)
-        largest_shape = sorted([a.shape for a in np_args])[0]
+    def __init__(self, func, runtime, inline=()):
+        # Slabs do not match the element count compiled into vectorized kernels
+        env = copy.copy(runtime.env)
+        env.opt_level = min(env.opt_level, 2)
 
-        axis = np.argmin(largest_shape)
+        super(MultiCall, self).__init__(func, runtime, env, inline)
+        self.halo = pina.gen.halo(func)
+        self.weights = [device_weight(q.device) for q in runtime.queues]
+        self.launches = []
 
-        kargs = []
-        out_buffers = []
+    def slabs(self, shape):
+        """
+        Return the ids (start, stop) along the last dimension of the global
+        range launched by each queue for a work space of *shape* and the flat
+        elements (lo, hi) its work items read, including the halo.
+        """
+        global_size = pina.misc.global_range(shape)
+        stride, count = int(np.prod(global_size[:-1])), int(np.prod(shape))
 
-        n_devices = self.runtime.n_devices
+        return [(start, stop, max(0, start * stride - self.halo[0]),
+                 min(count, stop * stride + self.halo[1]))
+                for start, stop in partition(global_size[-1], self.weights)]
 
-        for arg in args:
-            if isinstance(arg, np.ndarray):
-                if id(arg) in self.buffers:
-                    sub_buffers = self.buffers[id(arg)]
+    def balance(self):
+        """Adapt the weights to the throughput of the last finished launches."""
+        complete = cl.command_execution_status.COMPLETE
+        launches, rates = self.launches, {}
 
-                    for i, s in enumerate(slices(arg, axis, n_devices)):
-                        hostbuf = np.copy(arg[s]) if axis > 0 else arg[s]
-                        cl.enqueue_copy(self.runtime.queues[i], sub_buffers[i], hostbuf)
-                else:
-                    sub_buffers = []
+        if any(e.command_execution_status != complete for _, _, e in launches):
+            return
 
-                    for s in slices(arg, axis, n_devices):
-                        hostbuf = np.copy(arg[s]) if axis > 0 else arg[s]
-                        buf = cl.Buffer(self.runtime.context, self.INIT_FLAGS, 0, hostbuf=hostbuf)
-                        sub_buffers.append(buf)
+        self.launches = []
 
-                    self.buffers[id(arg)] = sub_buffers
+        try:
+            for i, n, event in launches:
+                rates[i] = float(n) / max(event.profile.end - event.profile.start, 1)
+        except cl.Error:
+            # Queues without profiling keep their initial weights
+            return
 
-                kargs.append(sub_buffers)
-            else:
-                kargs.append(np.float32(arg))
+        if len(rates) < 2:
+            return
 
-        out_size = np.multiply(*largest_shape) * 4
+        total_weight = sum(self.weights[i] for i in rates)
+        total_rate = sum(rates.values())
 
-        out_shape = [dim for dim in largest_shape]
-        out_shape[axis] /= n_devices
+        for i, rate in rates.items():
+            self.weights[i] = 0.5 * self.weights[i] + 0.5 * total_weight * rate / total_rate
 
-        if key in self.out_buffers:
-            out_buffers = self.out_buffers[key]
-        else:
-            for i in range(n_devices):
-                buf_out = cl.Buffer(self.runtime.context, cl.mem_flags.WRITE_ONLY, size=int(out_size))
-                out_buffers.append(buf_out)
+    def run(self, kernel, shape, out, blocking, wait_for, *args):
+        if wait_for:
+            cl.wait_for_events(wait_for)
 
-            self.out_buffers[key] = out_buffers
+        self.balance()
 
-        start = time.time()
+        args = [np.ascontiguousarray(a) if isinstance(a, np.ndarray) else a
+                for a in self.host_args(args)]
+        workspace = tuple(shape if shape else [a for a in args if isinstance(a, np.ndarray)][0].shape)
+        output = self.output_array(workspace, self.host_args([out])[0], self.out_types[kernel])
+        global_size = pina.misc.global_range(workspace)
+        stride = int(np.prod(global_size[:-1]))
+        keep = [args, output]
+        downloads = []
 
-        for i in range(n_devices):
-            cargs = []
+        start_time = time.time()
 
-            for k in kargs:
-                cargs.append(k[i] if isinstance(k, list) else k)
+        # Enqueue everything without blocking, so that all devices work at once
+        for i, (start, stop, lo, hi) in enumerate(self.slabs(workspace)):
+            if start == stop:
+                continue
 
-            cargs.append(out_buffers[i])
-            kernel(self.runtime.queues[i], out_shape, None, *cargs)
+            queue = self.runtime.queues[i]
+            kargs, shapes, uploads, buffers = [], [], [], []
 
-        if self.output is None:
-            self.output = np.empty_like(arg)
-            self.temporary = np.empty(out_shape).astype(np.float32)
+            try:
+                for j, arg in enumerate(args):
+                    if not isinstance(arg, np.ndarray):
+                        kargs.append(scalar_arg(arg))
+                        shapes.append(None)
+                        continue
 
-        for i, s in enumerate(slices(arg, axis, n_devices)):
-            if axis > 0:
-                cl.enqueue_copy(self.runtime.queues[i], self.temporary, out_buffers[i])
-                self.output[s] = self.temporary
-            else:
-                cl.enqueue_copy(self.runtime.queues[i], self.output[s], out_buffers[i])
+                    buf = self.runtime.pool.acquire(arg.nbytes)
+                    buffers.append(buf)
+                    shapes.append(arg.shape)
+
+                    if arg.shape == workspace:
+                        event = cl.enqueue_copy(queue, buf, arg.ravel()[lo:hi], is_blocking=False,
+                                                device_offset=lo * arg.itemsize)
+                    else:
+                        event = cl.enqueue_copy(queue, buf, arg, is_blocking=False)
+
+                    kargs.append(buf)
+                    uploads.append(event)
+                    self.runtime.record(self.name, 'upload', queue, event)
+
+                out_buffer = self.runtime.pool.acquire(output.nbytes)
+                buffers.append(out_buffer)
+                kargs.append(out_buffer)
+                kargs.extend(self.dimension_args(shapes))
+
+                offset = (0,) * (len(global_size) - 1) + (start,)
+                event = self.enqueue_kernel(kernel, queue, global_size[:-1] + (stop - start,),
+                                            kargs, offset=offset, wait_for=uploads)
+                self.launches.append((i, (stop - start) * stride, event))
+
+                downloads.append(cl.enqueue_copy(queue, output.ravel()[start * stride:stop * stride],
+                                                 out_buffer, is_blocking=False, wait_for=[event],
+                                                 device_offset=start * stride * output.itemsize))
+                self.runtime.record(self.name, 'download', queue, downloads[-1])
+            except Exception:
+                for buf in buffers:
+                    self.runtime.pool.release(buf, uploads)
+
+                raise
+
+            for buf in buffers:
+                self.runtime.pool.release(buf, [downloads[-1]])
+
+        if isinstance(out, DeviceArray):
+            out.mark_host_dirty()
+
+        if not blocking:
+            return Future(cl.enqueue_marker(self.runtime.queues[0], wait_for=downloads),
+                          output, keep)
 
-        self.time = time.time() - start
-        return self.output
+        cl.wait_for_events(downloads)
+        self.time = time.time() - start_time
+        return Future(None, output)
 
 
 class SingleCall(JustInTimeCall):
-    def __init__(self, func, runtime):
-        super(SingleCall, self).__init__(func, runtime)
+    def __init__(self, func, runtime, inline=(), batch=False):
+        super(SingleCall, self).__init__(func, runtime, inline=inline, batch=batch)
 
-    def run(self, kernel, shape, *args):
+    def run(self, kernel, shape, out, blocking, wait_for, *args):
+        queue = self.runtime.queues[0]
         kargs = []
+        keep = []
+        buffers = []
 
-        for arg in args:
-            if isinstance(arg, np.ndarray):
-                if id(arg) in self.buffers:
-                    buf = self.buffers[id(arg)]
-                    cl.enqueue_copy(self.runtime.queues[0], buf, arg)
+        # TODO: use user-supplied information if necessary
+        first_np_array = [a for a in args if pina.misc.is_array(a)][0]
+        workspace = tuple(shape if shape else first_np_array.shape)
+        out_shape = workspace
+
+        if self.reduction:
+            if out is not None:
+                raise TypeError("{}() returns a scalar and takes no output".format(self.name))
+
+            # One partial result per work group stays on the device
+            group_size = self.group_sizes[kernel][0]
+            out_shape = (-(-int(np.prod(workspace)) // group_size),)
+            out = DeviceArray(self.runtime, out_shape, self.out_types[kernel])
+
+        if out is None and any(isinstance(a, DeviceArray) for a in args):
+            # Keep the result on the device for subsequent calls
+            out = DeviceArray(self.runtime, workspace, self.out_types[kernel])
+
+        resident = isinstance(out, DeviceArray)
+        output = self.output_array(out_shape, out, self.out_types[kernel])
+
+        try:
+            for arg in args:
+                if isinstance(arg, DeviceArray):
+                    kargs.append(arg.buffer(queue))
+
+                    if arg.event:
+                        wait_for.append(arg.event)
+                elif isinstance(arg, np.ndarray):
+                    buf = self.runtime.pool.acquire(arg.nbytes)
+                    buffers.append(buf)
+                    event = cl.enqueue_copy(queue, buf, arg, is_blocking=False)
+                    wait_for.append(event)
+                    keep.append(arg)
+
+                    self.runtime.record(self.name, 'upload', queue, event)
+                    kargs.append(buf)
                 else:
-                    flags = cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR
-                    buf = cl.Buffer(self.runtime.context, flags, arg.nbytes, hostbuf=arg)
-                    self.buffers[id(arg)] = buf
+                    kargs.append(scalar_arg(arg))
 
-                kargs.append(buf)
+            if resident:
+                out_buffer = output.buffer(queue)
+                wait_for.extend(output.dependencies())
             else:
-                kargs.append(np.float32(arg))
+                out_buffer = self.runtime.pool.acquire(output.nbytes)
+                buffers.append(out_buffer)
 
-        # TODO: use user-supplied information if necessary
-        first_np_array = [a for a in args if isinstance(a, np.ndarray)][0]
-        workspace = shape if shape else first_np_array.shape
+            kargs.append(out_buffer)
+            kargs.extend(self.dimension_args([a.shape if pina.misc.is_array(a) else None
+                                              for a in args]))
+
+            start = time.time()
+            event = self.enqueue_kernel(kernel, queue, workspace, kargs, wait_for=wait_for or None)
+        except Exception:
+            # Commands enqueued so far still complete before the buffers are reused
+            for buf in buffers:
+                self.runtime.pool.release(buf, wait_for)
+
+            raise
+
+        for arg in args:
+            if isinstance(arg, DeviceArray):
+                arg.mark_read(event)
 
-        if self.output is None:
-            self.output = np.empty(workspace).astype(np.float32)
-            out_buffer = cl.Buffer(self.runtime.context, cl.mem_flags.WRITE_ONLY, self.output.nbytes)
-            self.buffers[id(self.output)] = out_buffer
+        if resident:
+            output.mark_device_dirty(event)
         else:
-            out_buffer = self.buffers[id(self.output)]
+            event = cl.enqueue_copy(queue, output, out_buffer, is_blocking=blocking,
+                                    wait_for=[event])
+            self.runtime.record(self.name, 'download', queue, event)
 
-        kargs.append(out_buffer)
+        for buf in buffers:
+            self.runtime.pool.release(buf, [event])
 
-        start = time.time()
-        kernel(self.runtime.queues[0], workspace, None, *kargs)
-        cl.enqueue_copy(self.runtime.queues[0], self.output, out_buffer)
-        self.time = time.time() - start
-        return self.output
+        if blocking:
+            self.time = time.time() - start
+
+        if self.reduction:
+            return self.reduce_partials(output, int(np.prod(workspace)), keep)
+
+        return Future(event, output, keep)
+
+    def reduce_partials(self, partials, count, keep):
+        """
+        Return a :class:`Future` of the reduction of the *partials* of the work
+        groups, which are reduced further on the device until a single value
+        has to be downloaded. Means are divided by the element *count*.
+        """
+        scalar = partials.dtype.type
+
+        if self.reduction == 'mean':
+            scale = lambda value: scalar(value / count)
+        else:
+            scale = scalar
+
+        if len(partials) == 1:
+            return Future(partials.event, partials, keep, lambda p: scale(p.get()[0]))
+
+        future = self.runtime.reducer(self.reduction).enqueue(partials)
+        return Future(future.event, future, keep, lambda f: scale(f.result()))
+
+
+class FusedCall(SingleCall):
+    """
+    Call of element-wise *funcs* fused into a single kernel. The result of
+    each function is passed as the last argument of the next one, so the
+    call takes the arguments of the first function followed by all but the
+    last argument of each subsequent function.
+    """
+
+    def __init__(self, funcs, runtime):
+        super(FusedCall, self).__init__(funcs[0], runtime)
+        self.funcs = funcs
+        self.name = '_'.join(f.__name__ for f in funcs)
+
+    def stage_args(self, args):
+        """Split *args* into the arguments of each stage."""
+        args = list(args)
+        n_args = len(pina.misc.arg_names(self.funcs[0]))
+        workspace = [a for a in args[:n_args] if pina.misc.is_array(a)][0].shape
+        stages = [args[:n_args]]
+
+        for func in self.funcs[1:]:
+            n_own = len(pina.misc.arg_names(func)) - 1
+            piped = DeviceArray(self.runtime, workspace)
+            stages.append(args[n_args:n_args + n_own] + [piped])
+            n_args += n_own
+
+        if n_args != len(args):
+            msg = "{}() takes exactly {} arguments ({} given)"
+            raise TypeError(msg.format(self.name, n_args, len(args)))
+
+        return stages
+
+    def output_dtype(self, args):
+        stages = self.stage_args(args)
+        specs = pina.misc.arg_specs(self.funcs[-1], stages[-1])
+        return np.dtype(pina.qualifiers.numpy_type(pina.gen.output_type(self.funcs[-1], specs)))
+
+    def translate(self, args):
+        stages = self.stage_args(args)
+        specs = [pina.misc.arg_specs(f, a) for f, a in zip(self.funcs, stages)]
+        return pina.gen.source(pina.gen.fuse(self.funcs, specs, self.env))
+
+    def cache_key(self, args):
+        stages = self.stage_args(args)
+        env, devices = self.env, self.runtime.device_ids
+        keys = [pina.cache.make_key(f, pina.misc.arg_specs(f, a), env, devices)
+                for f, a in zip(self.funcs, stages)]
+        return pina.cache.combine_keys(keys)
 
 
 class Runtime(object):
     def __init__(self, opt_level=2, use_multi_gpu=False,
                  preferred_platform=None,
-                 preferred_device=None):
+                 preferred_device=None,
+                 cache=True,
+                 dynamic_shapes=False,
+                 out_of_order=False,
+                 pinned=False,
+                 autotune=False,
+                 tuning=None,
+                 tile_size=None,
+                 dataflow=True,
+                 fast_math=False,
+                 native_math=None,
+                 profiling=False,
+                 pool_bytes=None):
         platforms = cl.get_platforms()
 
         if preferred_platform:
@@ -205,17 +1081,132 @@ class Runtime(object):
             self.devices = devices
 
         self.context = cl.Context(devices=self.devices)
-        self.queues = [cl.CommandQueue(self.context, device=d) for d in self.devices]
+
+        # Free buffers may take up to half of the smallest device by default
+        if pool_bytes is None:
+            pool_bytes = min(d.global_mem_size for d in self.devices) // 2
+
+        self.pool = BufferPool(self.context, pool_bytes)
+        self.queues = [self.create_queue(d, out_of_order, use_multi_gpu or profiling)
+                       for d in self.devices]
+        self.profile = pina.profiling.Profile() if profiling else None
 
         self.env = pina.cl.ExecutionEnvironment()
         self.env.MAX_CONSTANT_SIZE = min(d.max_constant_buffer_size for d in self.devices)
         self.env.MAX_CONSTANT_ARGS = min(d.max_constant_args for d in self.devices)
+        self.env.MAX_LOCAL_SIZE = min(d.local_mem_size for d in self.devices)
         self.env.opt_level = opt_level
+        self.env.dataflow = dataflow
+        self.env.fast_math = fast_math
+        self.env.native_math = native_math
+        self.env.dynamic_shapes = dynamic_shapes
+
+        preferred = min(d.preferred_vector_width_float for d in self.devices)
+        self.env.vector_width = 8 if preferred >= 8 else 4
+        self.env.tile_size = tile_size
+
+        # Tree reductions halve the work group in each step
+        group_size = min(256, *(d.max_work_group_size for d in self.devices))
+        self.env.reduction_size = 2 ** (group_size.bit_length() - 1)
+        self.reducers = {}
+
         self.use_multi_gpu = use_multi_gpu
         self.n_devices = len(self.devices)
+        self.pinned = pinned
+
+        if tuning is True or (tuning is None and autotune):
+            self.tuning = pina.tuning.TuningDatabase()
+        else:
+            self.tuning = tuning or None
+
+        # Tuned local sizes need not divide the range, so kernels guard it
+        self.autotune = autotune
+        self.env.guard_range = self.tuning is not None
+
+        if cache is True:
+            self.cache = pina.cache.Cache()
+        else:
+            self.cache = cache or None
+
+        self.device_ids = [pina.cl.device_id(d) for d in self.devices]
+
+    def create_queue(self, device, out_of_order=False, profiling=False):
+        """
+        Create a command queue for *device*, executing commands out of order
+        if requested and supported. Dependencies are then only expressed by
+        events. With *profiling* set, events carry execution times.
+        """
+        properties = cl.command_queue_properties.PROFILING_ENABLE if profiling else 0
+        ooo = cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE
+
+        if out_of_order and device.queue_properties & ooo:
+            properties |= ooo
+
+        return cl.CommandQueue(self.context, device=device, properties=properties)
+
+    def record(self, name, stage, queue, event):
+        """
+        Record the command of *event* executing *stage* of the call *name* on
+        *queue* if the runtime profiles.
+        """
+        if self.profile is not None:
+            self.profile.record(name, stage, self.queues.index(queue), event, queue.device.name)
+
+    def to_device(self, array):
+        """Wrap the host *array* in a :class:`DeviceArray` uploaded on first use."""
+        array = np.ascontiguousarray(array)
+        return DeviceArray(self, array.shape, array.dtype, host=array)
+
+    def empty_pinned(self, shape, dtype=np.float32):
+        """
+        Allocate a host array in page-locked memory, which devices can
+        transfer to and from without staging copies.
+        """
+        flags = cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        buf = cl.Buffer(self.context, flags, nbytes)
+        flags = cl.map_flags.READ | cl.map_flags.WRITE
+        array, _ = cl.enqueue_map_buffer(self.queues[0], buf, flags, 0, shape, dtype)
+        return array
+
+    def empty(self, shape, dtype=np.float32):
+        """Create an uninitialized :class:`DeviceArray`."""
+        return DeviceArray(self, shape, dtype)
+
+    def fuse(self, *funcs):
+        """
+        Compose element-wise *funcs* into a single kernel launch, keeping
+        intermediate results in registers. See :class:`FusedCall` for how
+        arguments are passed.
+        """
+        return FusedCall(funcs, self)
+
+    def reducer(self, reduction):
+        """Return the call reducing partial results of *reduction*."""
+        func = REDUCERS['sum' if reduction == 'mean' else reduction]
+
+        if func not in self.reducers:
+            self.reducers[func] = SingleCall(func, self)
+
+        return self.reducers[func]
+
+    def pipeline(self, stages, depth=2):
+        """
+        Return a :class:`Pipeline` streaming frames through *stages* with up
+        to *depth* frames in flight.
+        """
+        return Pipeline(self, stages, depth)
 
-    def jit(self, func):
-        if self.use_multi_gpu:
-            return MultiCall(func, self)
+    def jit(self, func, inline=(), batch=False):
+        """
+        Return a call of *func*. The values of the small arrays named in
+        *inline* are compiled into the kernel, which is rebuilt whenever
+        they change. With *batch* set, arrays shaped like the first one are
+        stacks of frames along their first axis, which are computed in a
+        single launch as if *func* was called on each frame.
+        """
+        # Partial results of reductions and batches are not split across devices
+        if self.use_multi_gpu and not pina.gen.reduction(func) and not batch:
+            return MultiCall(func, self, inline)
 
-        return SingleCall(func, self)
+        return SingleCall(func, self, inline, batch)
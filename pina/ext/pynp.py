@@ -0,0 +1,610 @@
+import ast
+import time
+import operator
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+import pina.cl
+import pina.gen
+import pina.cast
+import pina.misc
+import pina.parser
+import pina.qualifiers
+
+
+CONSTANTS = {'pi': np.pi, 'e': np.e, 'ln2': np.log(2), 'ln10': np.log(10),
+             'True': True, 'False': False}
+
+FUNCS = {
+    'acos': np.arccos, 'asin': np.arcsin, 'atan': np.arctan, 'atan2': np.arctan2,
+    'acosh': np.arccosh, 'asinh': np.arcsinh, 'atanh': np.arctanh,
+    'cospi': lambda x: np.cos(np.pi * x),
+    'sinpi': lambda x: np.sin(np.pi * x),
+    'tanpi': lambda x: np.tan(np.pi * x),
+    'acospi': lambda x: np.arccos(x) / np.pi,
+    'asinpi': lambda x: np.arcsin(x) / np.pi,
+    'atanpi': lambda x: np.arctan(x) / np.pi,
+    'rsqrt': lambda x: 1.0 / np.sqrt(x),
+    'exp10': lambda x: np.power(10.0, x),
+    'mad': lambda a, b, c: a * b + c,
+    'pow': np.power, 'fabs': np.abs, 'abs': np.abs,
+    'fmin': np.fmin, 'fmax': np.fmax, 'min': np.minimum, 'max': np.maximum,
+    'clamp': np.clip,
+}
+
+BINARY_OPS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+              ast.Pow: np.power}
+
+UNARY_OPS = {ast.USub: operator.neg, ast.UAdd: operator.pos,
+             ast.Not: np.logical_not, ast.Invert: operator.invert}
+
+COMPARE_OPS = {ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Lt: operator.lt,
+               ast.LtE: operator.le, ast.Eq: operator.eq, ast.NotEq: operator.ne}
+
+REDUCE_FUNCS = {'sum': np.sum, 'mean': np.sum, 'min': np.min, 'max': np.max}
+
+
+def is_integral(value):
+    return np.issubdtype(np.asarray(value).dtype, np.integer)
+
+
+def promote(left, right):
+    """
+    Promote the operands of arithmetic like C does: integers narrower than
+    int to int and single precision arrays combined with double precision
+    values to double. Literals are left to NumPy, so that ``x * 0.5`` stays
+    in single precision.
+    """
+    def is_double(value):
+        return isinstance(value, (np.ndarray, np.generic)) and value.dtype == np.float64
+
+    def widen(value, other):
+        if not np.ndim(value):
+            return value
+
+        if value.dtype.kind in 'biu' and value.dtype.itemsize < 4:
+            return value.astype(np.int32)
+
+        if value.dtype == np.float32 and is_double(other):
+            return value.astype(np.float64)
+
+        return value
+
+    return widen(left, right), widen(right, left)
+
+
+def divide(a, b):
+    """Divide like C, truncating quotients of integers."""
+    if is_integral(a) and is_integral(b):
+        quotient = np.fix(np.true_divide(a, b)).astype(np.result_type(a, b))
+        return quotient if np.ndim(quotient) else int(quotient)
+
+    return np.true_divide(a, b)
+
+
+def convert(value, dtype):
+    """Convert the scalar or array *value* to *dtype*."""
+    if np.ndim(value):
+        return np.asarray(value).astype(dtype, copy=False)
+
+    return np.dtype(dtype).type(value)
+
+
+def call_name(node):
+    if isinstance(node, ast.Attribute):
+        return node.attr
+
+    return node.id
+
+
+def subscript_index(node):
+    # Python 2 wraps subscripts in ast.Index
+    return node.slice.value if isinstance(node.slice, ast.Index) else node.slice
+
+
+def reduction_arg(node):
+    """Return the argument reduced by a return statement like ``return sum(x)``."""
+    value = node.value
+
+    if isinstance(value, ast.Call) and len(value.args) == 1 and \
+       call_name(value.func) in pina.gen.REDUCTIONS:
+        return value.args[0]
+
+    return None
+
+
+class Kernel(object):
+    """
+    Kernel function *func* prepared for arguments described by *specs*,
+    which determine the types of local variables and of the result.
+    """
+
+    def __init__(self, func, specs, batch=False):
+        types = pina.gen.infer_types(pina.cast.Tree(pina.parser.parse(func)), specs)
+
+        def dtype(type_name):
+            return np.dtype(pina.qualifiers.numpy_type(type_name))
+
+        self.tree = pina.parser.python_ast(func)
+        self.names = pina.misc.arg_names(func)
+        self.batched = set(name for name, spec in specs.items() if spec.batched)
+        self.reduction = pina.gen.reduction(func)
+        self.out_type = dtype(pina.gen.output_type(func, specs))
+        self.local_types = dict((name, dtype(t)) for name, t in types.items() if name != 'out')
+        self.batch = batch
+
+
+class Chunk(object):
+    """
+    Evaluation of a kernel on the elements [*start*, *stop*) of the workspace
+    of *size* elements, launched over the global range *sizes*. Relative
+    accesses are clamped to [*lo*, *hi*). Statements only affected by some
+    elements, like the branches of data-dependent conditions, are evaluated
+    on the lanes of these elements.
+    """
+
+    def __init__(self, kernel, args, sizes, start, stop, lo, hi):
+        self.kernel = kernel
+        self.args = dict(zip(kernel.names, args))
+        self.flat = dict((name, a.reshape(-1)) for name, a in self.args.items()
+                         if isinstance(a, np.ndarray))
+        self.sizes = sizes
+        self.start, self.stop, self.lo, self.hi = start, stop, lo, hi
+        self.size = stop - start
+        self.locals = {}
+        self.owned = set()
+        self.returned = False
+        self.done = np.zeros(self.size, dtype=np.bool_)
+
+        out_type = np.float64 if kernel.reduction else kernel.out_type
+        self.result = np.zeros(self.size, dtype=out_type)
+
+    def run(self):
+        with np.errstate(all='ignore'):
+            self.execute(self.kernel.tree.body, None)
+
+        return self.result
+
+    def select(self, value, lanes):
+        if lanes is None or not np.ndim(value):
+            return value
+
+        return value[lanes]
+
+    def alive(self, lanes):
+        """Return those of *lanes* that did not return yet."""
+        if not self.returned:
+            return lanes
+
+        if lanes is None:
+            return np.flatnonzero(~self.done)
+
+        return lanes[~self.done[lanes]]
+
+    def indices(self, lanes):
+        """Return the work item indices of *lanes*."""
+        idx = np.arange(self.start, self.stop)
+        return self.select(idx, lanes)
+
+    def execute(self, stmts, lanes):
+        for stmt in stmts:
+            lanes = self.alive(lanes)
+
+            if lanes is not None and not len(lanes):
+                return
+
+            if isinstance(stmt, ast.Assign):
+                target = stmt.targets[0]
+
+                if isinstance(target, ast.Tuple):
+                    values = [self.value(v, lanes) for v in stmt.value.elts]
+
+                    for t, v in zip(target.elts, values):
+                        self.assign(t, v, lanes)
+                else:
+                    self.assign(target, self.value(stmt.value, lanes), lanes)
+            elif isinstance(stmt, ast.AugAssign):
+                value = self.binary(stmt.op, self.value(stmt.target, lanes),
+                                    self.value(stmt.value, lanes))
+                self.assign(stmt.target, value, lanes)
+            elif isinstance(stmt, ast.If):
+                self.branch(stmt, lanes)
+            elif isinstance(stmt, ast.For):
+                self.loop(stmt, lanes)
+            elif isinstance(stmt, ast.Return):
+                self.ret(stmt, lanes)
+
+    def assign(self, target, value, lanes):
+        if not isinstance(target, ast.Name):
+            raise TypeError("Cannot assign to {0}".format(ast.dump(target)))
+
+        name = target.id
+        dtype = self.kernel.local_types.get(name)
+
+        if dtype is not None:
+            value = convert(value, dtype)
+
+        if lanes is None:
+            self.locals[name] = value
+            self.owned.discard(name)
+            return
+
+        current = self.locals.get(name, 0)
+
+        if name not in self.owned:
+            array = np.empty(self.size, dtype=dtype or np.result_type(current, value))
+            array[...] = current
+            self.locals[name] = current = array
+            self.owned.add(name)
+
+        current[lanes] = value
+
+    def branch(self, stmt, lanes):
+        test = self.value(stmt.test, lanes)
+
+        if not np.ndim(test):
+            self.execute(stmt.body if test else stmt.orelse, lanes)
+            return
+
+        test = np.asarray(test, dtype=np.bool_)
+        lanes = np.arange(self.size) if lanes is None else lanes
+
+        if test.any():
+            self.execute(stmt.body, lanes[test])
+
+        if stmt.orelse and not test.all():
+            self.execute(stmt.orelse, lanes[~test])
+
+    def loop(self, stmt, lanes):
+        var = stmt.target.id
+
+        if isinstance(stmt.iter, ast.Name):
+            values = self.args[stmt.iter.id].reshape(-1)
+        elif isinstance(stmt.iter, ast.Call) and call_name(stmt.iter.func) == 'range':
+            values = range(*[int(self.value(a, lanes)) for a in stmt.iter.args])
+        else:
+            raise TypeError("Cannot iterate over {0}".format(ast.dump(stmt.iter)))
+
+        for value in values:
+            # Loop variables are the same for all lanes
+            self.locals[var] = value
+            self.owned.discard(var)
+            self.execute(stmt.body, self.alive(lanes))
+
+    def ret(self, stmt, lanes):
+        expr = reduction_arg(stmt) if self.kernel.reduction else stmt.value
+        value = self.value(expr, lanes)
+
+        if lanes is None:
+            self.result[...] = value
+            self.done[...] = True
+        else:
+            self.result[lanes] = value
+            self.done[lanes] = True
+
+        self.returned = True
+
+    def binary(self, op, left, right):
+        left, right = promote(left, right)
+
+        if isinstance(op, ast.Div):
+            return divide(left, right)
+
+        return BINARY_OPS[type(op)](left, right)
+
+    def value(self, node, lanes):
+        if isinstance(node, ast.Num):
+            return node.n
+
+        if isinstance(node, ast.Name):
+            return self.name(node.id, lanes)
+
+        if isinstance(node, ast.Attribute):
+            return CONSTANTS[node.attr]
+
+        if isinstance(node, ast.BinOp):
+            return self.binary(node.op, self.value(node.left, lanes), self.value(node.right, lanes))
+
+        if isinstance(node, ast.UnaryOp):
+            return UNARY_OPS[type(node.op)](self.value(node.operand, lanes))
+
+        if isinstance(node, ast.BoolOp):
+            op = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return reduce(op, [self.value(v, lanes) for v in node.values])
+
+        if isinstance(node, ast.Compare):
+            op = COMPARE_OPS[type(node.ops[0])]
+            return op(self.value(node.left, lanes), self.value(node.comparators[0], lanes))
+
+        if isinstance(node, ast.Subscript):
+            return self.subscript(node, lanes)
+
+        if isinstance(node, ast.Call):
+            return self.call(node, lanes)
+
+        raise TypeError("Unsupported expression {0}".format(ast.dump(node)))
+
+    def name(self, name, lanes):
+        if name in self.locals:
+            return self.select(self.locals[name], lanes)
+
+        if name in self.flat:
+            return self.select(self.flat[name][self.start:self.stop], lanes)
+
+        if name in self.args:
+            return self.args[name]
+
+        if name in CONSTANTS:
+            return CONSTANTS[name]
+
+        raise NameError("name '{0}' is not defined".format(name))
+
+    def subscript(self, node, lanes):
+        name = node.value.id
+        index = subscript_index(node)
+
+        if isinstance(index, ast.Tuple):
+            array = self.args[name]
+            elts = [self.value(e, lanes) for e in index.elts]
+
+            if name in self.kernel.batched and len(elts) < array.ndim:
+                elts.insert(0, self.lo // (self.hi - self.lo))
+
+            return array[tuple(np.asarray(e, dtype=np.intp) for e in elts)]
+
+        offset = self.value(index, lanes)
+
+        if not isinstance(index, (ast.Num, ast.UnaryOp)):
+            # Absolute accesses like x[i] in loops
+            return self.flat[name][np.asarray(offset, dtype=np.intp)]
+
+        flat = self.flat[name]
+        lo, hi = (self.lo, self.hi) if name in self.kernel.batched else (0, len(flat))
+
+        if not np.ndim(offset) and lo <= self.start + offset and self.stop + offset <= hi:
+            # Shifted views need no copy
+            return self.select(flat[self.start + offset:self.stop + offset], lanes)
+
+        return flat[np.clip(self.indices(lanes) + offset, lo, hi - 1)]
+
+    def call(self, node, lanes):
+        name = call_name(node.func)
+
+        if name == 'len':
+            return len(self.args[node.args[0].id])
+
+        args = [self.value(a, lanes) for a in node.args]
+
+        if name == 'int':
+            return convert(np.trunc(args[0]), np.int32) if np.ndim(args[0]) else int(args[0])
+
+        if name == 'float':
+            return convert(args[0], np.float32)
+
+        if name in ('get_global_id', 'get_global_size'):
+            dim = int(args[0])
+            size = self.sizes[dim] if dim < len(self.sizes) else 1
+
+            if name == 'get_global_size':
+                return size
+
+            return self.indices(lanes) // int(np.prod(self.sizes[:dim])) % size
+
+        func = FUNCS.get(name) or getattr(np, name, None)
+
+        if func is None:
+            raise NameError("Unknown function {0}".format(name))
+
+        return func(*args)
+
+
+class Future(object):
+    """Result of a call, which is computed right away on the host."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def done(self):
+        return True
+
+    def wait(self):
+        pass
+
+    def result(self):
+        return self.value
+
+
+class JustInTimeCall(object):
+    """
+    Call of *func* evaluated with NumPy. Like with the OpenCL runtime, arrays
+    shaped like the first one are stacks of frames if *batch* is set. The
+    values of inlined arrays are read anyway, so *inline* is ignored.
+    """
+
+    def __init__(self, func, runtime, inline=(), batch=False):
+        self.pyfunc = func
+        self.funcs = [func]
+        self.runtime = runtime
+        self.env = runtime.env
+        self.batch = batch
+        self.name = func.__name__
+        self.reduction = pina.gen.reduction(func)
+        self.kernels = {}
+        self.time = 0.0
+
+    def __call__(self, *args, **kwargs):
+        return self.launch(args, kwargs).result()
+
+    def enqueue(self, *args, **kwargs):
+        """Compute the result and return a :class:`Future` of it."""
+        return self.launch(args, kwargs)
+
+    def kernel(self, args):
+        key = pina.misc.signature(args)
+        kernel = self.kernels.get(key)
+
+        if kernel is None:
+            specs = pina.misc.arg_specs(self.pyfunc, args, batch=self.batch)
+            kernel = Kernel(self.pyfunc, specs, self.batch)
+            self.kernels[key] = kernel
+
+        return kernel
+
+    def output_dtype(self, args):
+        """Return the dtype of the result for calling with *args*."""
+        return self.kernel(args).out_type
+
+    def launch(self, args, kwargs):
+        kernel = self.kernel(args)
+
+        # Half precision values are computed in single precision
+        args = [np.ascontiguousarray(a, np.float32 if a.dtype == np.float16 else None)
+                if isinstance(a, np.ndarray) else a for a in args]
+        shape = kwargs.get('shape', None)
+        workspace = tuple(shape if shape else [a for a in args if isinstance(a, np.ndarray)][0].shape)
+        start = time.time()
+
+        if kernel.reduction:
+            if kwargs.get('out') is not None:
+                raise TypeError("{}() returns a scalar and takes no output".format(self.name))
+
+            result = self.reduce(kernel, args, workspace)
+        else:
+            result = self.output_array(workspace, kwargs.get('out'), kernel.out_type)
+            values = self.runtime.map(kernel, args, workspace)
+            flat = result.reshape(-1)
+
+            for (begin, end), chunk in values:
+                flat[begin:end] = chunk
+
+        self.time = time.time() - start
+        return Future(result)
+
+    def reduce(self, kernel, args, workspace):
+        func = REDUCE_FUNCS[kernel.reduction]
+        partials = [func(chunk) for _, chunk in self.runtime.map(kernel, args, workspace)]
+        value = func(partials)
+
+        if kernel.reduction == 'mean':
+            value /= int(np.prod(workspace))
+
+        return kernel.out_type.type(value)
+
+    def output_array(self, shape, out=None, dtype=np.float32):
+        """
+        Return *out* after checking that it can hold a result of *shape* and
+        *dtype* or allocate a new array for it.
+        """
+        dtype = np.dtype(dtype)
+
+        if out is None:
+            return np.empty(shape, dtype=dtype)
+
+        if out.shape != tuple(shape) or out.dtype != dtype:
+            msg = "Output must be a {} array of shape {}"
+            raise ValueError(msg.format(dtype.name, tuple(shape)))
+
+        if not out.flags.c_contiguous:
+            raise ValueError("Output must be C-contiguous")
+
+        return out
+
+
+class FusedCall(JustInTimeCall):
+    """
+    Call of element-wise *funcs*, each one receiving the result of the
+    previous one as its last argument like :meth:`pina.ext.pycl.Runtime.fuse`.
+    """
+
+    def __init__(self, funcs, runtime):
+        super(FusedCall, self).__init__(funcs[0], runtime)
+        self.funcs = funcs
+        self.calls = [runtime.jit(f) for f in funcs]
+        self.name = '_'.join(f.__name__ for f in funcs)
+
+    def launch(self, args, kwargs):
+        args = list(args)
+        n_args = len(pina.misc.arg_names(self.funcs[0]))
+        start = time.time()
+        result = self.calls[0](*args[:n_args])
+
+        for i, call in enumerate(self.calls[1:]):
+            n_own = len(pina.misc.arg_names(call.pyfunc)) - 1
+            stage = args[n_args:n_args + n_own] + [result]
+            last = i == len(self.calls) - 2
+            result = call(*stage, out=kwargs.get('out') if last else None)
+            n_args += n_own
+
+        if n_args != len(args):
+            msg = "{}() takes exactly {} arguments ({} given)"
+            raise TypeError(msg.format(self.name, n_args, len(args)))
+
+        self.time = time.time() - start
+        return Future(result)
+
+
+class Runtime(object):
+    """
+    Runtime evaluating kernel functions with vectorized NumPy operations on
+    the host, for machines without an OpenCL platform. Workspaces are split
+    into chunks of *chunk_size* elements computed by a pool of *n_threads*
+    threads, as NumPy releases the interpreter lock in most operations.
+    Options of :class:`pina.ext.pycl.Runtime` are accepted and ignored.
+    """
+
+    def __init__(self, n_threads=None, chunk_size=1 << 16, opt_level=2, **kwargs):
+        self.env = pina.cl.ExecutionEnvironment()
+        self.env.opt_level = opt_level
+        self.n_threads = n_threads or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.pool = None
+
+    def chunks(self, workspace, batch):
+        """
+        Return the chunks (start, stop, lo, hi) of *workspace*, which clamp
+        relative accesses to [lo, hi), the current frame of a batch.
+        """
+        size = int(np.prod(workspace))
+        frame = int(np.prod(workspace[1:])) if batch else size
+        step = max(1, self.chunk_size)
+
+        return [(start, min(start + step, lo + frame), lo, lo + frame)
+                for lo in range(0, size, frame)
+                for start in range(lo, lo + frame, step)]
+
+    def map(self, kernel, args, workspace):
+        """
+        Evaluate *kernel* with *args* on all chunks of *workspace* and return
+        a list of ((start, stop), values) pairs.
+        """
+        sizes = pina.misc.global_range(workspace, kernel.batch)
+        chunks = self.chunks(workspace, kernel.batch)
+
+        def evaluate(chunk):
+            start, stop, lo, hi = chunk
+            return (start, stop), Chunk(kernel, args, sizes, start, stop, lo, hi).run()
+
+        if len(chunks) == 1 or self.n_threads == 1:
+            return [evaluate(c) for c in chunks]
+
+        if self.pool is None:
+            self.pool = multiprocessing.pool.ThreadPool(self.n_threads)
+
+        return self.pool.map(evaluate, chunks)
+
+    def to_device(self, array):
+        return array
+
+    def empty(self, shape, dtype=np.float32):
+        return np.empty(shape, dtype=dtype)
+
+    def empty_pinned(self, shape, dtype=np.float32):
+        return np.empty(shape, dtype=dtype)
+
+    def fuse(self, *funcs):
+        """Return a call of *funcs* chained like :meth:`pina.ext.pycl.Runtime.fuse`."""
+        return FusedCall(funcs, self)
+
+    def jit(self, func, inline=(), batch=False):
+        """Return a call of *func*, see :meth:`pina.ext.pycl.Runtime.jit`."""
+        return JustInTimeCall(func, self, inline, batch)
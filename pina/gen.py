@@ -1,120 +1,416 @@
+import copy
+import time
 import operator
 import parser
 import qualifiers
 import pina.opt
 import pina.cast
-from pycparser import c_generator, c_ast
+from pina.cast import c_generator, c_ast
 
 
-def fix_signature(fdef, specs):
+def is_dynamic(spec, env):
+    """Check if the dimensions of *spec* are passed as kernel arguments."""
+    if env is None or isinstance(spec.qualifier, qualifiers.NoQualifier):
+        return False
+
+    return env.is_dynamic(spec.shape)
+
+
+def shape_name(name, dim):
+    return '{0}__shape{1}'.format(name, dim)
+
+
+def stride_name(name, dim):
+    return '{0}__stride{1}'.format(name, dim)
+
+
+def strides(shape):
+    """Return the row-major strides of *shape* in elements."""
+    return [reduce(operator.mul, shape[i + 1:], 1) for i in range(len(shape))]
+
+
+def dimension_values(shapes, env):
+    """
+    Return the values of the dimension arguments that follow the output
+    argument of a kernel called with arrays of *shapes*. Scalar arguments are
+    represented by None.
+    """
+    values = []
+
+    if env is None:
+        return values
+
+    for shape in shapes:
+        if shape is not None and env.is_dynamic(shape):
+            values.extend(shape)
+            values.extend(strides(shape))
+
+    return values
+
+
+def halo(func):
+    """
+    Return the number of elements before and after the current one that
+    *func* reads with constant relative accesses such as ``x[-1]``.
+    """
+    tree = pina.cast.Tree(parser.parse(func))
+    params = set(p.name for p in tree.root.decl.type.args.params)
+    before, after = 0, 0
+
+    def is_relative(node):
+        return isinstance(node.name, c_ast.ID) and node.name.name in params
+
+    for ref in tree.find(c_ast.ArrayRef, is_relative):
+        subscript = ref.subscript
+
+        if isinstance(subscript, c_ast.UnaryOp) and subscript.op in ('+', '-'):
+            if not isinstance(subscript.expr, c_ast.Constant):
+                continue
+
+            offset = int(subscript.op + subscript.expr.value)
+        elif isinstance(subscript, c_ast.Constant):
+            offset = int(subscript.value)
+        else:
+            continue
+
+        before, after = max(before, -offset), max(after, offset)
+
+    return before, after
+
+
+REDUCTIONS = {'sum': 'sum', 'mean': 'mean', 'min': 'min', 'max': 'max',
+              'amin': 'min', 'amax': 'max'}
+
+
+def reduction_call(node):
+    """Return the reduction of a return statement like ``return sum(x)``."""
+    expr = node.expr
+
+    if not isinstance(expr, c_ast.FuncCall) or not isinstance(expr.name, c_ast.ID):
+        return None
+
+    if expr.name.name not in REDUCTIONS or not expr.args or len(expr.args.exprs) != 1:
+        return None
+
+    return REDUCTIONS[expr.name.name]
+
+
+def find_reduction(tree):
+    """
+    Return the reduction ('sum', 'mean', 'min' or 'max') computed by a kernel
+    whose return statements all reduce an expression with the same function
+    or None. Kernels mixing reductions with other results are rejected.
+    """
+    ops = set(reduction_call(r) for r in tree.find_type(c_ast.Return))
+
+    if len(ops) > 1 and ops != set([None]):
+        raise TypeError("All return statements must compute the same reduction")
+
+    return ops.pop() if ops else None
+
+
+def reduction(func):
+    """Return the reduction computed by *func* or None, see :func:`find_reduction`."""
+    return find_reduction(pina.cast.Tree(parser.parse(func)))
+
+
+def element_type(spec):
+    """
+    Return the type kernels compute with for the elements of the array or
+    the scalar described by *spec*. Half precision values are loaded as
+    float.
+    """
+    name = spec.qualifier.type_name
+    return 'float' if name == 'half' else name
+
+
+INT_FUNCS = set(['get_global_id', 'get_global_size', 'get_local_id', 'get_local_size',
+                 'get_group_id', 'get_num_groups', 'len'])
+
+
+def infer_types(tree, specs):
+    """
+    Propagate the element types of the arguments described by *specs*
+    through the kernel *tree* before it is transformed. Return a dictionary
+    mapping local variables to their type and 'out' to the type of the
+    result. Locals are computed in at least single precision. Arithmetic
+    results get the widest type of their operands, so that narrow integer
+    outputs are not widened to int like in C.
+    """
+    known = dict((name, element_type(spec)) for name, spec in specs.items())
+    local_types = {}
+
+    for loop in tree.find_type(c_ast.For):
+        if hasattr(loop, '_extra'):
+            it, mem = loop._extra
+            known[it] = known.get(mem)
+        elif isinstance(loop.init, c_ast.Decl):
+            known[loop.init.name] = 'int'
+
+    def typeof(node):
+        if isinstance(node, c_ast.Constant):
+            integral = not any(c in node.value.lower() for c in '.e')
+            return 'int' if node.type == 'int' and integral else 'float'
+
+        if isinstance(node, c_ast.ID):
+            return local_types.get(node.name, known.get(node.name))
+
+        if isinstance(node, c_ast.ArrayRef):
+            return typeof(node.name)
+
+        if isinstance(node, c_ast.Cast):
+            return node.to_type.type.names[-1]
+
+        if isinstance(node, c_ast.UnaryOp):
+            return 'int' if node.op == '!' else typeof(node.expr)
+
+        if isinstance(node, c_ast.BinaryOp):
+            if node.op in ('+', '-', '*', '/', '%'):
+                return qualifiers.promote(typeof(node.left), typeof(node.right))
+
+            return 'int'
+
+        if isinstance(node, c_ast.FuncCall):
+            if node.name.name in INT_FUNCS:
+                return 'int'
+
+            args = node.args.exprs if node.args else []
+            return qualifiers.promote('float', *[typeof(a) for a in args])
+
+        return None
+
+    assignments = [a for a in tree.find_type(c_ast.Assignment)
+                   if isinstance(a.lvalue, c_ast.ID) and a.lvalue.name not in specs]
+
+    # Locals assigned from other locals need several rounds
+    for i in range(len(assignments) + 1):
+        changed = False
+
+        for a in assignments:
+            name = a.lvalue.name
+            t = qualifiers.promote(local_types.get(name), typeof(a.rvalue), 'float')
+
+            if t != local_types.get(name):
+                local_types[name] = t
+                changed = True
+
+        if not changed:
+            break
+
+    local_types['out'] = qualifiers.promote(*[typeof(r.expr) for r in tree.find_type(c_ast.Return)])
+    local_types['out'] = local_types['out'] or 'float'
+    return local_types
+
+
+def output_type(func, specs):
+    """Return the type of the result of *func* called with *specs*."""
+    return infer_types(pina.cast.Tree(parser.parse(func)), specs)['out']
+
+
+def fix_signature(tree, specs):
     """Add necessary qualifiers to the function signature."""
+    fdef = tree.root
     params = [p for p in fdef.decl.type.args.params if p.name in specs]
 
     for p in params:
         spec = specs[p.name]
 
         if isinstance(spec.qualifier, qualifiers.NoQualifier):
-            d = pina.cast.TypeDecl(p.name, 'float', None)
+            d = pina.cast.TypeDecl(p.name, element_type(spec), None)
         else:
-            d = pina.cast.PtrDecl(p.name, ' float', None)
+            d = pina.cast.PtrDecl(p.name, ' ' + spec.qualifier.type_name, None)
             d.funcspec = [spec.qualifier.cl_keyword]
 
-        pina.cast.replace(fdef.decl, p, d)
+        tree.replace(p, d)
 
 
-def fix_for_loops(fdef, specs):
+def fix_for_loops(tree, specs, env=None):
     """Instantiate a real for loop now that we know sizes of data."""
-    loops = [l for l in pina.cast.find_type(fdef.body, c_ast.For) if hasattr(l, '_extra')]
+    loops = [l for l in tree.find_type(c_ast.For) if hasattr(l, '_extra')]
 
     for loop in loops:
         it, mem = loop._extra
 
         if mem in specs:
-            it_var = c_ast.ID(it + '__it')
-            n_it = specs[mem].size / 4
-            loop.init = pina.cast.TypeDecl(it_var.name, 'int', c_ast.Constant('int', '0'))
-            loop.cond = c_ast.BinaryOp('<', it_var, c_ast.Constant('int', str(n_it)))
-            loop.next = c_ast.ExprList([c_ast.BinaryOp('+=', it_var, c_ast.Constant('int', '1'))])
-            loop_var = pina.cast.TypeDecl(it, 'float', pina.cast.ArrayRef(mem, it_var.name))
-            loop.stmt.block_items.insert(0, loop_var)
+            it_name = it + '__it'
+
+            if is_dynamic(specs[mem], env):
+                dims = [c_ast.ID(shape_name(mem, i)) for i in range(len(specs[mem].shape))]
+                n_it = dims[0] if len(dims) == 1 else pina.cast.chain('*', dims)
+            else:
+                n_it = c_ast.Constant('int', str(reduce(operator.mul, specs[mem].shape, 1)))
+
+            tree.set(loop, 'init', pina.cast.TypeDecl(it_name, 'int', c_ast.Constant('int', '0')))
+            tree.set(loop, 'cond', c_ast.BinaryOp('<', c_ast.ID(it_name), n_it))
+            tree.set(loop, 'next', c_ast.ExprList([c_ast.BinaryOp('+=', c_ast.ID(it_name),
+                                                                  c_ast.Constant('int', '1'))]))
+            loop_var = pina.cast.TypeDecl(it, element_type(specs[mem]),
+                                          pina.cast.ArrayRef(mem, it_name))
+            tree.insert(loop.stmt, 'block_items', 0, loop_var)
         else:
             raise TypeError("Cannot infer iterator type")
 
 
-def replace_global_accesses(fdef, specs):
-    """Replace all reads and writes on global variabls with array accesses."""
-    names = [n for n in pina.cast.find_global_names(fdef)
-             if n in specs and not isinstance(specs[n].qualifier, qualifiers.NoQualifier)]
+def is_batch(specs):
+    return any(spec.batched for spec in specs.values())
+
+
+def frame_bounds():
+    """
+    Return expressions of the first and last index of the frame computed by
+    the current work item of a batch, which spans dimension 2 of the range.
+    """
+    def query(name, dim):
+        return c_ast.FuncCall(c_ast.ID(name), c_ast.ExprList([c_ast.Constant('int', str(dim))]))
+
+    def size():
+        return c_ast.BinaryOp('*', query('get_global_size', 0), query('get_global_size', 1))
 
-    for name in names:
-        # Replace simple identifiers
-        for node in pina.cast.find_name(fdef.body, name):
-            read_access = pina.cast.ArrayRef(name, 'idx')
-            pina.cast.replace(fdef.body, node, read_access)
+    first = c_ast.BinaryOp('*', query('get_global_id', 2), size())
+    end = c_ast.BinaryOp('+', c_ast.BinaryOp('*', query('get_global_id', 2), size()), size())
+    last = c_ast.BinaryOp('-', end, c_ast.Constant('int', '1'))
+    return pina.cast.CastDecl('int', first), pina.cast.CastDecl('int', last)
 
-        # Replace already indexed accesses
-        def is_valid(node):
-            return isinstance(node, c_ast.ArrayRef) and node.name.name == name
 
-        def is_constant_subscript(node):
-            return is_valid(node) and isinstance(node.subscript, c_ast.Constant)
+def replace_global_accesses(tree, specs, env=None):
+    """
+    Replace all reads and writes on global variabls with array accesses.
+    Relative accesses of frames in a batch are clamped to the current frame
+    and indices with one dimension less than the stack address the frame.
+    """
+    names = set(n for n in pina.cast.find_global_names(tree.root)
+                if n in specs and not isinstance(specs[n].qualifier, qualifiers.NoQualifier))
 
-        def is_unary_op_subscript(node):
-            return is_valid(node) and isinstance(node.subscript, c_ast.UnaryOp)
+    def is_name(node):
+        parent = tree.parent(node)
 
-        def is_tuple_subscript(node):
-            return is_valid(node) and isinstance(node.subscript, c_ast.ExprList)
+        if isinstance(parent, c_ast.ArrayRef) and parent.name is node:
+            return False
 
-        for node in pina.cast.find(fdef.body, is_constant_subscript):
-            node.subscript = c_ast.BinaryOp('+', c_ast.ID('idx'), node.subscript)
+        if isinstance(parent, c_ast.FuncCall) and parent.name is node:
+            return False
 
-        for node in pina.cast.find(fdef.body, is_unary_op_subscript):
-            subscript = node.subscript
-            node.subscript = c_ast.BinaryOp(subscript.op, c_ast.ID('idx'), subscript.expr)
+        return node.name in names
 
-        for node in pina.cast.find(fdef.body, is_tuple_subscript):
-            elts = node.subscript.exprs
-            spec = specs[name]
-            offsets = [reduce(operator.mul, spec.shape[i:]) for i in range(1, len(spec.shape))]
-            offsets.append(1)
+    # Replace simple identifiers
+    for node in tree.find(c_ast.ID, is_name):
+        tree.replace(node, pina.cast.ArrayRef(node.name, 'idx'))
 
-            mults = [c_ast.BinaryOp('*', c_ast.Constant('int', offset), element)
+    # Replace already indexed accesses
+    def is_valid(node):
+        return isinstance(node.name, c_ast.ID) and node.name.name in names
+
+    for node in tree.find(c_ast.ArrayRef, is_valid):
+        name = node.name.name
+        subscript = node.subscript
+
+        spec = specs[name]
+
+        if isinstance(subscript, (c_ast.Constant, c_ast.UnaryOp)):
+            if isinstance(subscript, c_ast.Constant):
+                index = c_ast.BinaryOp('+', c_ast.ID('idx'), subscript)
+            else:
+                index = c_ast.BinaryOp(subscript.op, c_ast.ID('idx'), subscript.expr)
+
+            if spec.batched:
+                first, last = frame_bounds()
+                args = c_ast.ExprList([index, first, last])
+                index = c_ast.FuncCall(c_ast.ID('clamp'), args)
+
+            tree.replace(subscript, index)
+        elif isinstance(subscript, c_ast.ExprList):
+            elts = subscript.exprs
+
+            if is_dynamic(spec, env):
+                offsets = [c_ast.ID(stride_name(name, i)) for i in range(len(spec.shape))]
+            else:
+                offsets = [c_ast.Constant('int', offset) for offset in strides(spec.shape)]
+
+            frame = spec.batched and len(elts) < len(spec.shape)
+
+            if frame:
+                offsets = offsets[1:]
+
+            mults = [c_ast.BinaryOp('*', offset, element)
                      for element, offset in zip(elts, offsets)]
 
-            node.subscript = pina.cast.chain('+', mults)
+            if frame:
+                mults.insert(0, frame_bounds()[0])
 
+            tree.replace(subscript, pina.cast.chain('+', mults))
 
-def fix_local_accesses(fdef):
-    """Add a declaration for all referenced local variables"""
+
+def fix_local_accesses(tree, types=None, dims=2):
+    """
+    Add a declaration for all referenced local variables, with their type
+    in *types* or float.
+    """
+    fdef = tree.root
     localvars = []
     globalvars = list(pina.cast.find_global_names(fdef))
-    assignments = pina.cast.find_type(fdef.body, c_ast.Assignment)
+    assignments = tree.find_type(c_ast.Assignment)
 
     for each in assignments:
+        if not isinstance(each.lvalue, c_ast.ID):
+            continue
+
         name = each.lvalue.name
+
         if not name in localvars and not name in globalvars:
-            localvars.append(each.lvalue.name)
+            localvars.append(name)
 
     for var in localvars:
-        fdef.body.block_items.insert(0, pina.cast.TypeDecl(var, 'float', None))
+        typename = (types or {}).get(var, 'float')
+        tree.insert(fdef.body, 'block_items', 0, pina.cast.TypeDecl(var, typename, None))
 
     # create work item indices
-    fdef.body.block_items.insert(0, pina.cast.TypeDecl('idx', 'int', pina.cast.WorkItemIndex()))
+    index = pina.cast.TypeDecl('idx', 'int', pina.cast.WorkItemIndex(dims))
+    tree.insert(fdef.body, 'block_items', 0, index)
 
 
-def replace_return_statements(fdef):
-    """Turn all return statements into writes to a global 'out' buffer."""
-    lvalue = pina.cast.ArrayRef('out', 'idx')
+def load_half_arrays(tree, specs):
+    """Read arrays of half precision values with vload_half()."""
+    halves = set(name for name, spec in specs.items()
+                 if not isinstance(spec.qualifier, qualifiers.NoQualifier) and
+                 spec.qualifier.type_name == 'half')
 
-    for stmt in pina.cast.find_type(fdef.body, c_ast.Return):
-        assignment = c_ast.Assignment('=', pina.cast.ArrayRef('out', 'idx'), stmt.expr)
-        pina.cast.replace(fdef.body, stmt, assignment)
+    def is_half(node):
+        return isinstance(node.name, c_ast.ID) and node.name.name in halves
+
+    for assignment in tree.find_type(c_ast.Assignment):
+        if isinstance(assignment.lvalue, c_ast.ArrayRef) and is_half(assignment.lvalue):
+            raise TypeError("Cannot write half precision array {0}".format(assignment.lvalue.name.name))
+
+    for ref in tree.find(c_ast.ArrayRef, is_half):
+        args = c_ast.ExprList([ref.subscript, c_ast.ID(ref.name.name)])
+        tree.replace(ref, c_ast.FuncCall(c_ast.ID('vload_half'), args))
+
+
+def replace_return_statements(tree, reduction=None, out_type='float'):
+    """
+    Turn all return statements into writes to a global 'out' buffer of
+    *out_type* elements. The arguments of reductions are assigned to the
+    work item's value instead, which reductions compute in *out_type*.
+    """
+    for stmt in tree.find_type(c_ast.Return):
+        if reduction:
+            assignment = c_ast.Assignment('=', c_ast.ID('idx__value'), stmt.expr.args.exprs[0])
+        else:
+            assignment = c_ast.Assignment('=', pina.cast.ArrayRef('out', 'idx'), stmt.expr)
+
+        tree.replace(stmt, assignment)
 
     # add out argument
-    fdef.decl.type.args.params.append(pina.cast.PtrDecl('out', '__global float', None))
+    out = pina.cast.PtrDecl('out', '__global ' + out_type, None)
+    tree.append(tree.root.decl.type.args, 'params', out)
 
 
-def replace_constants(fdef):
+def replace_constants(tree, single=False):
+    """
+    Replace named constants by their values, suffixed as single precision
+    literals if *single* is set.
+    """
+    suffix = 'f' if single else ''
     consts = {
         'e':    '2.7182818284590452353602874713526624977572470937000',
         'ln2':  '0.6931471805599453094172321214581765680755001343602',
@@ -123,64 +419,344 @@ def replace_constants(fdef):
         'pi_2': '1.5707963267948966192313216916397514420985846996876',
     }
 
-    def is_constant(node):
-        return isinstance(node, c_ast.Constant) and node.value in consts
-
-    for node in pina.cast.find(fdef.body, is_constant):
-        pina.cast.replace(fdef.body, node, c_ast.ID(consts[node.value]))
+    for node in tree.find(c_ast.Constant, lambda node: node.value in consts):
+        tree.replace(node, c_ast.ID(consts[node.value] + suffix))
 
 
-def replace_func_names(fdef):
+def replace_func_names(tree):
     funcs = ('cos', 'sin', 'tan', 'cosh', 'sinh', 'tanh')
     repl = {'arc'+name: 'a'+name for name in funcs}
 
-    def is_valid(node):
-        return isinstance(node, c_ast.FuncCall) and node.name.name in repl
-
-    for node in pina.cast.find(fdef.body, is_valid):
+    for node in tree.find(c_ast.FuncCall, lambda node: node.name.name in repl):
         node.name.name = repl[node.name.name]
 
 
-def replace_len_builtin(fdef, specs):
+def replace_len_builtin(tree, specs, env=None):
     def is_valid_len_call(node):
-        return isinstance(node, c_ast.FuncCall) and \
-               node.name.name == 'len' and \
+        return node.name.name == 'len' and \
                len(node.args.exprs) == 1 and \
                isinstance(node.args.exprs[0], c_ast.ID)
 
-    for node in pina.cast.find(fdef.body, is_valid_len_call):
+    for node in tree.find(c_ast.FuncCall, is_valid_len_call):
         arg = node.args.exprs[0]
 
         if arg.name in specs:
             spec = specs[arg.name]
-            pina.cast.replace(fdef.body, node, c_ast.ID(str(sum(spec.shape))))
 
+            if is_dynamic(spec, env):
+                dims = [c_ast.ID(shape_name(arg.name, i)) for i in range(len(spec.shape))]
+                length = dims[0] if len(dims) == 1 else pina.cast.chain('+', dims)
+            else:
+                length = c_ast.ID(str(sum(spec.shape)))
+
+            tree.replace(node, length)
 
-def ast(func, specs, env=None):
-    fdef = parser.parse(func)
 
-    fix_signature(fdef, specs)
-    fix_local_accesses(fdef)
-    fix_for_loops(fdef, specs)
-    replace_len_builtin(fdef, specs)
-    replace_func_names(fdef)
-    replace_global_accesses(fdef, specs)
-    replace_return_statements(fdef)
+def add_dimension_params(tree, specs, env):
+    """
+    Append shape and stride arguments for all arrays whose dimensions are not
+    compiled into the kernel.
+    """
+    args = tree.root.decl.type.args
+
+    for p in list(args.params):
+        if p.name in specs and is_dynamic(specs[p.name], env):
+            rank = len(specs[p.name].shape)
+
+            for i in range(rank):
+                tree.append(args, 'params', pina.cast.TypeDecl(shape_name(p.name, i), 'int', None))
+
+            for i in range(rank):
+                tree.append(args, 'params', pina.cast.TypeDecl(stride_name(p.name, i), 'int', None))
+
+
+def range_name(dim):
+    return 'idx__range{0}'.format(dim)
+
+
+def add_range_guard(tree, dims=2):
+    """
+    Let the kernel run on a global range of *dims* dimensions padded to a
+    multiple of the local size. The real range is passed as trailing
+    arguments and work items outside of it return right away.
+    """
+    fdef = tree.root
+    index = fdef.body.block_items[0]
+    ranges = [c_ast.ID(range_name(dim)) for dim in range(dims)]
+
+    tree.replace(index.init, pina.cast.WorkItemIndex(dims, [r.name for r in ranges]))
+
+    def is_size_query(node):
+        args = node.args.exprs if node.args else []
+        return node.name.name == 'get_global_size' and \
+               len(args) == 1 and isinstance(args[0], c_ast.Constant)
+
+    for node in tree.find(c_ast.FuncCall, is_size_query):
+        tree.replace(node, c_ast.ID(range_name(int(node.args.exprs[0].value))))
+
+    outside = [c_ast.BinaryOp('>=', c_ast.ID('get_global_id({0})'.format(dim)), c_ast.ID(r.name))
+               for dim, r in enumerate(ranges)]
+
+    guard = c_ast.If(pina.cast.chain('||', outside), c_ast.Return(None), None)
+    tree.insert(fdef.body, 'block_items', 1, guard)
+
+    for r in ranges:
+        tree.append(fdef.decl.type.args, 'params', pina.cast.TypeDecl(r.name, 'int', None))
+
+
+def add_reduction(tree, specs, env, reduction, out_type='float'):
+    """
+    Reduce the values of all work items in a work group of
+    *env.reduction_size* items in local memory and write one partial result
+    of *out_type* per work group to 'out'. Means are computed as sums.
+    """
+    fdef = tree.root
+    size = env.reduction_size if env else 256
+    count = pina.opt.element_count(tree, specs, env)
+
+    def const(value):
+        return c_ast.Constant('int', str(value))
+
+    def scratch(subscript):
+        return c_ast.ArrayRef(c_ast.ID('idx__scratch'), subscript)
+
+    def combine(a, b):
+        if reduction in ('sum', 'mean'):
+            return c_ast.BinaryOp('+', a, b)
+
+        name = 'fmin' if reduction == 'min' else 'fmax'
+        return c_ast.FuncCall(c_ast.ID(name), c_ast.ExprList([a, b]))
+
+    identities = {'min': c_ast.ID('INFINITY'),
+                  'max': c_ast.UnaryOp('-', c_ast.ID('INFINITY'))}
+
+    zero = c_ast.Constant(out_type, '0.0f' if out_type == 'float' else '0.0')
+    identity = identities.get(reduction, zero)
+    barrier = c_ast.FuncCall(c_ast.ID('barrier'), c_ast.ExprList([c_ast.ID('CLK_LOCAL_MEM_FENCE')]))
+    local_index = c_ast.FuncCall(c_ast.ID('get_local_id'), c_ast.ExprList([const(0)]))
+    group_index = c_ast.FuncCall(c_ast.ID('get_group_id'), c_ast.ExprList([const(0)]))
+    typedecl = c_ast.TypeDecl('idx__scratch', [], c_ast.IdentifierType([out_type]))
+
+    # All work items must reach the barriers, so the range guard is replaced
+    # by a check around the computation of the value
+    head = fdef.body.block_items[:1]
+    body = fdef.body.block_items[2 if env and env.guard_range else 1:]
+    local, stride = c_ast.ID('idx__local'), c_ast.ID('idx__stride')
+
+    step = c_ast.If(c_ast.BinaryOp('<', local, stride),
+                    c_ast.Assignment('=', scratch(local),
+                                     combine(scratch(local),
+                                             scratch(c_ast.BinaryOp('+', local, stride)))),
+                    None)
+
+    items = [pina.cast.TypeDecl('idx__value', out_type, identity),
+             c_ast.If(c_ast.BinaryOp('<', c_ast.ID('idx'), count), c_ast.Compound(body), None),
+             c_ast.Decl('idx__scratch', [], [], ['__local'],
+                        c_ast.ArrayDecl(typedecl, const(size)), None, None),
+             pina.cast.TypeDecl('idx__local', 'int', local_index),
+             c_ast.Assignment('=', scratch(local), c_ast.ID('idx__value')),
+             barrier,
+             c_ast.For(pina.cast.TypeDecl('idx__stride', 'int', const(size // 2)),
+                       c_ast.BinaryOp('>', stride, const(0)),
+                       c_ast.ExprList([c_ast.BinaryOp('/=', stride, const(2))]),
+                       c_ast.Compound([step, copy.deepcopy(barrier)])),
+             c_ast.If(c_ast.BinaryOp('==', local, const(0)),
+                      c_ast.Assignment('=', c_ast.ArrayRef(c_ast.ID('out'), group_index),
+                                       scratch(const(0))),
+                      None)]
+
+    tree.set(fdef, 'body', c_ast.Compound(head + items))
+    hint = '__attribute__((reqd_work_group_size({0}, 1, 1)))'.format(size)
+    fdef.decl.type.type.quals.append(hint)
+
+
+def timed(timings):
+    """
+    Return a function that calls a pass with its arguments and, if *timings*
+    is a dictionary, adds the time spent to it under the name of the pass.
+    """
+    def call(func, *args):
+        if timings is None:
+            return func(*args)
+
+        start = time.time()
+        result = func(*args)
+        timings[func.__name__] = timings.get(func.__name__, 0.0) + time.time() - start
+        return result
+
+    return call
+
+
+def ast(func, specs, env=None, timings=None):
+    """
+    Translate *func* for arguments described by *specs* into the pycparser AST
+    of an OpenCL kernel. The time spent in each pass is added to the
+    dictionary *timings* if given.
+    """
+    step = timed(timings)
+    tree = pina.cast.Tree(step(parser.parse, func))
+    types = step(infer_types, tree, specs)
+    dims = 3 if is_batch(specs) else 2
+
+    step(fix_signature, tree, specs)
+    step(fix_local_accesses, tree, types, dims)
+    step(fix_for_loops, tree, specs, env)
+    step(replace_len_builtin, tree, specs, env)
+    step(replace_func_names, tree)
+    step(replace_global_accesses, tree, specs, env)
+    step(load_half_arrays, tree, specs)
+
+    reduction = step(find_reduction, tree)
+
+    if reduction and dims > 2:
+        raise TypeError("Reductions cannot be computed per frame")
+
+    step(replace_return_statements, tree, reduction, types['out'])
+    step(add_dimension_params, tree, specs, env)
+
+    if env and env.guard_range:
+        step(add_range_guard, tree, dims)
+
+    if reduction:
+        step(add_reduction, tree, specs, env, reduction, types['out'])
 
     if env:
         if env.opt_level > 0:
-            pina.opt.level1(fdef, specs, env)
+            step(pina.opt.level1, tree, specs, env)
 
         if env.opt_level > 1:
-            pina.opt.level2(fdef, specs, env)
+            step(pina.opt.level2, tree, specs, env)
+
+        if env.opt_level > 2:
+            step(pina.opt.level3, tree, specs, env)
+
+        if env.fast_math:
+            step(pina.opt.fast_math, tree, env)
 
     # we replace constants after optimization passes, because the symbols might be
     # removed by the optimization
-    replace_constants(fdef)
+    step(replace_constants, tree, env and env.fast_math)
+    return tree.root
+
+
+def rename_decl(decl, name):
+    """Rename the variable or parameter declared by *decl*."""
+    typedecl = decl.type.type if isinstance(decl.type, c_ast.PtrDecl) else decl.type
+    typedecl.declname = name
+    decl.name = name
+
+
+def fuse(funcs, specs, env=None):
+    """
+    Fuse the element-wise kernels *funcs* into a single kernel. The result of
+    each stage is passed to the last parameter of the following stage and
+    kept in a private variable instead of global memory. *specs* is a list
+    containing the specs of each stage.
+    """
+    # Stages are vectorized only once they are fused
+    stage_env = copy.copy(env)
+
+    if env and env.opt_level > 2:
+        stage_env.opt_level = 2
+
+    for func in funcs:
+        if reduction(func):
+            raise TypeError("Cannot fuse reduction {0}()".format(func.__name__))
+
+    fdefs = [ast(func, s, stage_env) for func, s in zip(funcs, specs)]
+    fused_specs = {}
+
+    # The work item index and the range guard are shared by all stages
+    head = 2 if env and env.guard_range else 1
+    params, dims, body = [], [], fdefs[0].body.block_items[:head]
+    ranges = [p for p in fdefs[0].decl.type.args.params if p.name.startswith('idx__')]
+    result = None
+
+    for i, fdef in enumerate(fdefs):
+        tree = pina.cast.Tree(fdef)
+        prefix = 's{0}__'.format(i)
+        fused_specs.update((prefix + name, spec) for name, spec in specs[i].items())
+        args = fdef.decl.type.args.params
+        n_args = [p.name for p in args].index('out')
+        own = args[:n_args]
+        own_dims = [p for p in args[n_args + 1:] if not p.name.startswith('idx__')]
+
+        if result:
+            piped = own[-1].name
+            own = own[:-1]
+            own_dims = [p for p in own_dims if not p.name.startswith(piped + '__')]
+
+            def is_piped(node):
+                return isinstance(node.name, c_ast.ID) and node.name.name == piped
+
+            for ref in tree.find(c_ast.ArrayRef, is_piped):
+                if not isinstance(ref.subscript, c_ast.ID) or ref.subscript.name != 'idx':
+                    msg = "Cannot fuse {0}() with relative accesses to {1}"
+                    raise TypeError(msg.format(funcs[i].__name__, piped))
+
+                tree.replace(ref, c_ast.ID(result))
+
+            if tree.find(c_ast.ID, lambda n: n.name.split('__')[0] == piped):
+                msg = "Cannot fuse {0}() using {1} other than element-wise"
+                raise TypeError(msg.format(funcs[i].__name__, piped))
+
+        locals_ = [d for d in tree.find_type(c_ast.Decl)
+                   if d.name != 'idx' and not d.name.startswith('idx__')]
+        renames = set(d.name for d in locals_ if d.name != 'out')
+
+        for ident in tree.find(c_ast.ID, lambda n: n.name in renames):
+            ident.name = prefix + ident.name
+
+        for decl in locals_:
+            if decl.name in renames:
+                rename_decl(decl, prefix + decl.name)
+
+        if i < len(fdefs) - 1:
+            result = prefix + 'out'
+            body.append(pina.cast.TypeDecl(result, pina.cast.type_name(args[n_args]), None))
+
+            for assignment in tree.find_type(c_ast.Assignment):
+                lvalue = assignment.lvalue
+
+                if isinstance(lvalue, c_ast.ArrayRef) and lvalue.name.name == 'out':
+                    tree.replace(lvalue, c_ast.ID(result))
+        else:
+            out = args[n_args]
+
+        params.extend(own)
+        dims.extend(own_dims)
+        body.extend(fdef.body.block_items[head:])
+
+    # Each stage placed its read-only arguments in constant memory on its own
+    constants = [p for p in params if p.funcspec == ['__constant']]
+
+    for p in constants[env.MAX_CONSTANT_ARGS if env else 0:]:
+        p.funcspec = ['__global']
+
+    name = '_'.join(func.__name__ for func in funcs)
+    fdef = fdefs[0]
+    fdef.decl.type.args.params = params + [out] + dims + ranges
+    fdef.decl.type.type.declname = name
+    fdef.decl.name = name
+    fdef.body.block_items = body
+
+    if env and env.opt_level > 2:
+        pina.opt.level3(pina.cast.Tree(fdef), fused_specs, env)
+
     return fdef
 
 
+def source(fdef):
+    """Generate the OpenCL source string of the kernel *fdef*"""
+    generator = c_generator.CGenerator()
+    code = generator.visit(fdef)
+
+    if any('double' in t.names[-1] for t in pina.cast.find_type(fdef, c_ast.IdentifierType)):
+        code = '#pragma OPENCL EXTENSION cl_khr_fp64 : enable\n\n' + code
+
+    return code
+
+
 def kernel(func, specs, env=None):
     """Build OpenCL kernel source string from *func*"""
-    generator = c_generator.CGenerator()
-    return generator.visit(ast(func, specs, env))
+    return source(ast(func, specs, env))
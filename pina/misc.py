@@ -1,9 +1,12 @@
 import ast
+import copy
 import inspect
 import types
+import collections
 from .gen import kernel, ast
 from .qualifiers import *
 from .cl import BufferSpec, ExecutionEnvironment
+from .cache import env_digest
 
 
 
@@ -40,16 +43,24 @@ def static(*args):
     return _source
 
 
-def arg_spec(arg, name):
+def is_array(arg):
+    """
+    Check if *arg* is a NumPy array or an array-like object living on a
+    device, such as :class:`pina.ext.pycl.DeviceArray`.
+    """
     import numpy as np
 
+    return arg.__class__ == np.ndarray or getattr(arg, 'is_device_array', False)
+
+
+def arg_spec(arg, name):
     def check_supported(type_name):
         if not is_supported(type_name):
             raise RuntimeError("Unsupported data type {0}".format(type_name))
 
     spec = BufferSpec(name)
 
-    if arg.__class__ == np.ndarray:
+    if is_array(arg):
         check_supported(repr(arg.dtype.type))
         spec.size = arg.nbytes
         spec.shape = arg.shape
@@ -62,10 +73,111 @@ def arg_spec(arg, name):
     return spec
 
 
+def arg_names(func):
+    return inspect.getargspec(func).args
+
+
+def arg_specs(func, args, values=None, batch=False):
+    """
+    Return a dictionary of buffer specs for calling *func* with *args*. The
+    specs of arrays in *values*, a dictionary as returned by
+    :func:`inline_values`, carry their values. With *batch* set, arrays of
+    the same shape as the first one are marked as stacks of frames along
+    their first axis.
+    """
+    names = arg_names(func)
+    num_expected = len(names)
+
+    if num_expected != len(args):
+        msg = "{}() takes exactly {} arguments ({} given)"
+        raise TypeError(msg.format(func.__name__, num_expected, len(args)))
+
+    specs = {name: arg_spec(a, name) for a, name in zip(args, names)}
+
+    for name, v in (values or {}).items():
+        specs[name].values = v
+
+    if batch:
+        shape = [a for a in args if is_array(a)][0].shape
+
+        if len(shape) < 2:
+            raise ValueError("Batches need arrays of at least two dimensions")
+
+        for a, name in zip(args, names):
+            specs[name].batched = is_array(a) and a.shape == shape
+
+    return specs
+
+
+def inline_values(func, args, names, env=None):
+    """
+    Return a dictionary mapping those of *names* that are host arrays with at
+    most *env.inline_limit* elements to a tuple of their values. Kernels are
+    specialized for these values.
+    """
+    import numpy as np
+
+    limit = env.inline_limit if env else 0
+    values = {}
+
+    for name, arg in zip(arg_names(func), args):
+        if name in names and arg.__class__ == np.ndarray and arg.size <= limit:
+            values[name] = tuple(float(v) for v in arg.ravel())
+
+    return values
+
+
+def global_range(shape, batch=False):
+    """
+    Return the global range computing a workspace of *shape*. Kernels use at
+    most two dimensions, except for batches, whose dimension 2 enumerates the
+    frames and dimension 0 the elements of their rows.
+    """
+    def product(dims):
+        return reduce(lambda a, b: a * b, dims, 1)
+
+    shape = tuple(int(n) for n in shape)
+
+    if batch:
+        frame = shape[1:]
+        return (frame[-1], product(frame[:-1]), shape[0])
+
+    if len(shape) > 2:
+        return (product(shape[:-1]), shape[-1])
+
+    return shape
+
+
+MEMO_SIZE = 256
+
+_memo = collections.OrderedDict()
+
+
+def signature(args, env=None):
+    """
+    Return a hashable signature of *args* consisting of array dtypes and
+    shapes and scalar types, including the C type they are passed as. Arrays
+    whose dimensions are passed at run-time are only distinguished by their
+    rank.
+    """
+    def normalize(a):
+        if not is_array(a):
+            return (a.__class__, NoQualifier(a.__class__).type_name)
+
+        if env and env.is_dynamic(a.shape):
+            return (a.dtype, len(a.shape))
+
+        return (a.dtype, a.shape)
+
+    return tuple(normalize(a) for a in args)
+
+
 class jit(object):
     def __init__(self, *args, **kwargs):
         self.env = kwargs.get('env', None)
         self.return_ast = kwargs.get('ast', False)
+        self.inline = kwargs.get('inline', ())
+        self.batch = kwargs.get('batch', False)
         self.func = args[0] if args else None
 
     def __call__(self, *cargs):
@@ -73,19 +185,27 @@ class jit(object):
             self.func = cargs[0]
 
         def _wrapper(*args):
-            arg_names = inspect.getargspec(self.func).args
-            num_expected = len(arg_names)
+            values = inline_values(self.func, args, self.inline, self.env)
+            key = (self.func, self.return_ast, signature(args, self.env), env_digest(self.env),
+                   tuple(sorted(values.items())), self.batch)
+            result = _memo.pop(key, None)
+
+            if result is None:
+                specs = arg_specs(self.func, args, values, self.batch)
 
-            if num_expected != len(args):
-                msg = "{}() takes exactly {} arguments ({} given)"
-                raise TypeError(msg.format(self.func.__name__, num_expected, len(args)))
+                if not self.return_ast:
+                    result = kernel(self.func, specs, env=self.env)
+                else:
+                    result = ast(self.func, specs, env=self.env)
 
-            specs = {name: arg_spec(a, name) for a, name in zip(args, arg_names)}
+            # Least recently used translations are dropped first
+            _memo[key] = result
 
-            if not self.return_ast:
-                return kernel(self.func, specs, env=self.env)
+            while len(_memo) > MEMO_SIZE:
+                _memo.popitem(last=False)
 
-            return ast(self.func, specs, env=self.env)
+            # Callers are free to modify the trees they get
+            return copy.deepcopy(result) if self.return_ast else result
 
         if not isinstance(cargs[0], types.FunctionType):
             return _wrapper(*cargs)
@@ -1,23 +1,38 @@
+import copy
+import operator
 import pina.cast
-from pycparser import c_ast
+import pina.gen
+import pina.qualifiers
+from pina.cast import c_ast, c_generator
 
 
-class OpVisitor(c_ast.NodeVisitor):
+class OpVisitor(object):
     def __init__(self, op):
         self.op = None
         self.left = None
         self.right = None
         self._op = op
 
-    def visit_BinaryOp(self, node):
-        if node.op == self._op:
-            self.op = node
-            self.left = node.left
-            self.right = node.right
+    def visit(self, node):
+        if isinstance(node, c_ast.BinaryOp):
+            if node.op == self._op:
+                self.op = node
+                self.left = node.left
+                self.right = node.right
 
+            return
 
-def constantify(fdef, specs, env):
-    """Replace small read-only with constant memory"""
+        for _, child in node.children():
+            self.visit(child)
+
+
+def constantify(tree, specs, env):
+    """
+    Replace small read-only with constant memory. Arrays whose dimensions are
+    passed at run-time are left alone, as the kernel is reused for arrays of
+    any size.
+    """
+    fdef = tree.root
     params = fdef.decl.type.args.params
     readonly_params = pina.cast.find_read_only(fdef.body, params)
 
@@ -31,6 +46,9 @@ def constantify(fdef, specs, env):
         if p.name in specs:
             spec = specs[p.name]
 
+            if pina.gen.is_dynamic(spec, env):
+                continue
+
             if spec.size and spec.size < constant_size:
                 constant_size -= spec.size
                 constant_args -= 1
@@ -38,98 +56,892 @@ def constantify(fdef, specs, env):
                 p.funcspec = ['__constant']
 
 
-def substitute_mad(stmt):
-    """Substitute "a * b + c" expressions  with "mad(a, b, c)"."""
-    result = []
+def substitute_mad(tree, exclude=None):
+    """
+    Substitute "a * b + c" expressions  with "mad(a, b, c)", except in the
+    statement *exclude*.
+    """
+    types = local_types(tree)
+
+    def matches(node):
+        if node.op not in ('+', '-'):
+            return False
+
+        if not isinstance(node.left, c_ast.BinaryOp) or node.left.op != '*':
+            return False
+
+        # mad() only exists for floating point types
+        if expression_type(node, types) not in ('float', 'double'):
+            return False
+
+        # Only the outermost sums of an expression are substituted and integer
+        # index arithmetic is left alone
+        ancestors = list(tree.ancestors(node))
+        skip = (c_ast.BinaryOp, c_ast.ArrayRef)
+        return not any(isinstance(a, skip) or a is exclude for a in ancestors)
+
+    for node in tree.find(c_ast.BinaryOp, matches):
+        result = expression_type(node, types)
+        args = [node.left.left, node.left.right, node.right]
+
+        if result == 'float':
+            # Double literals make the call ambiguous between the float and
+            # double overloads
+            args = [single_precision(a) for a in args]
 
-    class AddVisitor(c_ast.NodeVisitor):
-        def visit_BinaryOp(self, node):
-            if node.op in ('+', '-'):
-                v = OpVisitor('*')
-                v.visit(node.left)
+        # So do operands of any other type
+        args = [a if expression_type(a, types) in (result, None) else
+                pina.cast.CastDecl(result, a) for a in args]
 
-                if v.left and v.right:
-                    right = node.right
+        if node.op == '-':
+            # invert c to be able to use mad()
+            args[2] = c_ast.UnaryOp('-', args[2])
 
-                    if node.op == '-':
-                        # invert c to be able to use mad()
-                        right = c_ast.UnaryOp('-', right)
+        tree.replace(node, c_ast.FuncCall(c_ast.ID('mad'), c_ast.ExprList(args)))
 
-                    result.append((node, v.left, v.right, right))
 
-    AddVisitor().visit(stmt)
+def single_precision(node):
+    """Return *node* with floating point literals suffixed as single precision."""
+    for n in pina.cast.walk(node):
+        if isinstance(n, c_ast.Constant) and isinstance(numeric_value(n), float):
+            n.value += 'f'
 
-    for node, a, b, c in result:
-        args = c_ast.ExprList([a, b, c])
-        mad = c_ast.FuncCall(c_ast.ID('mad'), args)
-        pina.cast.replace(stmt, node, mad)
+    return node
 
 
 def is_pi(node):
     return isinstance(node, c_ast.Constant) and node.value == 'pi'
 
 
-def substitute_pi_funcs(fdef):
+def substitute_pi_funcs(tree):
     """Substitute "sin/cos/tan(x * pi)" calls with sinpi/cospi/tanpi(x)"""
     funcs = ('sin', 'cos', 'tan')
-    result = []
 
-    class FuncVisitor(c_ast.NodeVisitor):
-        def visit_FuncCall(self, node):
-            name = node.name.name
+    for call in tree.find(c_ast.FuncCall, lambda node: node.name.name in funcs):
+        v = OpVisitor('*')
+        v.visit(call.args.exprs[0])
 
-            if name in funcs:
-                arg = node.args.exprs[0]
-                v = OpVisitor('*')
-                v.visit(arg)
+        if is_pi(v.left):
+            replacement = v.right
+        elif is_pi(v.right):
+            replacement = v.left
+        else:
+            continue
 
-                if is_pi(v.left):
-                    result.append((name, node, v.op, v.right))
-                elif is_pi(v.right):
-                    result.append((name, node, v.op, v.left))
+        tree.replace(v.op, replacement)
+        tree.replace(call.name, c_ast.ID(call.name.name + 'pi'))
 
-            for _, c in node.children():
-                self.visit(c)
 
-    FuncVisitor().visit(fdef.body)
+def substitute_arcus_funcs(tree):
+    funcs = ('acos', 'asin', 'atan', 'atan2')
 
-    for name, call, pi_op, replacement in result:
-        pina.cast.replace(call, pi_op, replacement)
-        call.name = c_ast.ID(name + 'pi')
+    def matches(node):
+        if not isinstance(node.left, c_ast.FuncCall) or node.left.name.name not in funcs:
+            return False
 
+        return node.op == '/' and is_pi(node.right)
 
-def substitute_arcus_funcs(fdef):
-    funcs = ('acos', 'asin', 'atan', 'atan2')
-    result = []
+    for node in tree.find(c_ast.BinaryOp, matches):
+        call = node.left
+        call.name.name += 'pi'
+        tree.replace(node, call)
 
-    def is_func(node):
-        if isinstance(node,c_ast.FuncCall):
-            print node.name.name
-        return isinstance(node, c_ast.FuncCall) and node.name.name in funcs
 
-    def matches(node):
-        if not isinstance(node, c_ast.BinaryOp):
+ARITHMETIC_OPS = ('+', '-', '*', '/')
+
+PURE_FUNCS = set(['get_global_id', 'get_global_size', 'get_local_id', 'get_local_size',
+                  'get_group_id', 'get_num_groups', 'min', 'max', 'clamp', 'abs'])
+
+
+def numeric_value(node):
+    """Return the value of a numeric literal *node* or None."""
+    if not isinstance(node, c_ast.Constant):
+        return None
+
+    for convert in (int, float):
+        try:
+            return convert(node.value)
+        except ValueError:
+            pass
+
+    return None
+
+
+def fold(op, a, b):
+    """Evaluate "*a* *op* *b*" with C semantics or return None."""
+    if op == '/' and b == 0:
+        return None
+
+    if isinstance(a, int) and isinstance(b, int):
+        if op == '/':
+            # C truncates towards zero
+            quotient = abs(a) // abs(b)
+            result = quotient if (a < 0) == (b < 0) else -quotient
+        else:
+            result = {'+': a + b, '-': a - b, '*': a * b}[op]
+
+        return result if -2 ** 31 <= result < 2 ** 31 else None
+
+    result = {'+': operator.add, '-': operator.sub,
+              '*': operator.mul, '/': operator.truediv}[op](float(a), float(b))
+
+    return result if abs(result) < float('inf') else None
+
+
+def fold_constants(tree):
+    """Evaluate arithmetic on numeric literals at translation time."""
+    for node in reversed(list(pina.cast.walk(tree.root))):
+        if node not in tree:
+            continue
+
+        if isinstance(node, c_ast.BinaryOp) and node.op in ARITHMETIC_OPS:
+            a, b = numeric_value(node.left), numeric_value(node.right)
+            result = fold(node.op, a, b) if a is not None and b is not None else None
+
+            # Multiplying with an integer one leaves any value unchanged
+            if result is None and node.op == '*' and 1 in (a, b):
+                one = node.left if a == 1 else node.right
+
+                if one.type == 'int' and isinstance(numeric_value(one), int):
+                    tree.replace(node, node.right if one is node.left else node.left)
+                    continue
+        elif isinstance(node, c_ast.UnaryOp) and node.op in ('+', '-'):
+            a = numeric_value(node.expr)
+            result = None if a is None else (a if node.op == '+' else -a)
+        else:
+            continue
+
+        if result is not None:
+            tree.replace(node, c_ast.Constant('int', repr(result)))
+
+
+def is_pure(node):
+    """Check if evaluating the expression *node* has no side effects."""
+    for n in pina.cast.walk(node):
+        if isinstance(n, c_ast.Assignment):
             return False
 
-        if not isinstance(node.left, c_ast.FuncCall):
+        if isinstance(n, c_ast.UnaryOp) and n.op in ('++', '--', 'p++', 'p--'):
             return False
 
-        return node.op == '/' and is_pi(node.right)
+        if isinstance(n, c_ast.FuncCall):
+            name = n.name.name
 
-    for node in pina.cast.find(fdef.body, matches):
-        call = node.left
-        call.name.name += 'pi'
-        pina.cast.replace(fdef.body, node, call)
+            for prefix in ('native_', 'half_'):
+                if name.startswith(prefix):
+                    name = name[len(prefix):]
+
+            if name not in VECTOR_FUNCS and name not in PURE_FUNCS:
+                return False
+
+    return True
+
+
+def read_names(node):
+    """Return the names of the variables and arrays read by *node*."""
+    calls = set(id(n.name) for n in pina.cast.find_type(node, c_ast.FuncCall))
+    return set(n.name for n in pina.cast.find_type(node, c_ast.ID) if id(n) not in calls)
+
+
+def written_names(node):
+    """
+    Return the names of the variables and arrays written in *node*. The set
+    contains '*' if *node* calls a function with possible side effects.
+    """
+    def base(lvalue):
+        while isinstance(lvalue, c_ast.ArrayRef):
+            lvalue = lvalue.name
+
+        return lvalue.name if isinstance(lvalue, c_ast.ID) else '*'
+
+    names = set()
+
+    for n in pina.cast.walk(node):
+        if isinstance(n, c_ast.Decl):
+            names.add(n.name)
+        elif isinstance(n, c_ast.Assignment):
+            names.add(base(n.lvalue))
+        elif isinstance(n, c_ast.BinaryOp) and n.op in ('+=', '-=', '*=', '/='):
+            names.add(base(n.left))
+        elif isinstance(n, c_ast.UnaryOp) and n.op in ('++', '--', 'p++', 'p--'):
+            names.add(base(n.expr))
+        elif isinstance(n, c_ast.FuncCall) and not is_pure(n):
+            names.add('*')
+
+    return names
+
+
+def statement_expressions(stmt):
+    """
+    Return the expressions evaluated once when *stmt* is executed, skipping
+    nested blocks and loops.
+    """
+    if isinstance(stmt, c_ast.Decl):
+        return [stmt.init] if stmt.init else []
+
+    if isinstance(stmt, c_ast.Assignment):
+        return [stmt.rvalue]
+
+    if isinstance(stmt, c_ast.FuncCall):
+        return [stmt.args] if stmt.args else []
+
+    if isinstance(stmt, c_ast.If):
+        return [stmt.cond]
+
+    return []
+
+
+def candidates(stmt, arrays=True):
+    """
+    Return the expressions of *stmt* worth keeping in a temporary in
+    pre-order. Index arithmetic is left alone, so that relative accesses
+    remain recognizable.
+    """
+    result = []
+
+    def visit(node, is_index):
+        if not is_index:
+            if isinstance(node, c_ast.BinaryOp) and node.op in ARITHMETIC_OPS:
+                result.append(node)
+            elif isinstance(node, c_ast.FuncCall) and node.args:
+                result.append(node)
+            elif arrays and isinstance(node, c_ast.ArrayRef) and isinstance(node.name, c_ast.ID):
+                result.append(node)
+
+        for attr, _, child in pina.cast.slots(node):
+            visit(child, is_index or (isinstance(node, c_ast.ArrayRef) and attr == 'subscript'))
+
+    for expr in statement_expressions(stmt):
+        visit(expr, False)
+
+    return [n for n in result if is_pure(n) and (arrays or not pina.cast.find_type(n, c_ast.ArrayRef))]
+
+
+def local_types(tree):
+    """
+    Map the names of scalar variables and parameters to their type and of
+    arrays to the type of their elements.
+    """
+    types = {}
+
+    for decl in tree.find_type(c_ast.Decl):
+        if isinstance(decl.type, (c_ast.TypeDecl, c_ast.PtrDecl)) and \
+                isinstance(decl.type.type, (c_ast.IdentifierType, c_ast.TypeDecl)):
+            types[decl.name] = pina.cast.type_name(decl)
+
+    return types
+
+
+def expression_type(node, types):
+    """Return the type of the expression *node*."""
+    if isinstance(node, c_ast.Constant):
+        return 'int' if isinstance(numeric_value(node), int) and node.type == 'int' else 'float'
+
+    if isinstance(node, c_ast.ID):
+        # Work item functions are inlined as identifiers
+        return 'int' if '(' in node.name else types.get(node.name, 'float')
+
+    if isinstance(node, c_ast.ArrayRef):
+        return types.get(node.name.name, 'float') if isinstance(node.name, c_ast.ID) else 'float'
+
+    if isinstance(node, c_ast.FuncCall):
+        if node.name.name in PURE_FUNCS - set(['min', 'max', 'clamp', 'abs']):
+            return 'int'
+
+        args = node.args.exprs if node.args else []
+        return pina.qualifiers.promote('float', *[expression_type(a, types) for a in args])
+
+    if isinstance(node, c_ast.Cast):
+        return node.to_type.type.names[-1]
+
+    if isinstance(node, c_ast.UnaryOp):
+        return expression_type(node.expr, types)
+
+    if isinstance(node, c_ast.BinaryOp):
+        if node.op not in ARITHMETIC_OPS:
+            return 'int'
+
+        return pina.qualifiers.arithmetic_type(expression_type(node.left, types),
+                                               expression_type(node.right, types))
+
+    return 'float'
+
+
+def temporary(tree, prefix):
+    """Return a variable name starting with *prefix* that is not used yet."""
+    used = set(d.name for d in tree.find_type(c_ast.Decl))
+    n = 0
+
+    while '{0}__{1}'.format(prefix, n) in used:
+        n += 1
+
+    return '{0}__{1}'.format(prefix, n)
+
+
+def index_of(items, node):
+    return [i for i, item in enumerate(items) if item is node][0]
+
+
+def hoist_loop_invariants(tree):
+    """
+    Compute expressions of loop bodies that do not depend on variables
+    changed in the loop once before the loop. Array reads are not moved,
+    because a loop might guard them.
+    """
+    generator = c_generator.CGenerator()
+    types = local_types(tree)
+    loops = [n for n in reversed(list(pina.cast.walk(tree.root))) if isinstance(n, c_ast.For)]
+
+    for loop in loops:
+        block = tree.parent(loop)
+
+        if not isinstance(block, c_ast.Compound) or not isinstance(loop.stmt, c_ast.Compound):
+            continue
+
+        variant = written_names(loop)
+        statements = list(loop.stmt.block_items)
+        hoisted = []
+
+        # Blocks of unrolled iterations are executed unconditionally as well
+        for stmt in statements:
+            if isinstance(stmt, c_ast.Compound):
+                statements.extend(stmt.block_items or [])
+
+            for node in candidates(stmt, arrays=False):
+                if read_names(node) & variant:
+                    continue
+
+                if not any(tree.within(node, h) for h in hoisted):
+                    hoisted.append(node)
+
+        temporaries = {}
+
+        for node in hoisted:
+            key = generator.visit(node)
+
+            if key not in temporaries:
+                name = temporary(tree, 'inv')
+                decl = pina.cast.TypeDecl(name, expression_type(node, types), copy.deepcopy(node))
+                tree.insert(block, 'block_items', index_of(block.block_items, loop), decl)
+                types[name] = pina.cast.type_name(decl)
+                temporaries[key] = name
+
+            tree.replace(node, c_ast.ID(temporaries[key]))
+
+
+def eliminate_common_subexpressions(tree, head=1):
+    """
+    Compute expressions occurring more than once in a block, without
+    variables changing in between, only once. The first *head* statements
+    of the kernel body are left alone.
+    """
+    generator = c_generator.CGenerator()
+    types = local_types(tree)
+
+    for block in tree.find_type(c_ast.Compound):
+        statements = block.block_items or []
+        start = head if block is tree.root.body else 0
+        available, groups = {}, []
+
+        for stmt in statements[start:]:
+            for node in candidates(stmt):
+                key = generator.visit(node)
+
+                if key not in available:
+                    available[key] = (read_names(node), [])
+                    groups.append((key, available[key][1]))
+
+                available[key][1].append((node, stmt))
 
+            written = written_names(stmt)
 
-def level1(fdef, specs, env):
-    constantify(fdef, specs, env)
+            for key, (names, _) in list(available.items()):
+                if '*' in written or names & written:
+                    del available[key]
 
+        # Larger expressions first, their parts then disappear with them
+        for key, occurrences in sorted(groups, key=lambda g: -len(g[0])):
+            occurrences = [(node, stmt) for node, stmt in occurrences if node in tree]
 
-def level2(fdef, specs, env):
+            if len(occurrences) < 2:
+                continue
+
+            first, stmt = occurrences[0]
+            name = temporary(tree, 'cse')
+            decl = pina.cast.TypeDecl(name, expression_type(first, types), copy.deepcopy(first))
+            tree.insert(block, 'block_items', index_of(block.block_items, stmt), decl)
+            types[name] = pina.cast.type_name(decl)
+
+            for node, _ in occurrences:
+                tree.replace(node, c_ast.ID(name))
+
+
+def trip_count(loop):
+    """
+    Return (variable, start, step, count) of a counting *loop* whose number
+    of iterations is known at translation time or None.
+    """
+    init, cond, step = loop.init, loop.cond, loop.next
+
+    if not isinstance(init, c_ast.Decl) or not isinstance(numeric_value(init.init), int):
+        return None
+
+    if not isinstance(cond, c_ast.BinaryOp) or cond.op != '<':
+        return None
+
+    if not isinstance(cond.left, c_ast.ID) or cond.left.name != init.name:
+        return None
+
+    if not isinstance(step, c_ast.ExprList) or len(step.exprs) != 1:
+        return None
+
+    step = step.exprs[0]
+
+    if not isinstance(step, c_ast.BinaryOp) or step.op != '+=' or step.left.name != init.name:
+        return None
+
+    start, stop, stride = numeric_value(init.init), numeric_value(cond.right), numeric_value(step.right)
+
+    if not isinstance(stop, int) or not isinstance(stride, int) or stride <= 0:
+        return None
+
+    if init.name in written_names(loop.stmt):
+        return None
+
+    if pina.cast.find(loop.stmt, lambda n: isinstance(n, (c_ast.Break, c_ast.Continue))):
+        return None
+
+    return init.name, start, stride, max(0, (stop - start + stride - 1) // stride)
+
+
+def iteration(body, name, value):
+    """Return a copy of the loop *body* with the variable *name* set to *value*."""
+    block = pina.cast.Tree(copy.deepcopy(body))
+
+    for ident in block.find(c_ast.ID, lambda n: n.name == name):
+        block.replace(ident, copy.deepcopy(value))
+
+    return block.root
+
+
+def unroll_loops(tree, env):
+    """
+    Replace loops of at most *env.unroll_limit* iterations known at
+    translation time by copies of their body. Longer loops compute
+    *env.unroll_factor* iterations per round. Each copy is a block of its
+    own, so that declarations of the body do not clash.
+    """
+    def const(value):
+        return c_ast.Constant('int', str(value))
+
+    loops = [n for n in reversed(list(pina.cast.walk(tree.root))) if isinstance(n, c_ast.For)]
+
+    for loop in loops:
+        trip = trip_count(loop) if isinstance(loop.stmt, c_ast.Compound) else None
+
+        if trip is None:
+            continue
+
+        name, start, stride, count = trip
+        factor = env.unroll_factor
+
+        if count <= env.unroll_limit:
+            rounds = 0
+        elif factor > 1:
+            rounds = count // factor
+        else:
+            continue
+
+        items = []
+
+        if rounds:
+            stop = start + rounds * factor * stride
+            offsets = [c_ast.ID(name)] + [c_ast.BinaryOp('+', c_ast.ID(name), const(k * stride))
+                                          for k in range(1, factor)]
+            body = c_ast.Compound([iteration(loop.stmt, name, o) for o in offsets])
+            items.append(c_ast.For(copy.deepcopy(loop.init),
+                                   c_ast.BinaryOp('<', c_ast.ID(name), const(stop)),
+                                   c_ast.ExprList([c_ast.BinaryOp('+=', c_ast.ID(name),
+                                                                  const(factor * stride))]),
+                                   body))
+
+        for k in range(rounds * factor, count):
+            items.append(iteration(loop.stmt, name, const(start + k * stride)))
+
+        tree.replace(loop, c_ast.Compound(items))
+
+
+def inline_constants(tree, specs, env):
+    """
+    Replace reads of constant indices of arrays whose values are known at
+    translation time, like filter taps, with the values.
+    """
+    written = written_names(tree.root.body)
+
+    def is_known(ref):
+        if not isinstance(ref.name, c_ast.ID) or ref.name.name in written:
+            return False
+
+        spec = specs.get(ref.name.name)
+        return spec is not None and spec.values is not None and \
+            len(spec.values) <= env.inline_limit and isinstance(numeric_value(ref.subscript), int)
+
+    for ref in tree.find(c_ast.ArrayRef, is_known):
+        spec = specs[ref.name.name]
+        values = spec.values
+        index = numeric_value(ref.subscript)
+
+        if not 0 <= index < len(values) or not abs(values[index]) < float('inf'):
+            continue
+
+        element_type = pina.gen.element_type(spec)
+
+        if element_type == 'float':
+            # Single precision literals keep float arithmetic and builtins
+            tree.replace(ref, c_ast.Constant('float', repr(values[index]) + 'f'))
+        elif element_type == 'double':
+            tree.replace(ref, c_ast.Constant('double', repr(values[index])))
+        else:
+            tree.replace(ref, c_ast.Constant('int', str(int(values[index]))))
+
+
+NATIVE_FUNCS = set(['cos', 'divide', 'exp', 'exp2', 'exp10', 'log', 'log2', 'log10',
+                    'powr', 'recip', 'rsqrt', 'sin', 'sqrt', 'tan'])
+
+
+def fast_math(tree, env):
+    """
+    Keep all arithmetic in single precision and, depending on
+    *env.native_math*, call the 'native' or 'half' variants of math
+    functions, which trade accuracy for speed.
+    """
+    single_precision(tree.root.body)
+
+    if env.native_math:
+        prefix = env.native_math + '_'
+
+        for call in tree.find(c_ast.FuncCall, lambda n: n.name.name in NATIVE_FUNCS):
+            tree.replace(call.name, c_ast.ID(prefix + call.name.name))
+
+
+def level1(tree, specs, env):
+    """Optimizations that do not affect the result."""
+    constantify(tree, specs, env)
+
+    if env.dataflow:
+        fold_constants(tree)
+        unroll_loops(tree, env)
+        fold_constants(tree)
+        inline_constants(tree, specs, env)
+        hoist_loop_invariants(tree)
+        eliminate_common_subexpressions(tree, 2 if env.guard_range else 1)
+
+
+def level2(tree, specs, env):
     """Optimizations that might affect the result."""
-    for stmt in fdef.body.block_items[1:]:
-        substitute_mad(stmt)
+    # skip the work item index declaration
+    substitute_mad(tree, tree.root.body.block_items[0])
+
+    substitute_pi_funcs(tree)
+    substitute_arcus_funcs(tree)
+
+
+VECTOR_FUNCS = set(['acos', 'acosh', 'acospi', 'asin', 'asinh', 'asinpi', 'atan', 'atan2',
+                    'atanh', 'atanpi', 'atan2pi', 'cbrt', 'ceil', 'copysign', 'cos', 'cosh',
+                    'cospi', 'divide', 'erf', 'erfc', 'exp', 'exp2', 'exp10', 'expm1', 'fabs',
+                    'fdim', 'floor', 'fma', 'fmax', 'fmin', 'fmod', 'hypot', 'log', 'log2',
+                    'log10', 'log1p', 'mad', 'pow', 'powr', 'recip', 'rint', 'round', 'rsqrt',
+                    'sin', 'sinh', 'sinpi', 'sqrt', 'tan', 'tanh', 'tanpi', 'trunc'])
+
 
-    substitute_pi_funcs(fdef)
-    substitute_arcus_funcs(fdef)
+def is_elementwise(body, arrays):
+    """
+    Check if the statements in *body* only combine the current elements of
+    *arrays* with scalars and math functions, so that they can be computed for
+    several consecutive elements at once.
+    """
+    allowed = (c_ast.Compound, c_ast.Decl, c_ast.TypeDecl, c_ast.IdentifierType,
+               c_ast.Assignment, c_ast.BinaryOp, c_ast.UnaryOp, c_ast.Constant, c_ast.ID,
+               c_ast.ArrayRef, c_ast.FuncCall, c_ast.ExprList)
+
+    for stmt in body:
+        for node in pina.cast.walk(stmt):
+            if not isinstance(node, allowed):
+                return False
+
+            if isinstance(node, c_ast.BinaryOp) and node.op not in ('+', '-', '*', '/'):
+                return False
+
+            if isinstance(node, c_ast.UnaryOp) and node.op not in ('+', '-'):
+                return False
+
+            if isinstance(node, c_ast.Assignment):
+                lvalue = node.lvalue
+
+                if isinstance(lvalue, c_ast.ArrayRef) and lvalue.name.name != 'out':
+                    return False
+
+            if isinstance(node, c_ast.ArrayRef):
+                if not isinstance(node.subscript, c_ast.ID) or node.subscript.name != 'idx':
+                    return False
+
+                if node.name.name not in arrays and node.name.name != 'out':
+                    return False
+
+            if isinstance(node, c_ast.FuncCall):
+                name = node.name.name
+
+                for prefix in ('native_', 'half_'):
+                    if name.startswith(prefix):
+                        name = name[len(prefix):]
+
+                if name not in VECTOR_FUNCS:
+                    return False
+
+            if isinstance(node, c_ast.ID) and node.name.startswith('idx__'):
+                return False
+
+    return True
+
+
+def element_count(tree, specs, env):
+    """Return an expression for the number of elements of the first array."""
+    for p in tree.root.decl.type.args.params:
+        if p.name not in specs or not isinstance(p.type, c_ast.PtrDecl):
+            continue
+
+        spec = specs[p.name]
+
+        if pina.gen.is_dynamic(spec, env):
+            dims = [c_ast.ID(pina.gen.shape_name(p.name, i)) for i in range(len(spec.shape))]
+            return pina.cast.chain('*', dims)
+
+        return c_ast.Constant('int', str(reduce(operator.mul, spec.shape, 1)))
+
+
+def vectorize(tree, specs, env):
+    """
+    Compute element-wise kernels on vectors of *env.vector_width* elements
+    loaded with vloadN() and stored with vstoreN(). The kernel then needs a
+    global range of the element count divided by the width, rounded up. The
+    last work item computes the remaining elements one by one. The width is
+    announced with a vec_type_hint attribute.
+    """
+    fdef = tree.root
+    width = env.vector_width
+    vector_type = 'float{0}'.format(width)
+    params = fdef.decl.type.args.params
+    arrays = set(p.name for p in params if isinstance(p.type, c_ast.PtrDecl))
+    head = 2 if env.guard_range else 1
+    body = fdef.body.block_items[head:]
+    count = element_count(tree, specs, env)
+
+    if count is None or not is_elementwise(body, arrays):
+        return
+
+    # Vector loads and stores exist for every type, but the arithmetic is
+    # done in floatN
+    decls = [p for p in params if isinstance(p.type, c_ast.PtrDecl)]
+    decls += [d for stmt in body for d in pina.cast.find_type(stmt, c_ast.Decl)]
+
+    if any(pina.cast.type_name(d) != 'float' for d in decls):
+        return
+
+    vector = pina.cast.Tree(c_ast.Compound(copy.deepcopy(body)))
+    local_names = set()
+
+    for decl in vector.find_type(c_ast.Decl):
+        if decl.type.type.names == ['float']:
+            decl.type.type.names = [vector_type]
+            local_names.add(decl.name)
+
+    def is_scalar(node):
+        parent = vector.parent(node)
+
+        if isinstance(parent, c_ast.ArrayRef):
+            return False
+
+        if isinstance(parent, c_ast.FuncCall) and parent.name is node:
+            return False
+
+        return not isinstance(node, c_ast.ID) or node.name not in local_names
+
+    # OpenCL does not mix double literals with float vectors and builtins
+    # only accept vectors of the same type
+    for node_type in (c_ast.Constant, c_ast.ID):
+        for node in vector.find(node_type, is_scalar):
+            vector.replace(node, pina.cast.CastDecl(vector_type, node))
+
+    load = 'vload{0}'.format(width)
+    store = 'vstore{0}'.format(width)
+
+    for ref in vector.find(c_ast.ArrayRef, lambda n: n.name.name != 'out'):
+        args = c_ast.ExprList([c_ast.ID('idx'), c_ast.ID(ref.name.name)])
+        vector.replace(ref, c_ast.FuncCall(c_ast.ID(load), args))
+
+    for assignment in vector.find_type(c_ast.Assignment):
+        if isinstance(assignment.lvalue, c_ast.ArrayRef):
+            args = c_ast.ExprList([assignment.rvalue, c_ast.ID('idx'), c_ast.ID('out')])
+            vector.replace(assignment, c_ast.FuncCall(c_ast.ID(store), args))
+
+    # Remaining elements are handled by the last work item with the scalar body
+    first = c_ast.BinaryOp('*', c_ast.ID('idx'), c_ast.Constant('int', str(width)))
+    tail_index = pina.cast.TypeDecl('idx', 'int', c_ast.ID('idx__tail'))
+    tail = c_ast.For(pina.cast.TypeDecl('idx__tail', 'int', first),
+                     c_ast.BinaryOp('<', c_ast.ID('idx__tail'), count),
+                     c_ast.ExprList([c_ast.BinaryOp('+=', c_ast.ID('idx__tail'),
+                                                    c_ast.Constant('int', '1'))]),
+                     c_ast.Compound([tail_index] + body))
+
+    end = c_ast.BinaryOp('*', c_ast.BinaryOp('+', c_ast.ID('idx'), c_ast.Constant('int', '1')),
+                         c_ast.Constant('int', str(width)))
+    branch = c_ast.If(c_ast.BinaryOp('<=', end, copy.deepcopy(count)),
+                      vector.root, c_ast.Compound([tail]))
+
+    tree.set(fdef, 'body', c_ast.Compound(fdef.body.block_items[:head] + [branch]))
+    hint = '__attribute__((vec_type_hint({0})))'.format(vector_type)
+    fdef.decl.type.type.quals.append(hint)
+
+
+def relative_offset(subscript):
+    """
+    Return the constant offset of a subscript relative to the work item
+    index or None if it is not relative.
+    """
+    if isinstance(subscript, c_ast.ID) and subscript.name == 'idx':
+        return 0
+
+    if not isinstance(subscript, c_ast.BinaryOp) or subscript.op not in ('+', '-'):
+        return None
+
+    left, right = subscript.left, subscript.right
+
+    if not isinstance(left, c_ast.ID) or left.name != 'idx':
+        return None
+
+    if not isinstance(right, c_ast.Constant):
+        return None
+
+    offset = int(right.value)
+    return offset if subscript.op == '+' else -offset
+
+
+def stencil_footprints(tree, arrays):
+    """
+    Return a dictionary mapping each of *arrays* that is only read relative
+    to the work item index, and not just at it, to the smallest and largest
+    offset.
+    """
+    offsets = dict((name, []) for name in arrays)
+
+    for ref in tree.find_type(c_ast.ArrayRef):
+        name = ref.name.name if isinstance(ref.name, c_ast.ID) else None
+
+        if name in offsets and offsets[name] is not None:
+            offset = relative_offset(ref.subscript)
+            offsets[name] = None if offset is None else offsets[name] + [offset]
+
+    return dict((name, (min(o), max(o))) for name, o in offsets.items()
+                if o and (min(o) < 0 or max(o) > 0))
+
+
+def tile_stencils(tree, specs, env):
+    """
+    Let work groups of *env.tile_size* items load the elements read by
+    relative accesses into local memory. Kernels querying the global range
+    and halos wider than a tile or local memory are left alone.
+    """
+    fdef = tree.root
+    size = env.tile_size
+    params = fdef.decl.type.args.params
+    arrays = [p.name for p in params if isinstance(p.type, c_ast.PtrDecl) and p.name != 'out']
+    types = dict((p.name, pina.cast.type_name(p)) for p in params)
+    footprints = stencil_footprints(tree, arrays)
+    count = element_count(tree, specs, env)
+
+    if not footprints or count is None:
+        return
+
+    def tile_bytes(name, lo, hi):
+        spec = specs[name]
+        return (size + hi - lo) * spec.size // reduce(operator.mul, spec.shape, 1)
+
+    if any(hi - lo > size for lo, hi in footprints.values()) or \
+            sum(tile_bytes(n, lo, hi) for n, (lo, hi) in footprints.items()) > env.MAX_LOCAL_SIZE:
+        return
+
+    # Kernels with a fixed work-group size, like reductions, synchronize on
+    # their own
+    if any('reqd_work_group_size' in q for q in fdef.decl.type.type.quals):
+        return
+
+    def const(value):
+        return c_ast.Constant('int', str(value))
+
+    # Work items of the padded range must reach the barrier, so the range
+    # guard is replaced by a check around the computation
+    head = fdef.body.block_items[:1]
+    body = fdef.body.block_items[2 if env.guard_range else 1:]
+    ranges = set(pina.gen.range_name(dim) for dim in range(2))
+
+    def is_query(node):
+        if isinstance(node, c_ast.FuncCall):
+            return isinstance(node.name, c_ast.ID) and \
+                   node.name.name in ('get_global_id', 'get_global_size')
+
+        # Range guards replace size queries by the range arguments
+        return isinstance(node, c_ast.ID) and node.name in ranges
+
+    if any(is_query(node) for stmt in body for node in pina.cast.walk(stmt)):
+        return
+
+    local_index = c_ast.FuncCall(c_ast.ID('get_local_id'), c_ast.ExprList([const(0)]))
+    loads = [pina.cast.TypeDecl('idx__local', 'int', local_index)]
+
+    for name, (lo, hi) in sorted(footprints.items()):
+        tile = name + '__tile'
+        length = size + hi - lo
+        typedecl = c_ast.TypeDecl(tile, [], c_ast.IdentifierType([types[name]]))
+        loads.append(c_ast.Decl(tile, [], [], ['__local'],
+                                c_ast.ArrayDecl(typedecl, const(length)), None, None))
+
+        first = c_ast.BinaryOp('-', c_ast.ID('idx'), c_ast.ID('idx__local'))
+        element = c_ast.BinaryOp('+', c_ast.BinaryOp('+', first, const(lo)), c_ast.ID('idx__load'))
+        inside = c_ast.BinaryOp('&&', c_ast.BinaryOp('>=', c_ast.ID('idx__global'), const(0)),
+                                c_ast.BinaryOp('<', c_ast.ID('idx__global'), copy.deepcopy(count)))
+        load = c_ast.Assignment('=', pina.cast.ArrayRef(tile, 'idx__load'),
+                                pina.cast.ArrayRef(name, 'idx__global'))
+
+        loads.append(c_ast.For(pina.cast.TypeDecl('idx__load', 'int', c_ast.ID('idx__local')),
+                               c_ast.BinaryOp('<', c_ast.ID('idx__load'), const(length)),
+                               c_ast.ExprList([c_ast.BinaryOp('+=', c_ast.ID('idx__load'),
+                                                              const(size))]),
+                               c_ast.Compound([pina.cast.TypeDecl('idx__global', 'int', element),
+                                               c_ast.If(inside, load, None)])))
+
+        def is_tiled(node):
+            return isinstance(node.name, c_ast.ID) and node.name.name == name
+
+        for ref in tree.find(c_ast.ArrayRef, is_tiled):
+            offset = relative_offset(ref.subscript) - lo
+            subscript = c_ast.BinaryOp('+', c_ast.ID('idx__local'), const(offset))
+            tree.replace(ref, c_ast.ArrayRef(c_ast.ID(tile), subscript))
+
+    barrier = c_ast.FuncCall(c_ast.ID('barrier'), c_ast.ExprList([c_ast.ID('CLK_LOCAL_MEM_FENCE')]))
+    compute = c_ast.If(c_ast.BinaryOp('<', c_ast.ID('idx'), count), c_ast.Compound(body), None)
+
+    tree.set(fdef, 'body', c_ast.Compound(head + loads + [barrier, compute]))
+    hint = '__attribute__((reqd_work_group_size({0}, 1, 1)))'.format(size)
+    fdef.decl.type.type.quals.append(hint)
+
+
+def level3(tree, specs, env):
+    """Optimizations that change the global range of the kernel."""
+    if any(spec.batched for spec in specs.values()):
+        # Frames of a batch span dimension 2 of the range
+        return
+
+    vectorize(tree, specs, env)
+
+    if env.tile_size:
+        tile_stencils(tree, specs, env)
@@ -1,7 +1,8 @@
 import ast
+import copy
 import inspect
 import cast
-from pycparser import c_ast
+from cast import c_ast
 
 
 def constant(name):
@@ -174,11 +175,25 @@ def python_to_c_ast(py_node):
         return v.result
 
 
+def python_ast(func):
+    """
+    Return a copy of the Python AST of *func*, parsing its source only once.
+    """
+    tree = _trees.get(func)
+
+    if tree is None:
+        source = inspect.getsource(func)
+        tree = ast.parse(source).body[0]
+        _trees[func] = tree
+
+    return copy.deepcopy(tree)
+
+_trees = {}
+
+
 def parse(func):
     """
     Turn *func*'s Python AST into a pycparser AST for subsequent
     optimization and OpenCL code generation.
     """
-    source = inspect.getsource(func)
-    tree = ast.parse(source)
-    return python_to_c_ast(tree.body[0])
+    return python_to_c_ast(python_ast(func))
@@ -0,0 +1,126 @@
+import json
+
+
+STAGES = ('upload', 'kernel', 'download')
+
+
+def percentile(values, q):
+    """Return the *q*-th percentile of the sorted *values*, interpolating linearly."""
+    if not values:
+        return None
+
+    pos = (len(values) - 1) * q / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def statistics(values):
+    """
+    Return the count, total, mean and 50th, 90th and 99th percentile of
+    *values*.
+    """
+    values = sorted(values)
+    return dict(count=len(values),
+                total=sum(values),
+                mean=sum(values) / len(values),
+                p50=percentile(values, 50),
+                p90=percentile(values, 90),
+                p99=percentile(values, 99))
+
+
+class Profile(object):
+    """
+    Timeline of the commands of a runtime whose queues have profiling
+    enabled. Commands are recorded with their OpenCL event, whose start and
+    end times are only read once they are needed, so that recording never
+    waits for the device.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.records = []
+        self.queue_names = {}
+
+    def record(self, name, stage, queue, event, queue_name=None):
+        """
+        Record the command of *event* executing *stage* of the call *name* on
+        the queue with index *queue*.
+        """
+        if event is None:
+            return
+
+        if queue_name:
+            self.queue_names[queue] = queue_name
+
+        self.pending.append((name, stage, queue, event))
+
+    def collect(self):
+        """
+        Wait for all recorded commands and return a list of (name, stage,
+        queue, start, end) tuples with device times in nanoseconds.
+        """
+        for name, stage, queue, event in self.pending:
+            event.wait()
+            self.records.append((name, stage, queue, event.profile.start, event.profile.end))
+
+        self.pending = []
+        return self.records
+
+    def clear(self):
+        self.pending = []
+        self.records = []
+
+    def summary(self):
+        """
+        Return a dictionary mapping (name, stage) pairs to the count, total,
+        mean and 50th, 90th and 99th percentile of their durations in seconds.
+        """
+        durations = {}
+
+        for name, stage, _, start, end in self.collect():
+            durations.setdefault((name, stage), []).append((end - start) * 1e-9)
+
+        return dict((key, statistics(values)) for key, values in durations.items())
+
+    def format_summary(self):
+        """Return the summary as a text table."""
+        lines = ['name  stage  count  mean  p50  p90  p99']
+
+        for (name, stage), s in sorted(self.summary().items()):
+            lines.append('{}  {}  {}  {:.3e}  {:.3e}  {:.3e}  {:.3e}'.format(
+                name, stage, s['count'], s['mean'], s['p50'], s['p90'], s['p99']))
+
+        return '\n'.join(lines) + '\n'
+
+    def trace(self):
+        """
+        Return the timeline in the Chrome trace event format, with one
+        process per queue and one thread per stage, so that overlapping
+        transfers and kernels appear side by side.
+        """
+        records = self.collect()
+        origin = min(r[3] for r in records) if records else 0
+        events = []
+
+        for queue in sorted(set(r[2] for r in records)):
+            name = self.queue_names.get(queue, 'queue')
+            events.append(dict(name='process_name', ph='M', pid=queue,
+                               args=dict(name='{}: {}'.format(queue, name))))
+
+            for tid, stage in enumerate(STAGES):
+                events.append(dict(name='thread_name', ph='M', pid=queue, tid=tid,
+                                   args=dict(name=stage)))
+
+        for name, stage, queue, start, end in records:
+            events.append(dict(name=name, cat=stage, ph='X', pid=queue,
+                               tid=STAGES.index(stage),
+                               ts=(start - origin) / 1000.0,
+                               dur=(end - start) / 1000.0))
+
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def write_trace(self, path):
+        """Write the Chrome trace of the timeline to *path*."""
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
@@ -1,6 +1,6 @@
 _TYPE_MAP = {
     "<type 'bool'>": 'bool',
-    "<type 'float'>": 'double',
+    "<type 'float'>": 'float',
     "<type 'int'>": 'int',
     "<type 'str'>": 'char',
     "<type 'numpy.bool'>": 'bool',
@@ -9,6 +9,9 @@ _TYPE_MAP = {
     "<type 'numpy.int64'>": 'long',
     "<type 'numpy.int8'>": 'char',
     "<type 'numpy.uint8'>": 'unsigned char',
+    "<type 'numpy.int16'>": 'short',
+    "<type 'numpy.uint16'>": 'unsigned short',
+    "<type 'numpy.uint32'>": 'unsigned int',
     "<type 'numpy.float'>": 'double',
     "<type 'numpy.float16'>": 'half',
     "<type 'numpy.float32'>": 'float',
@@ -19,11 +22,28 @@ _TYPE_PRIORITY = {
     'bool': 1,
     'char': 2,
     'unsigned char': 2,
-    'int': 3,
-    'unsigned int': 3,
-    'half': 4,
-    'float': 5,
-    'double': 6
+    'short': 3,
+    'unsigned short': 3,
+    'int': 4,
+    'unsigned int': 4,
+    'long': 5,
+    'half': 6,
+    'float': 7,
+    'double': 8
+}
+
+_NUMPY_TYPES = {
+    'bool': 'bool',
+    'char': 'int8',
+    'unsigned char': 'uint8',
+    'short': 'int16',
+    'unsigned short': 'uint16',
+    'int': 'int32',
+    'unsigned int': 'uint32',
+    'long': 'int64',
+    'half': 'float16',
+    'float': 'float32',
+    'double': 'float64',
 }
 
 
@@ -31,6 +51,31 @@ def is_supported(type_name):
     return type_name in _TYPE_MAP
 
 
+def numpy_type(type_name):
+    """Return the name of the NumPy dtype matching the OpenCL *type_name*."""
+    return _NUMPY_TYPES[type_name]
+
+
+def promote(*type_names):
+    """
+    Return the type of highest priority among *type_names*, ignoring None,
+    or None if no type is given.
+    """
+    names = [t for t in type_names if t]
+    return max(names, key=lambda t: _TYPE_PRIORITY[t]) if names else None
+
+
+def arithmetic_type(*type_names):
+    """
+    Return the type of an arithmetic operation on *type_names*. Like in C,
+    types narrower than int are computed as int.
+    """
+    if not any(type_names):
+        return None
+
+    return promote('int', *type_names)
+
+
 def set_default_float_type(type_name):
     _TYPE_MAP["<type 'float'>"] = type_name
 
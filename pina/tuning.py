@@ -0,0 +1,122 @@
+import os
+import json
+import errno
+import hashlib
+import inspect
+import tempfile
+import itertools
+import pina.cache
+
+
+def default_path():
+    return os.path.join(pina.cache.default_path(), 'tuning.json')
+
+
+def next_power_of_two(n):
+    power = 1
+
+    while power < n:
+        power *= 2
+
+    return power
+
+
+def shape_class(shape):
+    """Round *shape* up to powers of two, so that similar shapes share entries."""
+    return tuple(next_power_of_two(n) for n in shape)
+
+
+def make_key(funcs, env, device, shape):
+    """
+    Compute the key of a kernel composed of *funcs*, translated in *env* and
+    launched over a global range of *shape* on *device*, an identity string.
+    """
+    h = hashlib.sha1()
+    parts = [[inspect.getsource(func) for func in funcs],
+             pina.cache.env_digest(env)]
+
+    h.update(repr(parts).encode('utf-8'))
+    name = '_'.join(func.__name__ for func in funcs)
+    shape = 'x'.join(str(n) for n in shape_class(shape))
+    return '/'.join((name, h.hexdigest()[:16], device, shape))
+
+
+def candidates(shape, max_group_size, max_item_sizes, max_items=1024):
+    """
+    Return the local sizes worth trying for a global range of *shape*. None
+    stands for the choice of the driver.
+    """
+    def powers(n, limit):
+        limit = min(next_power_of_two(n), limit)
+        return [2 ** i for i in range(limit.bit_length()) if 2 ** i <= limit]
+
+    dims = [powers(n, limit) for n, limit in zip(shape, max_item_sizes)]
+    largest = min(max_group_size, max_items, reduce(lambda a, b: a * b[-1], dims, 1))
+    result = [None]
+
+    for local in itertools.product(*dims):
+        items = reduce(lambda a, b: a * b, local, 1)
+
+        if min(16, largest) <= items <= largest:
+            result.append(local)
+
+    return result
+
+
+def padded(shape, local):
+    """Round the global range *shape* up to multiples of the *local* size."""
+    if local is None:
+        return tuple(shape)
+
+    return tuple((n + l - 1) // l * l for n, l in zip(shape, local))
+
+
+class TuningDatabase(object):
+    """
+    JSON file mapping kernel keys to the fastest local size found by the
+    autotuner. A null entry means that the driver's choice was fastest.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        local = self.entries.get(key)
+        return tuple(local) if local else None
+
+    def put(self, key, local):
+        """Store *local* under *key*, keeping entries written by other processes."""
+        entries = self.load()
+        entries.update(self.entries)
+        entries[key] = list(local) if local else None
+        self.entries = entries
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            # Tuning results are an optimization, losing them is harmless
+            pass
@@ -16,5 +16,5 @@ setup(
         'pycparser >= 2.10',
         'pyopencl >= 2013.2',
     ],
-    scripts=['bin/pina-perf']
+    scripts=['bin/pina-perf', 'bin/pina-bundle']
 )
@@ -2,12 +2,20 @@
 
 import numpy as np
 import pina.cast
+import pina.gen
+import pina.misc
+import pina.parser
+import pina.qualifiers
 from pina import jit, ExecutionEnvironment
 from pycparser import c_ast
 
 
 env = ExecutionEnvironment()
 
+dynamic_env = ExecutionEnvironment()
+dynamic_env.dynamic_shapes = True
+dynamic_env.static_shapes = [(64, 64)]
+
 
 @jit(env=env, ast=True)
 def k_scalar(s, x):
@@ -29,6 +37,29 @@ def k_tuple_assignment(x, y):
     a, b = x, y
 
 
+@jit(env=dynamic_env)
+def k_dynamic(x):
+    return x[-1, 0] + len(x)
+
+
+@jit(env=dynamic_env)
+def k_dynamic_add(x, y):
+    return x + y
+
+
+def k_double(x):
+    return 2 * x
+
+
+def k_shift(x):
+    return x[-1]
+
+
+@jit
+def k_memo(x):
+    return 2 * x
+
+
 class TestBasics(object):
     def setUp(self):
         self.a = np.ones((512, 512))
@@ -59,3 +90,87 @@ class TestBasics(object):
 
         assert(assignments[0].lvalue.name == 'a')
         assert(assignments[1].lvalue.name == 'b')
+
+    def test_memoization(self):
+        source = k_memo(self.a)
+        assert k_memo(self.a) is source
+        assert k_memo(np.ones((256, 256))) is not source
+        assert k_memo(np.ones((512, 512), dtype=np.float32)) is not source
+
+        # Trees are copied, changing one leaves later results alone
+        tree = k_scalar(3.5, self.a)
+        tree.decl.name = 'changed'
+        assert k_scalar(3.5, self.a).decl.name != 'changed'
+        assert pina.parser.python_ast(k_shift) is not pina.parser.python_ast(k_shift)
+
+        # Scalars are translated again for another default float type
+        default = 'double' if pina.qualifiers.is_double_default() else 'float'
+        other = 'float' if default == 'double' else 'double'
+        k_scalar(3.5, self.a)
+
+        try:
+            pina.set_default_float_type(other)
+            decls = pina.cast.find_type(k_scalar(3.5, self.a), c_ast.Decl)
+            s = [d for d in decls if d.name == 's']
+            assert s[0].type.type.names == [other]
+        finally:
+            pina.set_default_float_type(default)
+
+        size = pina.misc.MEMO_SIZE
+
+        try:
+            pina.misc.MEMO_SIZE = 2
+
+            for n in range(1, 5):
+                k_memo(np.ones((n, n)))
+
+            assert len(pina.misc._memo) == 2
+            assert k_memo(np.ones((4, 4))) is k_memo(np.ones((4, 4)))
+        finally:
+            pina.misc.MEMO_SIZE = size
+
+    def test_dynamic_shapes(self):
+        source = k_dynamic(self.a)
+        assert 'x__shape1' in source
+        assert 'x__stride0' in source
+        assert k_dynamic(np.ones((128, 256))) is source
+        assert 'x__shape0' not in k_dynamic(np.ones((64, 64)))
+
+    def test_dynamic_constants(self):
+        # The kernel built for small arrays is reused for large ones
+        small = np.ones((8, 8), dtype=np.float32)
+        large = np.ones((1024, 1024), dtype=np.float32)
+        source = k_dynamic_add(small, small)
+        assert k_dynamic_add(large, large) is source
+        assert '__constant' not in source
+
+        # Static shapes still use constant memory
+        static = np.ones((64, 64), dtype=np.float32)
+        assert '__constant' in k_dynamic_add(static, static)
+
+    def test_tree(self):
+        a, b = c_ast.ID('a'), c_ast.ID('b')
+        expr = c_ast.BinaryOp('+', a, c_ast.FuncCall(c_ast.ID('cos'), c_ast.ExprList([b])))
+        tree = pina.cast.Tree(c_ast.Compound([c_ast.Return(expr)]))
+        assert tree.parent(a) is expr
+        assert len(tree.find_type(c_ast.ID)) == 3
+
+        c = c_ast.ArrayRef(c_ast.ID('c'), c_ast.ID('idx'))
+        tree.replace(b, c)
+        assert b not in tree
+        assert expr.right.args.exprs[0] is c
+        assert tree.within(c.subscript, expr)
+        assert len(tree.find_type(c_ast.ID)) == 4
+
+    def test_fuse(self):
+        specs = [pina.misc.arg_specs(f, (self.a,)) for f in (k_double, k_double)]
+        fdef = pina.gen.fuse([k_double, k_double], specs)
+        assert [p.name for p in fdef.decl.type.args.params] == ['s0__x', 'out']
+
+        specs = [pina.misc.arg_specs(f, (self.a,)) for f in (k_double, k_shift)]
+
+        try:
+            pina.gen.fuse([k_double, k_shift], specs)
+            assert False
+        except TypeError:
+            pass
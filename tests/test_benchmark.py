@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import json
+import StringIO
+import pina.cl
+import pina.benchmark
+
+
+class TestBenchmark(object):
+    def setUp(self):
+        self.records = [dict(test='add', width=64, height=32,
+                             call=pina.benchmark.timing([1.0, 2.0, 3.0, 4.0, 5.0]),
+                             kernel=pina.benchmark.timing([0.5])),
+                        dict(test='cos', width=64, height=32,
+                             call=pina.benchmark.timing([2.0]))]
+
+    def test_timing(self):
+        t = pina.benchmark.timing([3.0, 1.0, 2.0, 5.0, 4.0])
+        assert t['mean'] == 3.0 and t['p50'] == 3.0
+        assert abs(t['std'] - 2 ** 0.5) < 1e-12
+        assert abs(t['p90'] - 4.6) < 1e-12
+        assert pina.benchmark.timing([]) is None
+
+    def test_output(self):
+        f = StringIO.StringIO()
+        pina.benchmark.write_csv(self.records, f)
+        lines = f.getvalue().splitlines()
+        header = lines[0].split(',')
+        assert header[:3] == ['test', 'width', 'height'] and 'call_p50' in header
+        assert 'kernel_p99' in header and len(lines) == 3
+        assert lines[2].split(',')[header.index('kernel_p50')] == ''
+
+        f = StringIO.StringIO()
+        pina.benchmark.write_json(self.records, f, backend='opencl')
+        data = json.loads(f.getvalue())
+        assert data['config'] == dict(backend='opencl')
+        assert data['records'][0]['call']['p50'] == 3.0
+
+    def test_compare(self):
+        slower = [dict(test='add', width=64, height=32,
+                       call=pina.benchmark.timing([3.2]),
+                       kernel=pina.benchmark.timing([0.52])),
+                  dict(test='cos', width=128, height=32,
+                       call=pina.benchmark.timing([20.0]))]
+
+        regressions = pina.benchmark.compare(self.records, slower, threshold=0.05)
+        assert [(r[0]['test'], r[1]) for r in regressions] == [('add', 'call_p50')]
+        assert 'add 64x32 call_p50' in pina.benchmark.format_regressions(regressions)
+        assert '+6.7%' in pina.benchmark.format_regressions(regressions)
+        assert not pina.benchmark.compare(self.records, slower, threshold=0.1)
+        assert len(pina.benchmark.compare(self.records, slower, 0.01, ('call_p50', 'kernel_p50'))) == 2
+
+    def test_translation(self):
+        env = pina.cl.ExecutionEnvironment()
+        records = pina.benchmark.translation_records([2, 4], iterations=2, env=env)
+        assert [(r['test'], r['size']) for r in records][:2] == [('chain', 2), ('chain', 4)]
+        assert len(records) == 2 * len(pina.benchmark.KERNELS)
+
+        for record in records:
+            passes = list(record)[2:]
+            assert passes[0] == 'parse' and passes[-2:] == ['source', 'total']
+            assert 'level1' in passes and 'level2' in passes
+            assert record['total']['mean'] >= record['parse']['mean']
+
+        # Fresh functions are parsed again
+        assert pina.benchmark.synthetic_kernel('stencil', 3) is not pina.benchmark.synthetic_kernel('stencil', 3)
+
+    def test_scaling(self):
+        sizes = [1, 2, 4, 8]
+        assert abs(pina.benchmark.scaling(sizes, [3.0 * s for s in sizes]) - 1) < 1e-12
+        assert abs(pina.benchmark.scaling(sizes, [0.5 * s * s for s in sizes]) - 2) < 1e-12
+        assert pina.benchmark.scaling([4], [1.0]) is None
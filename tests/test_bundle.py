@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+import pina.bundle
+from pina.bundle import compile_for
+from pina.ext.pycl import Runtime
+
+
+x = np.zeros((64, 32), dtype=np.float32)
+u = np.zeros((16, 16), dtype=np.uint16)
+
+
+@compile_for((x, x), (u, u))
+def k_add(a, b):
+    return a + b
+
+
+@compile_for((0.5, x))
+def k_shift(s, a):
+    return s * a[-1]
+
+
+@compile_for((x,))
+def k_mean(a):
+    return mean(a)
+
+
+class TestBundle(object):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        pina.bundle.build(self.path, [k_add, k_shift, k_mean], Runtime(cache=False))
+        self.a = np.random.random(x.shape).astype(np.float32)
+        self.b = np.random.random(x.shape).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_load(self):
+        bundle = pina.bundle.load(self.path)
+        assert bundle.index == 0
+        assert np.allclose(bundle.k_add(self.a, self.b), self.a + self.b)
+
+        v = (self.a[:16, :16] * 1000).astype(np.uint16)
+        result = bundle.k_add(v, v)
+        assert result.dtype == np.uint16 and np.all(result == 2 * v)
+
+        flat = self.a.ravel()
+        assert np.allclose(bundle.k_shift(0.5, self.a).ravel()[1:], 0.5 * flat[:-1])
+        assert np.allclose(bundle.k_mean(self.a), np.mean(self.a), rtol=1e-5)
+
+        out = np.empty_like(self.a)
+        assert bundle.k_add(self.a, self.b, out=out) is out
+
+    def test_imports(self):
+        # Loading and calling prebuilt kernels must not need pycparser
+        script = ("import sys, numpy as np, pina.bundle\n"
+                  "bundle = pina.bundle.load(sys.argv[1])\n"
+                  "bundle.k_add(*[np.zeros((64, 32), dtype=np.float32)] * 2)\n"
+                  "print([m for m in sys.modules if m.startswith('pycparser')])\n")
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(pina.bundle.__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+        output = subprocess.check_output([sys.executable, '-c', script, self.path], env=env)
+        assert output.strip() == b'[]'
+
+    def test_signatures(self):
+        bundle = pina.bundle.load(self.path)
+
+        calls = ((bundle.k_add, (self.a[:10], self.b[:10])),
+                 (bundle.k_add, (self.a.astype(np.float64), self.b)),
+                 (bundle.k_shift, (1, self.a)))
+
+        for call, args in calls:
+            try:
+                call(*args)
+                assert False
+            except TypeError:
+                pass
+
+    def test_source_fallback(self):
+        manifest_path = os.path.join(self.path, pina.bundle.MANIFEST)
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        manifest['devices'] = ['other device']
+
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+        bundle = pina.bundle.load(self.path)
+        assert bundle.index is None
+        assert np.allclose(bundle.k_add(self.a, self.b), self.a + self.b)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import pina.misc
+import pina.qualifiers
+from pina.cache import Cache, make_key
+from pina.cl import ExecutionEnvironment
+from pina.tuning import TuningDatabase
+
+
+def k_add(x, y):
+    return x + y
+
+
+class TestCache(object):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = Cache(self.path)
+        self.a = np.ones((64, 32)).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def key(self, *args, **kwargs):
+        specs = pina.misc.arg_specs(k_add, args)
+        return make_key(k_add, specs, kwargs.get('env'), ['device'])
+
+    def test_key(self):
+        b = np.ones((32, 64)).astype(np.float32)
+        env = ExecutionEnvironment()
+        assert self.key(self.a, self.a) == self.key(self.a, self.a)
+        assert self.key(self.a, self.a) != self.key(self.a, b)
+        assert self.key(self.a, self.a) != self.key(self.a, self.a, env=env)
+
+        default = 'double' if pina.qualifiers.is_double_default() else 'float'
+        key = self.key(self.a, 0.5)
+
+        try:
+            pina.set_default_float_type('float' if default == 'double' else 'double')
+            assert self.key(self.a, 0.5) != key
+        finally:
+            pina.set_default_float_type(default)
+
+    def test_roundtrip(self):
+        key = self.key(self.a, self.a)
+        assert self.cache.get(key) is None
+
+        self.cache.put(key, 'source', [b'binary'])
+        source, binaries = self.cache.get(key)
+        assert source == 'source'
+        assert binaries == [b'binary']
+
+    def test_eviction(self):
+        self.cache.max_size = 1024
+        self.cache.put('first', 'x' * 600)
+        self.cache.put('second', 'y' * 600)
+        assert self.cache.get('first') is None
+        assert self.cache.get('second') is not None
+
+    def test_foreign_files(self):
+        # The tuning database lives next to the entries by default
+        tuning = TuningDatabase(os.path.join(self.path, 'tuning.json'))
+        tuning.put('key', (16, 16))
+
+        self.cache.max_size = 1024
+        self.cache.put('first', 'x' * 600)
+        self.cache.put('second', 'y' * 600)
+        assert self.cache.get('second') is not None
+        assert TuningDatabase(tuning.path).get('key') == (16, 16)
+
+        self.cache.clear()
+        assert self.cache.size() == 0
+        assert os.path.exists(tuning.path)
@@ -1,10 +1,23 @@
 #!/usr/bin/env python
 
+import os
+import tempfile
 import numpy as np
-from pina.ext.pycl import Runtime
+from pina.ext.pycl import Runtime, size_class
+from pina.tuning import TuningDatabase
 
 
 m = Runtime()
+m_dynamic = Runtime(dynamic_shapes=True)
+m_ooo = Runtime(out_of_order=True)
+m_pinned = Runtime(pinned=True)
+m_multi = Runtime(use_multi_gpu=True)
+m_fast = Runtime(fast_math=True, native_math='native')
+
+m_tuned = Runtime(autotune=True, tuning=TuningDatabase(os.path.join(tempfile.mkdtemp(), 'tuning.json')))
+
+# Two queues on the same device stand in for two devices
+m_multi.queues.append(m_multi.create_queue(m_multi.devices[0], profiling=True))
 
 
 def k_add(x, y):
@@ -35,6 +48,63 @@ def k_mad_scalar(a, x, y):
     return a * x + y
 
 
+def k_neighbours(x, c):
+    return x[-1] + x[+1] + c[1, 0]
+
+
+def k_column(x):
+    return float(get_global_id(1) * get_global_size(0))
+
+
+def k_shifted_column(x):
+    return x[-1] + float(get_global_id(1) * get_global_size(0))
+
+
+def k_wide(x):
+    return x[-256] + x[+256]
+
+
+def k_sum(x, y):
+    return np.sum(x * y)
+
+
+def k_max(x):
+    return max(x)
+
+
+def k_mixed(x, s):
+    if s > 0:
+        return sum(x)
+
+    return x
+
+
+def k_mean(x):
+    return np.mean(x)
+
+
+def k_invariant(x, c):
+    s = 0.0
+
+    for i in range(4):
+        s += (x - 2.0 * 0.5) * c[i] + (x - 2.0 * 0.5) / c[i]
+
+    return s
+
+
+def k_taps(x, c):
+    s = 0.0
+
+    for v in c:
+        s += v * x
+
+    return s
+
+
+def k_half(x):
+    return x * 2.0 + 1.0
+
+
 def compare(func, *args):
     reference = func(*args)
     result = m.jit(func)(*args)
@@ -66,3 +136,320 @@ class TestBasics(object):
 
     def test_mad_scalar(self):
         compare(k_mad_scalar, 2.0, self.a, self.b)
+
+    def test_dataflow(self):
+        c = np.random.random(4).astype(np.float32) + 1.0
+        reference = sum((self.a - 1.0) * v + (self.a - 1.0) / v for v in c)
+        result = m.jit(k_invariant)(self.a, c)
+        assert np.allclose(result, reference, rtol=1e-4)
+
+    def test_fast_math(self):
+        for func in (k_cos, k_cospi, k_acospi):
+            assert np.allclose(m_fast.jit(func)(self.a), func(self.a), atol=1e-5)
+
+        result = m_fast.jit(k_complexmad)(self.a, self.b)
+        assert np.allclose(result, k_complexmad(self.a, self.b), atol=1e-5)
+
+    def test_inline_taps(self):
+        call = m.jit(k_taps, inline=('c',))
+
+        for taps in ([0.25, 0.5, 0.25], [1.0, -1.0]):
+            c = np.array(taps, dtype=np.float32)
+            assert np.allclose(call(self.a, c), sum(v * self.a for v in c), rtol=1e-4)
+
+        assert len(call.kernels) == 2
+
+    def test_narrow_types(self):
+        x = (self.a * 255).astype(np.uint8)
+        y = (self.b * 1000).astype(np.uint16)
+
+        result = m.jit(k_scale)(0.5, x)
+        assert result.dtype == np.float32 and np.allclose(result, 0.5 * x)
+
+        result = m.jit(k_add)(y, x)
+        assert result.dtype == np.uint16 and np.all(result == y + x)
+
+        result = m.jit(k_add)(x, x)
+        assert result.dtype == np.uint8 and np.all(result == x + x)
+
+        result = m.jit(k_scale)(3, x)
+        assert result.dtype == np.int32 and np.all(result == 3 * x.astype(np.int32))
+
+        result = m.jit(k_half)(self.a.astype(np.float16))
+        assert result.dtype == np.float32
+        assert np.allclose(result, k_half(self.a.astype(np.float16)), rtol=1e-3)
+
+    def test_batch(self):
+        stack = np.random.random((6, 16, 8)).astype(np.float32)
+        c = np.random.random((4, 4)).astype(np.float32)
+
+        for runtime in (m, m_dynamic, m_tuned):
+            result = runtime.jit(k_neighbours, batch=True)(stack, c)
+
+            for frame, computed in zip(stack, result):
+                reference = m.jit(k_neighbours)(frame, c).ravel()
+                assert np.allclose(computed.ravel()[1:-1], reference[1:-1])
+
+                # Relative accesses stop at the frame borders
+                assert np.allclose(computed.ravel()[0], frame.ravel()[0] + frame.ravel()[1] + c[1, 0])
+
+        assert np.allclose(m.jit(k_add, batch=True)(stack, stack), 2 * stack)
+        assert np.allclose(m.jit(k_add)(stack, stack), 2 * stack)
+
+    def test_profiling(self):
+        runtime = Runtime(profiling=True)
+        x = runtime.to_device(self.a)
+
+        assert np.allclose(runtime.jit(k_add)(self.a, self.b), self.a + self.b)
+        assert np.allclose(runtime.jit(k_scale)(2.0, x).get(), 2.0 * self.a)
+
+        summary = runtime.profile.summary()
+        assert summary[('k_add', 'upload')]['count'] == 2
+        assert summary[('k_add', 'kernel')]['count'] == 1
+        assert summary[('k_add', 'download')]['count'] == 1
+        assert ('to_device', 'upload') in summary and ('get', 'download') in summary
+        assert all(s['mean'] >= 0 for s in summary.values())
+
+    def test_buffer_pool(self):
+        assert size_class(1) == 4096 and size_class(4096) == 4096
+        assert size_class(4097) == 5120 and size_class(10000) == 10240
+
+        runtime = Runtime()
+        call = runtime.jit(k_add)
+        call(self.a, self.b)
+        stats = runtime.pool.stats()
+        assert stats['misses'] == 3 and stats['used'] == 0
+        assert stats['resident'] == 3 * size_class(self.a.nbytes)
+
+        for i in range(3):
+            assert np.allclose(call(self.a, self.b), self.a + self.b)
+
+        assert runtime.pool.stats()['hits'] == 9 and runtime.pool.stats()['misses'] == 3
+
+        # Smaller arrays get buffers of their own size class
+        assert np.allclose(call(self.a[:3], self.b[:3]), self.a[:3] + self.b[:3])
+        assert runtime.pool.stats()['misses'] == 6
+
+        # Rejected outputs do not leak buffers
+        try:
+            call(self.a, self.b, out=np.empty((3, 3)))
+            assert False
+        except ValueError:
+            pass
+
+        try:
+            runtime.jit(k_max)(self.a, out=np.empty(1))
+            assert False
+        except TypeError:
+            pass
+
+        assert runtime.pool.stats()['used'] == 0
+
+        # Device arrays hold a pooled buffer until they are released
+        x = runtime.to_device(self.a)
+        y = runtime.jit(k_cos)(x)
+        assert runtime.pool.stats()['used'] == 2 * size_class(self.a.nbytes)
+
+        x.release()
+        assert np.allclose(y.get(), np.cos(self.a))
+        assert np.allclose(runtime.jit(k_cos)(x).get(), np.cos(self.a))
+
+        del x, y
+        assert runtime.pool.stats()['used'] == 0
+        assert np.isclose(runtime.jit(k_max)(runtime.to_device(self.a)), self.a.max())
+        assert runtime.pool.stats()['used'] == 0
+
+        runtime.pool.clear()
+        assert runtime.pool.stats()['resident'] == 0
+
+        capped = Runtime(pool_bytes=0)
+        assert np.allclose(capped.jit(k_add)(self.a, self.b), self.a + self.b)
+        stats = capped.pool.stats()
+        assert stats['resident'] == 0 and stats['evictions'] == 3
+
+    def test_pipeline(self):
+        runtime = Runtime(profiling=True)
+        frames = [np.random.random(self.a.shape).astype(np.float32) for i in range(5)]
+        pipeline = runtime.pipeline([(runtime.jit(k_add), (self.b,)), (runtime.jit(k_scale), (2.0,))])
+        results = list(pipeline(iter(frames)))
+
+        assert len(results) == len(frames)
+        assert all(np.allclose(r, 2.0 * (self.b + f)) for r, f in zip(results, frames))
+
+        stats = pipeline.stats()
+        assert stats['frames'] == 5 and stats['latency']['count'] == 5
+        assert list(stats['stages']) == ['read', 'upload', 'k_add', 'k_scale', 'download']
+        assert all(s['count'] == 5 for s in stats['stages'].values())
+
+        energies = runtime.pipeline([runtime.jit(k_max)], depth=3)(f for f in frames)
+        assert np.allclose(list(energies), [f.max() for f in frames])
+
+        def failing():
+            yield self.a
+            raise IOError("camera disconnected")
+
+        try:
+            list(runtime.pipeline([runtime.jit(k_cos)])(failing()))
+            assert False
+        except IOError:
+            pass
+
+    def test_dynamic_shapes(self):
+        call = m_dynamic.jit(k_neighbours)
+
+        for shape in ((16, 8), (32, 24)):
+            x = np.random.random(shape).astype(np.float32)
+            c = np.random.random((shape[1], 4)).astype(np.float32)
+            result = call(x, c).ravel()
+            reference = x.ravel()[:-2] + x.ravel()[2:] + c[1, 0]
+            assert np.allclose(result[1:-1], reference)
+
+        assert len(set(call.kernels.values())) == 1
+
+    def test_device_arrays(self):
+        x = m.to_device(self.a)
+        cosines = m.jit(k_cos)(x)
+        assert cosines.device_dirty and cosines.host is None
+
+        result = m.jit(k_scale)(2.0, cosines)
+        assert np.allclose(result.get(), 2.0 * np.cos(self.a))
+        assert not x.host_dirty
+
+    def test_enqueue(self):
+        call = m_ooo.jit(k_add)
+        frames = [np.random.random((64, 32)).astype(np.float32) for i in range(4)]
+        futures = [call.enqueue(f, f) for f in frames]
+
+        for frame, future in zip(frames, futures):
+            assert np.allclose(future.result(), frame + frame)
+
+        x = m_ooo.to_device(self.a)
+        result = m_ooo.jit(k_scale).enqueue(2.0, m_ooo.jit(k_cos).enqueue(x).result())
+        assert np.allclose(result.result().get(), 2.0 * np.cos(self.a))
+
+    def test_fuse(self):
+        fused = m.fuse(k_cos, k_scale, k_mad_scalar)
+        result = fused(self.a, 2.0, 0.5, self.b)
+        reference = k_mad_scalar(0.5, self.b, k_scale(2.0, k_cos(self.a)))
+        assert np.allclose(result, reference)
+
+    def test_output(self):
+        call = m.jit(k_cos)
+        first, second = call(self.a), call(self.b)
+        assert first is not second
+        assert np.allclose(first, np.cos(self.a))
+
+        out = np.empty_like(self.a)
+        assert call(self.b, out=out) is out
+        assert np.allclose(out, np.cos(self.b))
+
+        out = m_pinned.empty_pinned(self.a.shape)
+        assert m_pinned.jit(k_cos)(self.a, out=out) is out
+        assert np.allclose(m_pinned.jit(k_add)(self.a, self.b), self.a + self.b)
+
+    def test_multi(self):
+        call = m_multi.jit(k_neighbours)
+        c = np.random.random((4, 4)).astype(np.float32)
+        reference = self.a.ravel()[:-2] + self.a.ravel()[2:] + c[1, 0]
+
+        # Slab borders must fall inside rows for the halo to matter
+        for weights in ([1, 1], [1, 3], [2.5, 1]):
+            call.weights = weights
+            result = call(self.a, c).ravel()
+            assert np.allclose(result[1:-1], reference)
+
+        call.weights = [1, 3]
+        assert call.slabs((8, 4)) == [(0, 1, 0, 9), (1, 4, 7, 32)]
+
+        # Slabs keep the global ids and sizes of an unsplit launch
+        column = m_multi.jit(k_column)
+
+        for weights in ([1, 1], [1, 3]):
+            column.weights = weights
+            assert np.all(column(self.a).ravel() == np.arange(self.a.size) // 512 * 512)
+
+        future = m_multi.jit(k_add).enqueue(self.a, self.b)
+        assert np.allclose(future.result(), self.a + self.b)
+
+    def test_autotune(self):
+        # An odd shape needs padding for most local sizes
+        x = np.random.random((97, 61)).astype(np.float32)
+        c = np.random.random((4, 4)).astype(np.float32)
+        call = m_tuned.jit(k_neighbours)
+        reference = x.ravel()[:-2] + x.ravel()[2:] + c[1, 0]
+
+        assert np.allclose(call(x, c).ravel()[1:-1], reference)
+        assert len(m_tuned.tuning.entries) == 1
+
+        # Reloading the database reuses the stored local size
+        tuning = TuningDatabase(m_tuned.tuning.path)
+        assert tuning.entries == m_tuned.tuning.entries
+        assert np.allclose(m_tuned.fuse(k_cos, k_scale)(x, 2.0), 2.0 * np.cos(x))
+
+    def test_vectorize(self):
+        m_vector = Runtime(opt_level=3)
+
+        # Sizes that are not a multiple of the vector width need a tail
+        for shape in ((64, 32), (33, 7), (3,)):
+            x = np.random.random(shape).astype(np.float32)
+            y = np.random.random(shape).astype(np.float32)
+            call = m_vector.jit(k_mad_scalar)
+            assert np.allclose(call(2.0, x, y), 2.0 * x + y)
+            assert max(call.widths.values()) > 1
+
+        fused = m_vector.fuse(k_cospi, k_scale)
+        assert np.allclose(fused(self.a, 2.0), 2.0 * np.cos(self.a * np.pi), atol=1e-5)
+        assert np.allclose(m_vector.jit(k_acospi)(self.a), np.arccos(self.a) / np.pi)
+
+        call = m_vector.jit(k_neighbours)
+        assert np.allclose(call(self.a, self.a).ravel()[1:-1],
+                           self.a.ravel()[:-2] + self.a.ravel()[2:] + self.a[1, 0])
+        assert max(call.widths.values()) == 1
+
+    def test_tiling(self):
+        runtimes = (Runtime(opt_level=3, tile_size=64),
+                    Runtime(opt_level=3, tile_size=32, dynamic_shapes=True),
+                    Runtime(opt_level=3, tile_size=64, tuning=m_tuned.tuning))
+
+        for runtime in runtimes:
+            for shape in ((64, 32), (33, 7)):
+                x = np.random.random(shape).astype(np.float32)
+                call = runtime.jit(k_neighbours)
+                result = call(x, self.a).ravel()
+                assert np.allclose(result[1:-1], x.ravel()[:-2] + x.ravel()[2:] + self.a[1, 0])
+                assert call.group_sizes.values()[0] == (runtime.env.tile_size, 1)
+
+            # Kernels querying the global range are not tiled
+            call = runtime.jit(k_shifted_column)
+            reference = m.jit(k_shifted_column)(self.a).ravel()
+            assert np.allclose(call(self.a).ravel()[1:], reference[1:])
+            assert call.group_sizes.values()[0] is None
+
+            # Halos wider than a tile are read directly
+            call = runtime.jit(k_wide)
+            flat = self.a.ravel()
+            assert np.allclose(call(self.a).ravel()[256:-256], flat[:-512] + flat[512:])
+            assert call.group_sizes.values()[0] is None
+
+    def test_reductions(self):
+        # Sizes below, at and above a single work group
+        for shape in ((100,), (256,), (512, 256), (97, 61)):
+            x = np.random.random(shape).astype(np.float32)
+            assert np.allclose(m.jit(k_sum)(x, x), np.sum(x * x), rtol=1e-4)
+            assert np.allclose(m.jit(k_mean)(x), np.mean(x), rtol=1e-4)
+            assert m.jit(k_max)(x) == np.max(x)
+
+        future = m_ooo.jit(k_mean).enqueue(m_ooo.to_device(self.a))
+        assert np.allclose(future.result(), np.mean(self.a), rtol=1e-4)
+
+        # Double input is reduced in double precision
+        x = np.random.random((512, 256)) + 1e-9
+        for result, reference in ((m.jit(k_sum)(x, x), np.sum(x * x)),
+                                  (m.jit(k_mean)(x), np.mean(x))):
+            assert result.dtype == np.float64 and np.allclose(result, reference, rtol=1e-12)
+
+        try:
+            m.jit(k_mixed)
+            assert False
+        except TypeError:
+            pass
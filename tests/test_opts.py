@@ -9,6 +9,10 @@ from pycparser import c_ast
 env = ExecutionEnvironment()
 env.opt_level = 2
 
+fast_env = ExecutionEnvironment()
+fast_env.fast_math = True
+fast_env.native_math = 'native'
+
 
 @jit(env=env, ast=True)
 def k_cospi(x, y):
@@ -25,6 +29,72 @@ def k_mad(x, y):
     return 2 * x + y
 
 
+@jit(env=env, ast=True)
+def k_fold(x):
+    return x * (2 * 3 - 1)
+
+
+@jit(env=env, ast=True)
+def k_cse(x, y):
+    return (x + y) * (x + y)
+
+
+@jit(env=env, ast=True)
+def k_invariant(x, c):
+    width = get_global_size(0)
+    s = 0.0
+
+    for i in range(40):
+        s += (x[0] - width / 2) * c[i]
+
+    return s
+
+
+@jit(env=env, ast=True)
+def k_unroll(x):
+    s = 0.0
+
+    for i in range(3):
+        s += x * i
+
+    return s
+
+
+@jit(env=env, ast=True)
+def k_unroll_partial(x, c):
+    s = 0.0
+
+    for i in range(30):
+        s += x * c[i]
+
+    return s
+
+
+@jit(env=env, ast=True, inline=('c',))
+def k_taps(x, c):
+    s = 0.0
+
+    for v in c:
+        s += v * x
+
+    return s
+
+
+@jit(env=fast_env, ast=True)
+def k_fast(x):
+    return np.sqrt(x) * 0.5 + np.pi
+
+
+@jit(env=env, ast=True, batch=True)
+def k_batch(x):
+    return x[-1] + x
+
+
+@jit(env=env, ast=True)
+def k_narrow(x, y):
+    return x - y
+
+
 class TestOptimizations(object):
     def setUp(self):
         self.a = np.ones((512, 512))
@@ -47,3 +117,70 @@ class TestOptimizations(object):
         r = pina.cast.find_type(ast, c_ast.FuncCall)
         assert len(r) == 1
         assert r[0].name.name == 'mad'
+
+    def test_fold_constants(self):
+        ast = k_fold(self.a)
+        r = pina.cast.find_type(ast, c_ast.Constant)
+        assert [c.value for c in r] == ['5']
+
+    def test_common_subexpressions(self):
+        ast = k_cse(self.a, self.b)
+        sums = [op for op in pina.cast.find_type(ast, c_ast.BinaryOp) if op.op == '+']
+        assert len(sums) == 2   # the work item index and x + y
+
+    def test_loop_invariants(self):
+        ast = k_invariant(self.a, np.ones(40))
+        loop = pina.cast.find_type(ast, c_ast.For)[0]
+        assert not [op for op in pina.cast.find_type(loop.stmt, c_ast.BinaryOp) if op.op == '/']
+
+    def test_unroll(self):
+        ast = k_unroll(self.a)
+        assert not pina.cast.find_type(ast, c_ast.For)
+
+    def test_unroll_partial(self):
+        ast = k_unroll_partial(self.a, np.ones(30))
+        loops = pina.cast.find_type(ast, c_ast.For)
+        assert len(loops) == 1
+        assert loops[0].cond.right.value == '28'
+        assert len(loops[0].stmt.block_items) == env.unroll_factor
+
+    def test_inline_taps(self):
+        ast = k_taps(self.a, np.array([0.25, 0.5, 0.25], dtype=np.float32))
+        refs = pina.cast.find_type(ast, c_ast.ArrayRef)
+        assert not [r for r in refs if r.name.name == 'c']
+
+        values = [c.value for c in pina.cast.find_type(ast, c_ast.Constant)]
+        assert '0.25f' in values and '0.5f' in values
+
+        # Taps of double arrays keep their precision
+        ast = k_taps(self.a, np.array([0.1, 1 + 1e-9, 0.3]))
+        values = [c.value for c in pina.cast.find_type(ast, c_ast.Constant)]
+        assert '1.000000001' in values and not [v for v in values if v.endswith('f')]
+
+    def test_fast_math(self):
+        ast = k_fast(self.a)
+        calls = [c.name.name for c in pina.cast.find_type(ast, c_ast.FuncCall)]
+        assert 'native_sqrt' in calls
+
+        values = [c.value for c in pina.cast.find_type(ast, c_ast.Constant)]
+        assert '0.5f' in values
+
+        ids = [i.name for i in pina.cast.find_type(ast, c_ast.ID)]
+        assert [i for i in ids if i.startswith('3.14159') and i.endswith('f')]
+
+    def test_batch(self):
+        ast = k_batch(np.ones((4, 16, 16), dtype=np.float32))
+        calls = [c.name.name for c in pina.cast.find_type(ast, c_ast.FuncCall)]
+        assert 'clamp' in calls
+
+        ids = [i.name for i in pina.cast.find_type(ast, c_ast.ID)]
+        assert 'get_global_id(2)' in ids
+
+    def test_narrow_types(self):
+        x = np.ones((16, 16), dtype=np.uint8)
+        y = np.ones((16, 16), dtype=np.uint16)
+        ast = k_narrow(x, y)
+        params = dict((p.name, pina.cast.type_name(p)) for p in
+                      pina.cast.find_type(ast, c_ast.Decl) if isinstance(p.type, c_ast.PtrDecl))
+
+        assert params == {'x': 'unsigned char', 'y': 'unsigned short', 'out': 'unsigned short'}
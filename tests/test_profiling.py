@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import tempfile
+from pina.profiling import Profile, percentile
+
+
+class Times(object):
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class Event(object):
+    def __init__(self, start, end):
+        self.profile = Times(start, end)
+
+    def wait(self):
+        pass
+
+
+class TestProfiling(object):
+    def setUp(self):
+        self.profile = Profile()
+
+        for i in range(10):
+            start = 1000000 * i
+            self.profile.record('add', 'upload', 0, Event(start, start + 1000), 'gpu')
+            self.profile.record('add', 'kernel', 0, Event(start + 1000, start + 5000))
+            self.profile.record('add', 'download', 1, Event(start + 5000, start + 6000 + i))
+
+    def test_percentile(self):
+        assert percentile([], 50) is None
+        assert percentile([1.0], 90) == 1.0
+        assert percentile([1.0, 2.0, 3.0], 50) == 2.0
+        assert percentile([1.0, 2.0], 25) == 1.25
+
+    def test_summary(self):
+        summary = self.profile.summary()
+        assert sorted(summary) == [('add', 'download'), ('add', 'kernel'), ('add', 'upload')]
+
+        kernel = summary[('add', 'kernel')]
+        assert kernel['count'] == 10
+        assert abs(kernel['mean'] - 4e-6) < 1e-12
+        assert summary[('add', 'download')]['p90'] > summary[('add', 'download')]['p50']
+
+    def test_trace(self):
+        path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+
+        try:
+            self.profile.write_trace(path)
+
+            with open(path) as f:
+                events = json.load(f)['traceEvents']
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+        spans = [e for e in events if e['ph'] == 'X']
+        names = dict((e['pid'], e['args']['name']) for e in events if e['name'] == 'process_name')
+
+        assert len(spans) == 30
+        assert min(e['ts'] for e in spans) == 0
+        assert names == {0: '0: gpu', 1: '1: queue'}
+        assert set(e['tid'] for e in spans if e['cat'] == 'kernel') == set([1])
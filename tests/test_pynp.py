@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import numpy as np
+from pina.ext.pynp import Runtime
+
+
+m = Runtime(chunk_size=1000)
+m_serial = Runtime(n_threads=1)
+
+
+def k_mad_scalar(a, x, y):
+    return a * x + y
+
+
+def k_cospi(x):
+    return cospi(x)
+
+
+def k_neighbours(x, c):
+    return x[-1] + x[+1] + c[1, 0]
+
+
+def k_clip(x):
+    if x > 0.5:
+        return 0.5
+
+    return x
+
+
+def k_taps(x, c):
+    s = 0.0
+
+    for v in c:
+        s += v * x
+
+    return s
+
+
+def k_column(x):
+    return float(get_global_id(1))
+
+
+def k_sum(x, y):
+    return sum(x * y)
+
+
+def k_mean(x):
+    return mean(x)
+
+
+class TestNumPyBackend(object):
+    def setUp(self):
+        self.a = np.random.random((97, 61)).astype(np.float32)
+        self.b = np.random.random((97, 61)).astype(np.float32)
+
+    def test_elementwise(self):
+        for runtime in (m, m_serial):
+            assert np.allclose(runtime.jit(k_mad_scalar)(2.0, self.a, self.b), 2.0 * self.a + self.b)
+            assert np.allclose(runtime.jit(k_cospi)(self.a), np.cos(np.pi * self.a), atol=1e-6)
+
+    def test_relative(self):
+        c = np.random.random((4, 4)).astype(np.float32)
+        result = m.jit(k_neighbours)(self.a, c).ravel()
+        flat = self.a.ravel()
+        assert np.allclose(result[1:-1], flat[:-2] + flat[2:] + c[1, 0])
+
+        # Borders repeat the first and last element
+        assert np.allclose(result[0], flat[0] + flat[1] + c[1, 0])
+
+        stack = np.random.random((5, 16, 8)).astype(np.float32)
+        result = m.jit(k_neighbours, batch=True)(stack, c)
+
+        for frame, computed in zip(stack, result):
+            assert np.allclose(computed, m.jit(k_neighbours)(frame, c))
+
+    def test_control_flow(self):
+        assert np.allclose(m.jit(k_clip)(self.a), np.minimum(self.a, 0.5))
+
+        c = np.array([0.25, 0.5, 0.25], dtype=np.float32)
+        assert np.allclose(m.jit(k_taps)(self.a, c), self.a)
+
+        # Work items enumerate dimension 0 fastest
+        result = m.jit(k_column)(self.a).ravel()
+        assert np.all(result == np.arange(self.a.size) // 97)
+
+    def test_types(self):
+        x = (self.a * 255).astype(np.uint8)
+        result = m.jit(k_mad_scalar)(3, x, x)
+        assert result.dtype == np.int32 and np.all(result == 4 * x.astype(np.int32))
+
+        result = m.jit(k_mad_scalar)(0.5, x, self.b)
+        assert result.dtype == np.float32 and np.allclose(result, 0.5 * x + self.b)
+
+    def test_reductions(self):
+        assert np.allclose(m.jit(k_sum)(self.a, self.b), np.sum(self.a * self.b), rtol=1e-5)
+        assert np.allclose(m.jit(k_mean)(self.a), np.mean(self.a), rtol=1e-5)
+
+    def test_output(self):
+        out = np.empty_like(self.a)
+        assert m.jit(k_cospi)(self.a, out=out) is out
+
+        fused = m.fuse(k_cospi, k_mad_scalar)
+        assert np.allclose(fused(self.a, 2.0, self.b), 2.0 * self.b + np.cos(np.pi * self.a))
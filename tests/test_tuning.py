@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+from pina.tuning import TuningDatabase, candidates, padded, shape_class
+
+
+class TestTuning(object):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fname = os.path.join(self.path, 'tuning.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_candidates(self):
+        sizes = candidates((100, 3), 256, (1024, 1024, 64))
+        assert sizes[0] is None
+        assert (64, 2) in sizes and (16, 4) in sizes
+        assert all(l0 * l1 <= 256 and l1 <= 4 for l0, l1 in sizes[1:])
+
+    def test_padded(self):
+        assert padded((100, 3), (16, 2)) == (112, 4)
+        assert padded((100, 3), None) == (100, 3)
+        assert shape_class((100, 3)) == (128, 4)
+
+    def test_database(self):
+        db = TuningDatabase(self.fname)
+        db.put('k/a', (16, 4))
+        db.put('k/b', None)
+
+        other = TuningDatabase(self.fname)
+        assert other.get('k/a') == (16, 4)
+        assert 'k/b' in other and other.get('k/b') is None
+        assert 'k/c' not in other